@@ -0,0 +1,63 @@
+"""Shared helpers for benchmark scripts: percentiles and JSON reports."""
+import json
+import platform
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+
+def summarize(samples: List[float]) -> Dict:
+    """Latency summary in milliseconds for a list of durations in seconds"""
+    values = sorted(s * 1000 for s in samples)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 3),
+        "p50_ms": round(percentile(values, 50), 3),
+        "p95_ms": round(percentile(values, 95), 3),
+        "p99_ms": round(percentile(values, 99), 3),
+        "max_ms": round(values[-1], 3),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def write_report(path: str, name: str, params: Dict, results: Dict):
+    """Write results as JSON so runs can be diffed across commits"""
+    report = {
+        "benchmark": name,
+        "commit": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": params,
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+
+
+def print_table(rows: Dict[str, Dict]):
+    print(f"{'name':<32}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, s in rows.items():
+        if not s.get("count"):
+            continue
+        print(
+            f"{name:<32}{s['count']:>8}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}"
+            f"{s['p99_ms']:>10.2f}{s['max_ms']:>10.2f}"
+        )
@@ -0,0 +1,110 @@
+"""Minimal fake Telegram Bot API server for benchmarks.
+
+Answers the methods the bot uses with valid-looking payloads and lets the
+harness wait for the bot's reply to a specific chat or callback query.
+Updates pushed with push_update() are served through getUpdates, so the
+polling runner can be benchmarked without the webhook HTTP layer.
+"""
+import asyncio
+import itertools
+import time
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Emotion Diary", "username": "emotion_diary_bench_bot"}
+
+# Methods that return a Message object
+MESSAGE_METHODS = {"sendmessage", "editmessagetext", "sendphoto", "senddocument"}
+
+
+class FakeTelegramServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, latency_ms: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency_ms / 1000
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+        self._waiters: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._updates: List[Dict] = []
+        self._updates_event = asyncio.Event()
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def expect(self, kind: str, key) -> asyncio.Future:
+        """Future resolved with the monotonic time of the next matching call.
+        kind is "chat" (any message to chat_id) or "callback" (answerCallbackQuery)"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[(kind, str(key))] = future
+        return future
+
+    def push_update(self, update: Dict):
+        self._updates.append(update)
+        self._updates_event.set()
+
+    async def _get_updates(self, data) -> List[Dict]:
+        offset = int(data.get("offset") or 0)
+        limit = int(data.get("limit") or 100)
+        timeout = float(data.get("timeout") or 0)
+
+        # Updates below offset are confirmed by the client
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._updates_event.clear()
+            try:
+                await asyncio.wait_for(self._updates_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    def _resolve(self, kind: str, key):
+        future = self._waiters.pop((kind, str(key)), None)
+        if future and not future.done():
+            future.set_result(time.monotonic())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        data = await request.post()
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getme":
+            result = BOT_USER
+        elif method == "getupdates":
+            result = await self._get_updates(data)
+        elif method in MESSAGE_METHODS:
+            chat_id = int(data.get("chat_id", 0))
+            message_id = int(data.get("message_id") or next(self._message_ids))
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": data.get("text", ""),
+            }
+            self._resolve("chat", chat_id)
+        elif method == "answercallbackquery":
+            result = True
+            self._resolve("callback", data.get("callback_query_id"))
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
@@ -0,0 +1,132 @@
+"""Logging overhead benchmark.
+
+    python -m benchmarks.logging_bench --users 20000 --json logging.json
+
+Simulates a ping wave of N users on an asyncio loop and measures how long
+logging keeps the loop thread busy, for three setups:
+
+    direct   logging.basicConfig-style StreamHandler writing on the loop thread
+    queue    setup_logging(): QueueHandler on the loop, JSON written by a thread
+    batch    queue pipeline plus LogBatch (one summary line per wave)
+
+Output goes to a real file so write and flush costs are included;
+--write-latency-us adds a blocking delay per write, like stderr piped into
+a log collector that is falling behind.
+Reports loop-thread time per user and the worst loop stall seen by a
+1 ms ticker running next to the wave.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from benchmarks.common import write_report
+from logging_setup import LogBatch, setup_logging, stop_logging
+
+logger = logging.getLogger("bench")
+
+
+class SlowStream:
+    def __init__(self, stream, latency: float):
+        self.stream = stream
+        self.latency = latency
+
+    def write(self, text: str):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def direct(stream):
+    root = logging.getLogger()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    root.handlers = [handler]
+    root.setLevel(logging.INFO)
+    return None
+
+
+async def ticker(stop: asyncio.Event, stalls: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - started - 0.001)
+
+
+async def wave(users: int, batched: bool):
+    stop = asyncio.Event()
+    stalls = []
+    tick = asyncio.create_task(ticker(stop, stalls))
+    await asyncio.sleep(0)
+
+    batch = LogBatch(logger, "ping") if batched else None
+    busy = 0.0
+    for user_id in range(users):
+        started = time.perf_counter()
+        if batch:
+            batch.ok(user_id)
+        else:
+            logger.info(f"Sent check to user {user_id}")
+        busy += time.perf_counter() - started
+        if user_id % 100 == 0:
+            # Stand-in for awaiting send_message
+            await asyncio.sleep(0)
+    if batch:
+        started = time.perf_counter()
+        batch.flush()
+        busy += time.perf_counter() - started
+
+    stop.set()
+    await tick
+    return busy, max(stalls or [0])
+
+
+def run(mode: str, users: int, path: str, latency: float):
+    with open(path, "w") as file:
+        stream = SlowStream(file, latency)
+        listener = direct(stream) if mode == "direct" else setup_logging(level="INFO", fmt="json", stream=stream)
+        busy, stall = asyncio.run(wave(users, batched=mode == "batch"))
+        if listener:
+            drained = time.perf_counter()
+            stop_logging()
+            drain_ms = (time.perf_counter() - drained) * 1000
+        else:
+            drain_ms = 0.0
+    size = os.path.getsize(path)
+    return {
+        "loop_us_per_user": round(busy / users * 1e6, 2),
+        "loop_ms": round(busy * 1000, 1),
+        "max_stall_ms": round(stall * 1000, 2),
+        "drain_ms": round(drain_ms, 1),
+        "output_kb": round(size / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--write-latency-us", type=float, default=0)
+    parser.add_argument("--json", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("direct", "queue", "batch"):
+            results[mode] = run(mode, args.users, os.path.join(tmp, f"{mode}.log"), args.write_latency_us / 1e6)
+
+    print(f"{args.users} users, write latency {args.write_latency_us} us")
+    print(f"{'':<8}{'us/user':>10}{'loop ms':>10}{'stall ms':>10}{'drain ms':>10}{'KB':>10}")
+    for name, r in results.items():
+        print(f"{name:<8}{r['loop_us_per_user']:>10}{r['loop_ms']:>10}{r['max_stall_ms']:>10}{r['drain_ms']:>10}{r['output_kb']:>10}")
+
+    if args.json:
+        write_report(args.json, "logging", {"users": args.users, "write_latency_us": args.write_latency_us}, results)
+
+
+if __name__ == "__main__":
+    main()
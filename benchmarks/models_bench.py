@@ -0,0 +1,93 @@
+"""Memory and allocation benchmark for row models.
+
+    python -m benchmarks.models_bench --users 1000000 --json models.json
+
+Builds N user rows the way Database does, once as dict(row) copies and
+once as ScheduleSettings NamedTuples, and reports memory held, allocated
+blocks, build time and the time of a cron-style sweep over all rows.
+Plain tuples stand in for asyncpg Records, so no database is needed.
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from benchmarks.common import write_report
+from benchmarks.seed import generate_users
+from models import ScheduleSettings
+
+FIELDS = ScheduleSettings._fields
+
+
+def as_dicts(rows):
+    return [dict(zip(FIELDS, row)) for row in rows]
+
+
+def as_models(rows):
+    return [ScheduleSettings._make(row) for row in rows]
+
+
+def sweep_dicts(items) -> int:
+    total = 0
+    for item in items:
+        total += item['timezone'] + item['check_start_hour'] + item['check_end_hour'] + item['checks_per_day']
+    return total
+
+
+def sweep_models(items) -> int:
+    total = 0
+    for item in items:
+        total += item.timezone + item.check_start_hour + item.check_end_hour + item.checks_per_day
+    return total
+
+
+def measure(build, sweep, rows):
+    gc.collect()
+    tracemalloc.start()
+    items = build(rows)
+    held, _ = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+
+    # Time the build and sweep again without tracemalloc overhead
+    del items
+    gc.collect()
+    started = time.perf_counter()
+    items = build(rows)
+    build_s = time.perf_counter() - started
+    started = time.perf_counter()
+    sweep(items)
+    sweep_s = time.perf_counter() - started
+    return {
+        "held_mb": round(held / 2 ** 20, 1),
+        "bytes_per_row": round(held / len(rows), 1),
+        "blocks": blocks,
+        "build_ms": round(build_s * 1000, 1),
+        "sweep_ms": round(sweep_s * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--json", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    # (user_id, timezone, start, end, checks_per_day, settings_version)
+    rows = [row[:5] + (0,) for row in generate_users(args.users)]
+
+    results = {
+        "dict": measure(as_dicts, sweep_dicts, rows),
+        "namedtuple": measure(as_models, sweep_models, rows),
+    }
+    print(f"{args.users} rows")
+    print(f"{'':<12}{'MB':>8}{'B/row':>8}{'blocks':>10}{'build ms':>10}{'sweep ms':>10}")
+    for name, r in results.items():
+        print(f"{name:<12}{r['held_mb']:>8}{r['bytes_per_row']:>8}{r['blocks']:>10}{r['build_ms']:>10}{r['sweep_ms']:>10}")
+
+    if args.json:
+        write_report(args.json, "models", {"users": args.users}, results)
+
+
+if __name__ == "__main__":
+    main()
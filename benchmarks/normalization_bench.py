@@ -0,0 +1,85 @@
+"""Microbenchmark for free-text emotion normalization.
+
+    python -m benchmarks.normalization_bench --json normalization.json
+
+Reports the cost of building the index and of a single lookup per kind of
+input (exact taxonomy word, synonym, inflected form, multi-word phrase, miss),
+both through the result cache and for a cold slow-path lookup. The 1 us
+verdict is taken from the cold lookup, which is what every first-seen input
+pays; a kind that only meets it through the cache is reported as such.
+"""
+import argparse
+import time
+
+from benchmarks.common import write_report
+from normalization import EmotionNormalizer
+
+INPUTS = {
+    "exact": ["тревога", "радость", "усталость", "раздражение", "спокойствие"],
+    "case_spaces": ["Тревога ", " РАДОСТЬ", "Усталость  "],
+    "synonym": ["тревожно", "бесит", "устала", "грустно", "счастлива"],
+    "inflected": ["раздражённая", "тревожная", "вдохновлённый", "разочарованная"],
+    "phrase": ["немного тревожно", "очень устала сегодня", "скучаю по дому"],
+    "miss": ["кот", "не знаю", "что-то странное", "ммм"],
+    # Negated: kept as text, never mapped to the emotion they name
+    "negated": ["не радостно", "мне не хорошо", "ничего хорошего", "не тревожно", "без радости"],
+}
+
+
+def bench(fn, values, repeat: int) -> float:
+    """Best per-call time in nanoseconds over 5 runs"""
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter_ns()
+        for _ in range(repeat):
+            for value in values:
+                fn(value)
+        best = min(best, (time.perf_counter_ns() - started) / (repeat * len(values)))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20_000)
+    parser.add_argument("--json", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    normalizer = EmotionNormalizer.from_taxonomy()
+    build_ms = (time.perf_counter() - started) * 1000
+
+    results = {
+        "build_ms": round(build_ms, 3),
+        "index_size": {"exact": len(normalizer.exact), "stems": len(normalizer.stems)},
+        "lookup_ns": {},
+    }
+    print(f"index built in {build_ms:.2f} ms, {len(normalizer.exact)} forms, {len(normalizer.stems)} stems")
+    print(f"{'input':<14}{'cached':>10}{'uncached':>12}")
+    for kind, values in INPUTS.items():
+        cached = bench(normalizer.lookup, values, args.repeat)
+        uncached = bench(normalizer._lookup_slow, values, max(1, args.repeat // 10))
+        results["lookup_ns"][kind] = {"cached": round(cached, 1), "uncached": round(uncached, 1)}
+        if uncached < 1000:
+            verdict = "ok"
+        elif cached < 1000:
+            verdict = "over 1us, under only for cache hits"
+        else:
+            verdict = "over 1us"
+        print(f"{kind:<14}{cached:>10.0f}{uncached:>12.0f} ns  {verdict}")
+
+    results["under_1us"] = {
+        "uncached": all(kind["uncached"] < 1000 for kind in results["lookup_ns"].values()),
+        "cached": all(kind["cached"] < 1000 for kind in results["lookup_ns"].values()),
+    }
+
+    # Negated input must stay unmapped
+    results["negated_mapped"] = [value for value in INPUTS["negated"] if normalizer.lookup(value)]
+    if results["negated_mapped"]:
+        print(f"negated input mapped to an emotion: {results['negated_mapped']}")
+
+    if args.json:
+        write_report(args.json, "normalization", {"repeat": args.repeat}, results)
+
+
+if __name__ == "__main__":
+    main()
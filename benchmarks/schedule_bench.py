@@ -0,0 +1,96 @@
+"""Benchmark for bulk ping-time generation.
+
+    python -m benchmarks.schedule_bench --users 1000000 --json schedule.json
+
+Generates a day of checks for N users with generate_bulk_check_times,
+validates the result (per-user count, sorted, distinct, inside the check
+window) and compares with the per-user Python loop on a sample.
+"""
+import argparse
+import random
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from benchmarks.common import write_report
+from benchmarks.seed import generate_users
+from ping_schedule import generate_bulk_check_times, pick_check_minutes
+
+
+def python_loop(rows, day: date):
+    """What schedule_daily_checks does for each user"""
+    result = []
+    for user_id, timezone, start_hour, end_hour, count, _ in rows:
+        for minutes in pick_check_minutes(random, start_hour, end_hour, count):
+            check_time = datetime.combine(day, datetime.min.time()) + timedelta(
+                hours=start_hour - timezone, minutes=minutes
+            )
+            result.append((user_id, check_time))
+    return result
+
+
+def validate(rows, user_ids, times, day: date) -> int:
+    """Raises AssertionError on a bad schedule; returns the number of checks"""
+    columns = np.array([row[:5] for row in rows], dtype=np.int64).T
+    ids, timezones, starts, ends, counts = columns
+    expected = np.minimum(counts, (ends - starts) * 60)
+    assert len(user_ids) == expected.sum(), "wrong number of checks"
+    assert np.array_equal(user_ids, np.repeat(ids, expected)), "checks out of user order"
+
+    local = (times - np.datetime64(day, "m")).astype(np.int64) + np.repeat(timezones * 60, expected)
+    assert (local >= np.repeat(starts * 60, expected)).all(), "check before window"
+    assert (local < np.repeat(ends * 60, expected)).all(), "check after window"
+
+    same_user = user_ids[1:] == user_ids[:-1]
+    assert (np.diff(local)[same_user] > 0).all(), "minutes not sorted or colliding"
+    return int(expected.sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--sample", type=int, default=20_000, help="users timed with the Python loop")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    rows = list(generate_users(args.users))
+    columns = [np.array(c) for c in zip(*rows)][:5]
+    day = date.today()
+
+    best = float("inf")
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        user_ids, times = generate_bulk_check_times(*columns, day)
+        best = min(best, time.perf_counter() - started)
+    checks = validate(rows, user_ids, times, day)
+
+    started = time.perf_counter()
+    records = list(zip(user_ids.tolist(), times.astype("datetime64[us]").tolist()))
+    to_records = time.perf_counter() - started
+
+    sample = rows[:args.sample]
+    started = time.perf_counter()
+    python_loop(sample, day)
+    loop_per_user = (time.perf_counter() - started) / len(sample)
+
+    results = {
+        "checks": checks,
+        "bulk_ms": round(best * 1000, 1),
+        "to_records_ms": round(to_records * 1000, 1),
+        "python_loop_ms_extrapolated": round(loop_per_user * args.users * 1000, 1),
+        "speedup": round(loop_per_user * args.users / best, 1),
+    }
+    print(f"{args.users} users, {checks} checks ({len(records)} records)")
+    print(f"bulk generation     {results['bulk_ms']:>10.1f} ms  {'ok' if best < 1 else 'over 1s'}")
+    print(f"to COPY records     {results['to_records_ms']:>10.1f} ms")
+    print(f"python loop (est.)  {results['python_loop_ms_extrapolated']:>10.1f} ms")
+
+    if args.json:
+        params = {"users": args.users, "sample": args.sample, "repeat": args.repeat}
+        write_report(args.json, "schedule", params, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Synthetic dataset generator shared by the database benchmarks.
+
+Users get realistic settings and entries drawn from emotions.EMOTIONS and
+BODY_SENSATIONS: skewed category popularity, intensities around the middle
+of the scale, entries clustered in waking hours and optional free text.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import Iterator, Tuple
+
+from emotions import EMOTIONS, CATEGORIES, BODY_SENSATIONS
+
+# Rough popularity of categories in real diaries: anxiety and fatigue dominate
+CATEGORY_WEIGHTS = {
+    "😊 Радость": 1.2,
+    "😌 Спокойствие": 1.0,
+    "🧐 Интерес": 0.7,
+    "😔 Грусть": 0.9,
+    "😰 Тревога": 1.6,
+    "😠 Злость": 0.8,
+    "😴 Усталость": 1.4,
+}
+
+REASONS = [
+    "работа", "дедлайн", "разговор с мамой", "плохо спал", "прогулка", "кофе с другом",
+    "пробки", "совещание", "тренировка", "новости", "ребёнок заболел", "выходной",
+    "ссора с партнёром", "похвалили на работе", "долго ехать домой", "хорошая погода",
+]
+
+FREE_TEXT_EMOTIONS = ["тревожно", "Тревога ", "ок", "нормально", "растерянность", "бешенство", "устала"]
+
+
+def generate_users(count: int, first_user_id: int = 1) -> Iterator[Tuple]:
+    """Rows for users(user_id, timezone, check_start_hour, check_end_hour, checks_per_day, onboarding_complete)"""
+    for i in range(count):
+        start = random.choice([7, 8, 9, 9, 9, 10])
+        end = random.choice([20, 21, 22, 22, 23])
+        yield (
+            first_user_id + i,
+            random.choice([2, 3, 3, 3, 4, 5, 7]),
+            start,
+            end,
+            random.choice([2, 3, 4, 4, 4, 5]),
+            True,
+        )
+
+
+def generate_entries(user_id: int, count: int, days: int = 180, now: datetime = None) -> Iterator[Tuple]:
+    """Rows for entries(user_id, category, emotion, intensity, body_sensation, reason, note, created_at)"""
+    now = now or datetime.now()
+    categories = CATEGORIES
+    weights = [CATEGORY_WEIGHTS.get(c, 1.0) for c in CATEGORIES]
+    for _ in range(count):
+        if random.random() < 0.15:
+            category = None
+            emotion = random.choice(FREE_TEXT_EMOTIONS)
+        else:
+            category = random.choices(categories, weights=weights)[0]
+            emotion = random.choice(EMOTIONS[category]["emotions"])
+
+        intensity = None
+        if random.random() < 0.6:
+            intensity = max(0, min(10, round(random.gauss(5, 2))))
+
+        body = random.choice(BODY_SENSATIONS) if random.random() < 0.5 else None
+        reason = random.choice(REASONS) if random.random() < 0.7 else None
+        note = "заметка" if random.random() < 0.1 else None
+
+        # Skew towards recent days and waking hours
+        day = int(random.triangular(0, days, 0))
+        hour = int(random.triangular(7, 23, 19))
+        created_at = (now - timedelta(days=day)).replace(
+            hour=hour, minute=random.randrange(60), second=random.randrange(60), microsecond=0
+        )
+        yield (user_id, category, emotion, intensity, body, reason, note, created_at)
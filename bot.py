@@ -1,11 +1,19 @@
 import asyncio
+import hmac
+import json
 import logging
+import os
 import random
+import signal
+import threading
 from datetime import datetime, timedelta, timezone as tz
+from typing import List, Optional, Tuple
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand
+from aiogram.types import (
+    Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand, BufferedInputFile, Update,
+)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -14,17 +22,52 @@ from aiohttp import web
 
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from config import BOT_TOKEN, WEBHOOK_URL, WEBHOOK_PATH
+from config import (
+    BOT_TOKEN, WEBHOOK_URL, WEBHOOK_PATH,
+    UPDATE_QUEUE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_QUEUE_PUT_TIMEOUT,
+    BOT_MODE, POLLING_LIMIT, POLLING_TIMEOUT, POLLING_WORKERS, BOT_WORKERS, ENTRY_SPOOL_PATH,
+    SCHEDULE_MODE, DEBUG_TOKEN, CHART_DAYS, IMPORT_MAX_BYTES,
+)
+from charts import chart_service
 from database import db
 from emotions import EMOTIONS, CATEGORIES, BODY_SENSATIONS
-
-logging.basicConfig(level=logging.INFO)
+from importer import import_document
+from insights import render_insight, update_insights
+from leader import leader, leader_only
+from logging_setup import LogBatch, setup_logging
+from metrics import metrics
+from ping_schedule import PingIndex, generate_bulk_check_times, pick_check_minutes
+from polling import poll_updates
+from reason_clusters import cluster_new_reasons
+from reports import build_report, render_report, month_range, year_range
+from response_cache import response_cache
+from retention import apply_retention, process_deletion_requests
+from profiler import profile_loop_thread
+from spool import EntryRejected, EntrySpool, entry_writer
+from supervisor import Supervisor, raw_chat_id, serve_worker
+from telegram_session import create_session
+from throttling import ThrottlingMiddleware
+from tracing import (
+    TelegramTracingMiddleware, TracedStorage, TracingMiddleware, instrument_database, slow_updates,
+)
+from update_queue import UpdateQueue, QueuedRequestHandler
+from webapp_api import setup_api
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+bot = Bot(token=BOT_TOKEN, session=create_session())
+bot.session.middleware(TelegramTracingMiddleware())
+storage = TracedStorage(MemoryStorage())
 dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(TracingMiddleware())
+# Inner middleware: handler flags (throttling cost class) are only known there
+throttling = ThrottlingMiddleware()
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
 scheduler = AsyncIOScheduler()
+ping_index = PingIndex()
+last_derived_dispatch: Optional[datetime] = None
 
 
 # === FSM States ===
@@ -50,6 +93,10 @@ class SettingsStates(StatesGroup):
     waiting_for_checks_count = State()
 
 
+class ImportStates(StatesGroup):
+    waiting_for_file = State()
+
+
 # === Keyboards ===
 
 def get_main_menu():
@@ -165,8 +212,23 @@ def get_ping_keyboard():
 @dp.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     user = await db.get_user(message.from_user.id)
-
-    if user and user.get('onboarding_complete'):
+    # Coming back before /delete_me has been carried out cancels it
+    restored_checks = await db.cancel_deletion(user.user_id) if user else None
+    if restored_checks is not None:
+        logger.info(f"User {user.user_id} cancelled account deletion")
+
+    if user and user.onboarding_complete:
+        if restored_checks is not None:
+            await schedule_daily_checks(
+                user.user_id, user.timezone, user.check_start_hour, user.check_end_hour, restored_checks
+            )
+            await message.answer(
+                "С возвращением! Удаление отменено: записи и настройки на месте, "
+                "напоминания снова включены.\n\n"
+                "Как ты сейчас?",
+                reply_markup=get_main_menu()
+            )
+            return
         await message.answer(
             "С возвращением! Рада тебя видеть.\n\n"
             "Как ты сейчас?",
@@ -493,15 +555,24 @@ async def save_entry_and_finish(message: Message, state: FSMContext, edit: bool
     data = await state.get_data()
     user_id = message.chat.id
 
-    await db.save_entry(
-        user_id=user_id,
-        emotion=data.get('emotion', ''),
-        category=data.get('category'),
-        intensity=data.get('intensity'),
-        body_sensation=data.get('body_sensation'),
-        reason=data.get('reason'),
-        note=data.get('note')
-    )
+    try:
+        await entry_writer.save(
+            user_id=user_id,
+            emotion=data.get('emotion', ''),
+            category=data.get('category'),
+            intensity=data.get('intensity'),
+            body_sensation=data.get('body_sensation'),
+            reason=data.get('reason'),
+            note=data.get('note')
+        )
+    except EntryRejected:
+        await state.clear()
+        text = "Не получилось сохранить запись. Нажми /start и попробуй ещё раз."
+        if edit:
+            await message.edit_text(text)
+        else:
+            await message.answer(text)
+        return
 
     # Build summary
     summary_parts = [f"*{data.get('emotion', '')}*"]
@@ -543,6 +614,11 @@ async def delay_check(callback: CallbackQuery):
 @dp.callback_query(F.data == "skip_today")
 async def skip_today(callback: CallbackQuery):
     await db.skip_today_checks(callback.from_user.id)
+    if SCHEDULE_MODE == "derived":
+        user = await db.get_user(callback.from_user.id)
+        timezone = user.timezone if user else 3
+        local_date = (datetime.utcnow() + timedelta(hours=timezone)).date()
+        await db.add_ping_skip(callback.from_user.id, local_date)
     await callback.message.edit_text(
         "Понятно, сегодня больше не буду беспокоить. До завтра!"
     )
@@ -551,18 +627,18 @@ async def skip_today(callback: CallbackQuery):
 
 # === DIARY ===
 
-@dp.message(Command("diary"))
+@dp.message(Command("diary"), flags={"throttling": "diary"})
 async def cmd_diary(message: Message):
     await show_diary(message.from_user.id, message)
 
 
-@dp.callback_query(F.data == "diary")
+@dp.callback_query(F.data == "diary", flags={"throttling": "diary"})
 async def callback_diary(callback: CallbackQuery):
     await show_diary(callback.from_user.id, callback.message, edit=True)
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("diary_page_"))
+@dp.callback_query(F.data.startswith("diary_page_"), flags={"throttling": "diary"})
 async def diary_page(callback: CallbackQuery):
     page = int(callback.data.split("_")[2])
     await show_diary(callback.from_user.id, callback.message, page=page, edit=True)
@@ -570,6 +646,20 @@ async def diary_page(callback: CallbackQuery):
 
 
 async def show_diary(user_id: int, message: Message, page: int = 0, edit: bool = False):
+    key = (user_id, "diary", page, db.entries_version(user_id))
+    response = response_cache.get(key)
+    if response is None:
+        response = await render_diary(user_id, page)
+        response_cache.put(key, response)
+    text, keyboard = response
+
+    if edit:
+        await message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
+    else:
+        await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+
+
+async def render_diary(user_id: int, page: int) -> Tuple[str, InlineKeyboardMarkup]:
     per_page = 5
     entries = await db.get_entries(user_id, limit=per_page, offset=page * per_page)
     total = await db.get_entries_count(user_id)
@@ -580,12 +670,12 @@ async def show_diary(user_id: int, message: Message, page: int = 0, edit: bool =
     else:
         text = "*Твой дневник:*\n\n"
         for entry in entries:
-            date_str = entry['created_at'].strftime("%d.%m %H:%M")
-            intensity_str = f" ({entry['intensity']}/10)" if entry.get('intensity') is not None else ""
+            date_str = entry.created_at.strftime("%d.%m %H:%M")
+            intensity_str = f" ({entry.intensity}/10)" if entry.intensity is not None else ""
 
-            text += f"*{entry['emotion']}*{intensity_str} — {date_str}\n"
-            if entry.get('reason'):
-                text += f"   _{entry['reason']}_\n"
+            text += f"*{entry.display_emotion}*{intensity_str} — {date_str}\n"
+            if entry.reason:
+                text += f"   _{entry.reason}_\n"
             text += "\n"
 
         # Pagination
@@ -600,46 +690,142 @@ async def show_diary(user_id: int, message: Message, page: int = 0, edit: bool =
         buttons.append([InlineKeyboardButton(text="Меню", callback_data="menu")])
         keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
-    if edit:
-        await message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
-    else:
-        await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+    return text, keyboard
 
 
 # === STATS ===
 
-@dp.message(Command("stats"))
+@dp.message(Command("stats"), flags={"throttling": "stats"})
 async def cmd_stats(message: Message):
     await show_stats(message.from_user.id, message)
 
 
-@dp.callback_query(F.data == "stats")
+@dp.callback_query(F.data == "stats", flags={"throttling": "stats"})
 async def callback_stats(callback: CallbackQuery):
     await show_stats(callback.from_user.id, callback.message, edit=True)
     await callback.answer()
 
 
 async def show_stats(user_id: int, message: Message, edit: bool = False):
+    # The streak depends on today's date as well as on the entries
+    key = (user_id, "stats", datetime.now().date(), db.entries_version(user_id))
+    response = response_cache.get(key)
+    if response is None:
+        response = await render_stats(user_id)
+        response_cache.put(key, response)
+    text, keyboard = response
+
+    if edit:
+        await message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown")
+    else:
+        await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+
+
+async def render_stats(user_id: int) -> Tuple[str, InlineKeyboardMarkup]:
     stats = await db.get_emotion_stats(user_id)
+    insights = await db.get_insights(user_id)
 
-    if stats['total'] == 0:
+    if stats.total == 0:
         text = "Статистика пока пуста.\n\nЗапиши своё первое наблюдение!"
     else:
         text = "*Твоя статистика*\n\n"
-        text += f"Всего записей: {stats['total']}\n"
-        text += f"Streak: {stats['streak']} дней\n"
+        text += f"Всего записей: {stats.total}\n"
+        text += f"Streak: {stats.streak} дней\n"
 
-        if stats.get('avg_intensity'):
-            text += f"Средняя интенсивность: {stats['avg_intensity']}/10\n"
+        if stats.avg_intensity:
+            text += f"Средняя интенсивность: {stats.avg_intensity}/10\n"
 
         text += "\n"
 
-        if stats['top_emotions']:
+        if stats.top_emotions:
             text += "*Частые эмоции:*\n"
-            for i, em in enumerate(stats['top_emotions'], 1):
-                text += f"{i}. {em['emotion']} — {em['count']} раз\n"
+            for i, (emotion, count) in enumerate(stats.top_emotions, 1):
+                text += f"{i}. {emotion} — {count} раз\n"
+
+        if insights:
+            text += "\n*Наблюдения:*\n"
+            for insight in insights:
+                text += f"• {render_insight(insight)}\n"
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="За месяц", callback_data="report_month"),
+         InlineKeyboardButton(text="За год", callback_data="report_year")],
+        [InlineKeyboardButton(text="График", callback_data="chart")],
+        [InlineKeyboardButton(text="Меню", callback_data="menu")]
+    ])
+
+    return text, keyboard
+
+
+# === CHART ===
+
+@dp.message(Command("chart"), flags={"throttling": "chart"})
+async def cmd_chart(message: Message):
+    await send_chart(message.from_user.id, message)
+
+
+@dp.callback_query(F.data == "chart", flags={"throttling": "chart"})
+async def callback_chart(callback: CallbackQuery):
+    await callback.answer()
+    await send_chart(callback.from_user.id, callback.message)
+
+
+async def send_chart(user_id: int, message: Message):
+    user = await db.get_user(user_id)
+    key = chart_service.key(db, user_id)
+    chart = await chart_service.get(db, key, user.timezone if user else 3)
+
+    if chart is None:
+        await message.answer(
+            f"За последние {CHART_DAYS} дней записей нет.\n\nЗапиши своё первое наблюдение!",
+            reply_markup=get_main_menu()
+        )
+    elif isinstance(chart, str):
+        await message.answer_photo(chart)
+    else:
+        sent = await message.answer_photo(BufferedInputFile(chart, filename="chart.png"))
+        chart_service.uploaded(key, sent.photo[-1].file_id)
+
+
+# === MONTH/YEAR REPORTS ===
+
+@dp.message(Command("month"), flags={"throttling": "report"})
+async def cmd_month(message: Message):
+    await show_period_report(message.from_user.id, message, by_month=False)
+
+
+@dp.message(Command("year"), flags={"throttling": "report"})
+async def cmd_year(message: Message):
+    await show_period_report(message.from_user.id, message, by_month=True)
+
+
+@dp.callback_query(F.data.in_({"report_month", "report_year"}), flags={"throttling": "report"})
+async def callback_period_report(callback: CallbackQuery):
+    await show_period_report(
+        callback.from_user.id, callback.message,
+        by_month=callback.data == "report_year", edit=True
+    )
+    await callback.answer()
+
+
+async def show_period_report(user_id: int, message: Message, by_month: bool, edit: bool = False):
+    """Month report (by day) or year report (by month), read from the daily rollup"""
+    user = await db.get_user(user_id)
+    timezone = user.timezone if user else 3
+    today = (datetime.utcnow() + timedelta(hours=timezone)).date()
+
+    if by_month:
+        start, end = year_range(today)
+        title = "Твой год в эмоциях"
+    else:
+        start, end = month_range(today)
+        title = "Твой месяц в эмоциях"
+
+    rows = await db.get_daily_rollup(user_id, start, end)
+    text = render_report(build_report(rows, start, end, by_month=by_month), title, by_month=by_month)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Статистика", callback_data="stats")],
         [InlineKeyboardButton(text="Меню", callback_data="menu")]
     ])
 
@@ -670,9 +856,9 @@ async def show_settings(user_id: int, message: Message, edit: bool = False):
 
     text = (
         "*Настройки*\n\n"
-        f"Часовой пояс: UTC+{user['timezone']}\n"
-        f"Напоминания: с {user['check_start_hour']}:00 до {user['check_end_hour']}:00\n"
-        f"Раз в день: {user['checks_per_day']}\n"
+        f"Часовой пояс: UTC+{user.timezone}\n"
+        f"Напоминания: с {user.check_start_hour}:00 до {user.check_end_hour}:00\n"
+        f"Раз в день: {user.checks_per_day}\n"
     )
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -706,9 +892,9 @@ async def save_new_timezone(callback: CallbackQuery, state: FSMContext):
     await schedule_daily_checks(
         callback.from_user.id,
         timezone,
-        user['check_start_hour'],
-        user['check_end_hour'],
-        user['checks_per_day']
+        user.check_start_hour,
+        user.check_end_hour,
+        user.checks_per_day
     )
 
     await state.clear()
@@ -744,16 +930,16 @@ async def save_frequency(callback: CallbackQuery):
     user = await db.get_user(callback.from_user.id)
     await db.update_user_settings(
         callback.from_user.id,
-        user['check_start_hour'],
-        user['check_end_hour'],
+        user.check_start_hour,
+        user.check_end_hour,
         frequency
     )
 
     await schedule_daily_checks(
         callback.from_user.id,
-        user['timezone'],
-        user['check_start_hour'],
-        user['check_end_hour'],
+        user.timezone,
+        user.check_start_hour,
+        user.check_end_hour,
         frequency
     )
 
@@ -767,6 +953,85 @@ async def save_frequency(callback: CallbackQuery):
     await callback.answer()
 
 
+# === IMPORT ===
+
+@dp.message(Command("import"))
+async def cmd_import(message: Message, state: FSMContext):
+    if not await db.get_user(message.from_user.id):
+        await message.answer("Сначала нажми /start.")
+        return
+    await state.set_state(ImportStates.waiting_for_file)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Отмена", callback_data="menu")]
+    ])
+    await message.answer(
+        "Пришли файл CSV или JSON с записями из другого дневника.\n\n"
+        "Нужны колонки *date* и *emotion* (можно по-русски: *дата*, *эмоция*), "
+        "по желанию — *category*, *intensity* (0–10), *body\\_sensation*, *reason*, *note*.\n"
+        "Дата — например, 2024-05-01 09:30 или 01.05.2024 09:30, по твоему часовому поясу.\n\n"
+        "Повторная загрузка того же файла не создаст дублей.",
+        parse_mode="Markdown",
+        reply_markup=keyboard
+    )
+
+
+@dp.message(ImportStates.waiting_for_file, F.document, flags={"throttling": "import"})
+async def process_import_file(message: Message, state: FSMContext):
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.answer(f"Файл больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ. Раздели его на части.")
+        return
+
+    await state.clear()
+    user_id = message.from_user.id
+    user = await db.get_user(user_id)
+    status = await message.answer("Загружаю записи…")
+    data = (await bot.download(document)).getvalue()
+    result = await import_document(db, user_id, user.timezone if user else 3, data)
+
+    text = f"Импорт завершён.\n\nСтрок в файле: {result.rows}\nДобавлено записей: {result.imported}\n"
+    if result.duplicates:
+        text += f"Уже были в дневнике: {result.duplicates}\n"
+    if result.errors:
+        text += f"С ошибками: {result.errors}\n"
+        for line, error in result.first_errors:
+            text += f"  строка {line}: {error}\n"
+    await status.edit_text(text, reply_markup=get_main_menu())
+
+
+@dp.message(ImportStates.waiting_for_file)
+async def process_import_not_file(message: Message):
+    await message.answer("Жду файл CSV или JSON. Чтобы выйти, нажми /start.")
+
+
+# === ACCOUNT DELETION ===
+
+@dp.message(Command("delete_me"))
+async def cmd_delete_me(message: Message, state: FSMContext):
+    await state.clear()
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Да, удалить всё", callback_data="delete_me_confirm")],
+        [InlineKeyboardButton(text="Отмена", callback_data="menu")]
+    ])
+    await message.answer(
+        "Удалить все твои записи, статистику и настройки?\n\n"
+        "Это нельзя отменить.",
+        reply_markup=keyboard
+    )
+
+
+@dp.callback_query(F.data == "delete_me_confirm")
+async def confirm_delete_me(callback: CallbackQuery, state: FSMContext):
+    await state.clear()
+    await db.request_deletion(callback.from_user.id)
+    ping_index.remove(callback.from_user.id)
+    await callback.message.edit_text(
+        "Напоминания остановлены, данные удалятся в течение нескольких минут.\n\n"
+        "Если передумаешь — нажми /start: пока данные не удалены, удаление отменится."
+    )
+    await callback.answer()
+
+
 # === MENU ===
 
 @dp.callback_query(F.data == "menu")
@@ -790,7 +1055,12 @@ async def cmd_help(message: Message):
         "/check — записать эмоцию\n"
         "/diary — дневник\n"
         "/stats — статистика\n"
-        "/settings — настройки\n\n"
+        "/month — отчёт за месяц\n"
+        "/year — отчёт за год\n"
+        "/chart — график настроения\n"
+        "/import — загрузить записи из файла\n"
+        "/settings — настройки\n"
+        "/delete\\_me — удалить мои данные\n\n"
         "*Как это работает:*\n"
         "Я присылаю мягкие напоминания несколько раз в день. "
         "Ты можешь написать своими словами или выбрать из подсказок. "
@@ -803,13 +1073,12 @@ async def cmd_help(message: Message):
 # === SCHEDULER ===
 
 async def schedule_daily_checks(user_id: int, timezone: int, start_hour: int, end_hour: int, count: int):
-    today = datetime.now().date()
+    if SCHEDULE_MODE == "derived":
+        # Nothing to store: the leader's ping index picks up the new settings
+        return
 
-    total_minutes = (end_hour - start_hour) * 60
-    if total_minutes <= count:
-        random_minutes = list(range(0, total_minutes, max(1, total_minutes // count)))[:count]
-    else:
-        random_minutes = sorted(random.sample(range(total_minutes), count))
+    today = datetime.now().date()
+    random_minutes = pick_check_minutes(random, start_hour, end_hour, count)
 
     check_times = []
     for minutes in random_minutes:
@@ -823,16 +1092,38 @@ async def schedule_daily_checks(user_id: int, timezone: int, start_hour: int, en
     logger.info(f"Scheduled {count} checks for user {user_id}")
 
 
+@leader_only
+async def collect_derived_checks(now: datetime) -> List[int]:
+    """Users whose derived ping time fell into the minutes since the last run"""
+    global last_derived_dispatch
+    await ping_index.refresh(db)
+
+    # Catch up on a few missed minutes at most; older pings are simply dropped
+    after = max(last_derived_dispatch or now - timedelta(minutes=1), now - timedelta(minutes=5))
+    await ping_index.prepare(after, now)
+    # Tomorrow's buckets are built in the background long before UTC midnight
+    ping_index.build_ahead(now.date() + timedelta(days=1))
+    due = ping_index.due(after, now)
+    last_derived_dispatch = now.replace(second=0, microsecond=0)
+
+    skipped = await db.get_skipped_users(due)
+    return [user_id for user_id, _ in due if user_id not in skipped]
+
+
 async def check_and_send_notifications():
     now = datetime.now(tz.utc).replace(tzinfo=None)
 
     # Atomically get and mark pending checks - prevents duplicates even between processes
     user_ids = await db.get_and_mark_pending_checks(now)
 
+    if SCHEDULE_MODE == "derived":
+        user_ids = list(set(user_ids) | set(await collect_derived_checks(now) or []))
+
     if not user_ids:
         return
 
     # Send one message per user
+    batch = LogBatch(logger, "ping")
     for user_id in user_ids:
         try:
             await bot.send_message(
@@ -840,84 +1131,221 @@ async def check_and_send_notifications():
                 "Привет! Как ты сейчас?",
                 reply_markup=get_ping_keyboard()
             )
-            logger.info(f"Sent check to user {user_id}")
+            batch.ok(user_id)
         except Exception as e:
-            logger.error(f"Failed to send check to {user_id}: {e}")
+            batch.failed(user_id, e)
+    batch.flush()
 
 
+@leader_only
 async def regenerate_daily_schedules():
     logger.info("Regenerating daily schedules...")
     users = await db.get_all_users_with_settings()
-    for user in users:
-        await schedule_daily_checks(
-            user['user_id'],
-            user['timezone'],
-            user['check_start_hour'],
-            user['check_end_hour'],
-            user['checks_per_day']
-        )
-    logger.info(f"Regenerated schedules for {len(users)} users")
+    if not users:
+        return
+    # Rows are tuples, so the settings table transposes into columns directly
+    user_id, timezone, start_hour, end_hour, count, _ = zip(*users)
+    user_ids, check_times = generate_bulk_check_times(
+        user_id, timezone, start_hour, end_hour, count, datetime.now().date()
+    )
+    count = await db.replace_pending_checks(
+        list(zip(user_ids.tolist(), check_times.astype("datetime64[us]").tolist()))
+    )
+    logger.info(f"Regenerated schedules for {len(users)} users, {count} checks")
+
+
+@leader_only
+async def cleanup_ping_skips():
+    await db.delete_old_ping_skips(datetime.utcnow().date() - timedelta(days=2))
+
+
+async def replay_spool():
+    """Every process replays its own spool, so this is not leader-only"""
+    await entry_writer.replay()
+
+
+@leader_only
+async def process_deletions():
+    await process_deletion_requests(db)
+
+
+@leader_only
+async def retention_cleanup():
+    await apply_retention(db)
+
+
+@leader_only
+async def refresh_insights():
+    await update_insights(db)
+
 
+@leader_only
+async def update_reason_clusters():
+    for shard in db.shards:
+        await cluster_new_reasons(shard)
 
+
+@leader_only
 async def send_weekly_summary():
     logger.info("Sending weekly summaries...")
+    # Catch up on reasons written since the nightly clustering run
+    for shard in db.shards:
+        await cluster_new_reasons(shard)
     users = await db.get_all_users()
+    batch = LogBatch(logger, "weekly_summary")
     for user in users:
         try:
-            summary = await db.get_weekly_summary(user['user_id'])
-            if summary['total'] > 0:
+            summary = await db.get_weekly_summary(user.user_id)
+            insights = await db.get_insights(user.user_id)
+            if summary.total > 0:
                 text = "*Твоя неделя в эмоциях*\n\n"
-                text += f"Записей: {summary['total']}\n"
-                text += f"Дней с записями: {summary['days_with_entries']}/7\n\n"
+                text += f"Записей: {summary.total}\n"
+                text += f"Дней с записями: {summary.days_with_entries}/7\n\n"
 
-                if summary['top_emotions']:
-                    emotions_list = ", ".join([e['emotion'] for e in summary['top_emotions'][:3]])
+                if summary.top_emotions:
+                    emotions_list = ", ".join([emotion for emotion, _ in summary.top_emotions[:3]])
                     text += f"*Чаще всего:* {emotions_list}\n"
 
-                if summary['top_reasons']:
-                    reasons_list = ", ".join([r['reason'][:30] for r in summary['top_reasons'][:2]])
+                if summary.top_reasons:
+                    reasons_list = ", ".join([reason[:30] for reason, _ in summary.top_reasons[:2]])
                     text += f"*Частые причины:* {reasons_list}\n"
 
-                if summary['peak_time']:
-                    text += f"*Пик записей:* {summary['peak_time']}\n"
+                if summary.peak_time:
+                    text += f"*Пик записей:* {summary.peak_time}\n"
+
+                if summary.avg_intensity:
+                    text += f"*Средняя интенсивность:* {summary.avg_intensity}/10\n"
 
-                if summary['avg_intensity']:
-                    text += f"*Средняя интенсивность:* {summary['avg_intensity']}/10\n"
+                if insights:
+                    text += f"*Наблюдение:* {render_insight(insights[0])}\n"
 
                 text += "\nБереги себя!"
 
-                await bot.send_message(user['user_id'], text, parse_mode="Markdown")
-                logger.info(f"Sent weekly summary to user {user['user_id']}")
+                await bot.send_message(user.user_id, text, parse_mode="Markdown")
+                batch.ok(user.user_id)
         except Exception as e:
-            logger.error(f"Failed to send weekly summary to {user['user_id']}: {e}")
+            batch.failed(user.user_id, e)
+    batch.flush(users=len(users))
+
+
+@leader_only
+async def rebuild_schedules_on_startup():
+    """Only the leader resets schedules, so a restarting replica
+    doesn't wipe the checks the other replicas are about to send"""
+    # Clear any pending checks from previous runs to prevent duplicates
+    cleared = await db.clear_all_pending_checks()
+    if cleared:
+        logger.info(f"Cleared {cleared} pending checks from previous run")
+
+    if SCHEDULE_MODE != "derived":
+        await regenerate_daily_schedules()
+
+    # First deploy with the rollup table: build it from existing entries
+    if await db.rollup_needs_backfill():
+        users = await db.backfill_daily_rollup()
+        logger.info(f"Backfilled daily rollup for {users} users")
 
 
 # === HEALTH CHECK ===
 
+async def health_status() -> dict:
+    result = {"status": "ok", "leader": leader.is_leader}
+    if db.replica_pool:
+        try:
+            result["replica_lag_seconds"] = await asyncio.wait_for(db.replica_lag(), timeout=2)
+            if result["replica_lag_seconds"] is None:
+                result["replica_error"] = "replica lag unknown: not a standby or nothing replayed yet"
+        except Exception as e:
+            result["replica_lag_seconds"] = None
+            result["replica_error"] = str(e) or type(e).__name__
+    return result
+
+
 async def health_check(request):
-    return web.json_response({"status": "ok"})
+    return web.json_response(await health_status())
+
+
+async def metrics_handler(request):
+    return web.json_response(metrics.snapshot())
+
+
+def _debug_allowed(request) -> bool:
+    token = request.headers.get("X-Debug-Token", "")
+    return bool(DEBUG_TOKEN) and hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode())
+
+
+async def debug_slow_handler(request):
+    if not _debug_allowed(request):
+        raise web.HTTPNotFound()
+    return web.json_response(list(slow_updates))
+
+
+async def debug_profile_handler(request):
+    """Sampling profile of the event loop thread in collapsed-stack format"""
+    if not _debug_allowed(request):
+        raise web.HTTPNotFound()
+    try:
+        seconds = min(60.0, max(0.1, float(request.query.get("seconds", "5"))))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds must be a number")
+    loop_thread = threading.get_ident()
+    try:
+        text = await asyncio.to_thread(profile_loop_thread, loop_thread, seconds)
+    except RuntimeError as e:
+        raise web.HTTPConflict(text=str(e))
+    return web.Response(text=text)
 
 
 # === STARTUP/SHUTDOWN ===
 
-async def on_startup(app):
-    """Called when the web server starts"""
+async def start_services(jobs: bool = True):
+    """Connect the database, start the scheduler and set the commands menu.
+    Shared by webhook and polling modes and supervisor workers, where only
+    worker 0 runs the jobs (`jobs`) and the others just replay their spool."""
     await db.connect()
+    for shard in db.shards:
+        instrument_database(shard)
     logger.info("Database connected")
 
-    # Clear any pending checks from previous runs to prevent duplicates
-    cleared = await db.clear_all_pending_checks()
-    if cleared:
-        logger.info(f"Cleared {cleared} pending checks from previous run")
+    scheduler.add_job(
+        replay_spool, "interval", seconds=30,
+        id="replay_spool", replace_existing=True, max_instances=1
+    )
+    if not jobs:
+        scheduler.start()
+        chart_service.start()
+        return
 
     # Setup scheduler
     scheduler.add_job(
         check_and_send_notifications, "cron", minute="*",
         id="check_notifications", replace_existing=True, max_instances=1
     )
+    if SCHEDULE_MODE == "derived":
+        scheduler.add_job(
+            cleanup_ping_skips, "cron", hour=0, minute=30,
+            id="cleanup_ping_skips", replace_existing=True, max_instances=1
+        )
+    else:
+        scheduler.add_job(
+            regenerate_daily_schedules, "cron", hour=0, minute=0,
+            id="daily_schedules", replace_existing=True, max_instances=1
+        )
+    scheduler.add_job(
+        process_deletions, "interval", minutes=1,
+        id="process_deletions", replace_existing=True, max_instances=1
+    )
     scheduler.add_job(
-        regenerate_daily_schedules, "cron", hour=0, minute=0,
-        id="daily_schedules", replace_existing=True, max_instances=1
+        retention_cleanup, "cron", hour=4, minute=0,
+        id="retention", replace_existing=True, max_instances=1
+    )
+    scheduler.add_job(
+        update_reason_clusters, "cron", hour=3, minute=0,
+        id="reason_clusters", replace_existing=True, max_instances=1
+    )
+    scheduler.add_job(
+        refresh_insights, "cron", hour=3, minute=30,
+        id="insights", replace_existing=True, max_instances=1
     )
     scheduler.add_job(
         send_weekly_summary, "cron", day_of_week="sun", hour=20, minute=0,
@@ -926,7 +1354,8 @@ async def on_startup(app):
     scheduler.start()
     logger.info("Scheduler started")
 
-    await regenerate_daily_schedules()
+    await rebuild_schedules_on_startup()
+    chart_service.start()
 
     # Set bot commands menu
     commands = [
@@ -934,40 +1363,70 @@ async def on_startup(app):
         BotCommand(command="check", description="Записать эмоцию"),
         BotCommand(command="diary", description="Мой дневник"),
         BotCommand(command="stats", description="Статистика"),
+        BotCommand(command="month", description="Отчёт за месяц"),
+        BotCommand(command="year", description="Отчёт за год"),
+        BotCommand(command="chart", description="График настроения"),
+        BotCommand(command="import", description="Загрузить записи из файла"),
         BotCommand(command="settings", description="Настройки"),
+        BotCommand(command="delete_me", description="Удалить мои данные"),
     ]
-    await bot.set_my_commands(commands)
-    logger.info("Bot commands menu set")
+    try:
+        await bot.set_my_commands(commands)
+        logger.info("Bot commands menu set")
+    except Exception as e:
+        # Only the menu is missing; failing here would make a supervisor worker restart forever
+        logger.error(f"Failed to set bot commands menu: {e}")
+
+
+async def stop_services():
+    chart_service.shutdown()
+    await leader.release()
+    await db.disconnect()
+    scheduler.shutdown()
+    await bot.session.close()
+
+
+async def on_startup(app):
+    """Called when the web server starts"""
+    await start_services()
 
     # Set webhook
     if WEBHOOK_URL:
         await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
         logger.info(f"Webhook set to {WEBHOOK_URL}")
     else:
-        logger.warning("WEBHOOK_URL not set - bot will not receive updates!")
+        logger.warning("WEBHOOK_URL not set - bot will not receive updates! Use BOT_MODE=polling for local runs")
 
 
 async def on_shutdown(app):
     """Called when the web server stops"""
     logger.info("Shutting down...")
     await bot.delete_webhook()
-    await db.disconnect()
-    scheduler.shutdown()
-    await bot.session.close()
+    await stop_services()
 
 
 # === MAIN ===
 
-def main():
-    # Create aiohttp app
+def create_app() -> web.Application:
+    """Build the aiohttp app with health checks and the webhook handler"""
     app = web.Application()
 
     # Health check endpoints
     app.router.add_get("/", health_check)
     app.router.add_get("/health", health_check)
-
-    # Setup webhook handler
-    webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/debug/slow", debug_slow_handler)
+    app.router.add_get("/debug/profile", debug_profile_handler)
+    setup_api(app)
+
+    # Setup webhook handler: either ack immediately and queue, or aiogram's default
+    if UPDATE_QUEUE_WORKERS > 0:
+        update_queue = UpdateQueue(dp, bot, workers=UPDATE_QUEUE_WORKERS, maxsize=UPDATE_QUEUE_SIZE)
+        webhook_handler = QueuedRequestHandler(
+            dispatcher=dp, bot=bot, queue=update_queue, put_timeout=UPDATE_QUEUE_PUT_TIMEOUT
+        )
+    else:
+        webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
     webhook_handler.register(app, path=WEBHOOK_PATH)
 
     # Setup aiogram integration
@@ -977,6 +1436,169 @@ def main():
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
 
+    return app
+
+
+async def run_polling(port: int = 8080):
+    """Long-polling mode for local and staging runs without a public URL.
+    Health checks and /metrics are still served on `port`."""
+    health_app = web.Application()
+    health_app.router.add_get("/", health_check)
+    health_app.router.add_get("/health", health_check)
+    health_app.router.add_get("/metrics", metrics_handler)
+    health_app.router.add_get("/debug/slow", debug_slow_handler)
+    health_app.router.add_get("/debug/profile", debug_profile_handler)
+    setup_api(health_app)
+    runner = web.AppRunner(health_app)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=port).start()
+
+    await start_services()
+    # getUpdates is rejected while a webhook is set
+    await bot.delete_webhook()
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+
+    update_queue = UpdateQueue(dp, bot, workers=POLLING_WORKERS, maxsize=UPDATE_QUEUE_SIZE)
+    await update_queue.start()
+    logger.info(f"Polling started (limit={POLLING_LIMIT}, timeout={POLLING_TIMEOUT}s)")
+    try:
+        await poll_updates(
+            bot, update_queue,
+            limit=POLLING_LIMIT,
+            timeout=POLLING_TIMEOUT,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    finally:
+        logger.info("Shutting down...")
+        await update_queue.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await stop_services()
+        await runner.cleanup()
+
+
+# === SUPERVISOR MODE ===
+
+def run_worker(index: int, socket_path: str):
+    """Entry point of worker process `index` when BOT_WORKERS > 1"""
+    # Own process group: Ctrl+C goes to the front only, which stops workers with
+    # SIGTERM, and a worker that hangs is killed together with its chart processes
+    os.setpgrp()
+    asyncio.run(serve_updates(index, socket_path))
+
+
+async def serve_updates(index: int, socket_path: str):
+    """Process the updates the front forwards to this worker until SIGTERM"""
+    # Every worker needs its own spool file; worker 0 keeps the usual one
+    if index:
+        entry_writer.spool = EntrySpool(f"{ENTRY_SPOOL_PATH}.{index}")
+    await start_services(jobs=index == 0)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+
+    # The front only waits until an update is queued, so workers always use a queue
+    update_queue = UpdateQueue(dp, bot, workers=UPDATE_QUEUE_WORKERS or POLLING_WORKERS, maxsize=UPDATE_QUEUE_SIZE)
+    await update_queue.start()
+
+    async def on_update(payload: bytes) -> bool:
+        update = Update.model_validate_json(payload, context={"bot": bot})
+        return await update_queue.put(update, timeout=UPDATE_QUEUE_PUT_TIMEOUT)
+
+    async def on_stats() -> dict:
+        return {"health": await health_status(), "metrics": metrics.snapshot()}
+
+    server = await serve_worker(socket_path, on_update, on_stats)
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    logger.info(f"Worker {index} ready")
+    try:
+        # A front that was killed cannot send SIGTERM; notice that we were reparented
+        front = os.getppid()
+        while os.getppid() == front:
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=1)
+                break
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        logger.info(f"Worker {index} shutting down...")
+        server.close()
+        await update_queue.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await stop_services()
+
+
+def create_front_app(supervisor: Supervisor) -> web.Application:
+    """The front process: webhook, health checks, /metrics and the Web App API, no handlers"""
+
+    async def webhook(request):
+        body = await request.read()
+        try:
+            chat_id = raw_chat_id(json.loads(body))
+        except (ValueError, AttributeError):
+            return web.Response(text="Bad update", status=400)
+        if not await supervisor.forward(chat_id, body):
+            return web.Response(text="Worker unavailable", status=503)
+        return web.json_response({})
+
+    async def health(request):
+        stats = await supervisor.stats()
+        workers = [{"alive": alive, **(worker["health"] if worker else {})}
+                   for alive, worker in zip(supervisor.alive(), stats)]
+        status = "ok" if all(worker is not None for worker in stats) else "degraded"
+        return web.json_response({"status": status, "workers": workers})
+
+    async def metrics_all(request):
+        stats = await supervisor.stats()
+        return web.json_response({
+            "front": metrics.snapshot(),
+            "workers": [worker["metrics"] if worker else None for worker in stats],
+        })
+
+    async def on_startup(app):
+        await supervisor.start()
+        # Web App API requests are read-only and served here, with a pool of our own
+        await db.connect()
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
+            logger.info(f"Webhook set to {WEBHOOK_URL}")
+        else:
+            logger.warning("WEBHOOK_URL not set - bot will not receive updates! Use BOT_MODE=polling for local runs")
+
+    async def on_shutdown(app):
+        logger.info("Shutting down...")
+        await bot.delete_webhook()
+        await supervisor.stop()
+        await db.disconnect()
+        await bot.session.close()
+
+    app = web.Application()
+    app.router.add_get("/", health)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics_all)
+    app.router.add_post(WEBHOOK_PATH, webhook)
+    setup_api(app)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def main():
+    if BOT_MODE == "polling":
+        if BOT_WORKERS > 1:
+            logger.warning("BOT_WORKERS applies to webhook mode only, polling runs in one process")
+        logger.info("Starting bot with long polling...")
+        try:
+            asyncio.run(run_polling())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if BOT_WORKERS > 1:
+        logger.info(f"Starting bot with webhook and {BOT_WORKERS} worker processes...")
+        web.run_app(create_front_app(Supervisor(run_worker, BOT_WORKERS)), host="0.0.0.0", port=8080)
+        return
+
+    app = create_app()
+
     # Run on port 8080 (Render expects this)
     logger.info("Starting bot with webhook...")
     web.run_app(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,148 @@
+"""PNG charts for /chart, rendered off the event loop.
+
+render_chart() is a plain function of arrays that runs in a
+ProcessPoolExecutor, so matplotlib never holds the GIL of the process that
+serves the webhook. ChartService fetches the input with one columnar query
+(Database.get_chart_data) and caches the result under
+(user_id, today, entries_version): first the PNG bytes, then, once Telegram
+has the photo, only its file_id, which is resent without uploading again.
+"""
+import asyncio
+import io
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Hashable, List, Optional, Union
+
+from config import CHART_CACHE_BYTES, CHART_DAYS, CHART_WORKERS, RESPONSE_CACHE_TTL
+from metrics import metrics
+from response_cache import ResponseCache
+
+
+def render_chart(times: List[float], intensities: List[int], categories: List[str],
+                 category_counts: List[int], timezone: int, days: int) -> bytes:
+    """Intensity over time and the category distribution as one PNG"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    fig, (timeline, distribution) = plt.subplots(
+        2, 1, figsize=(8, 7), gridspec_kw={"height_ratios": [3, 2]}, constrained_layout=True
+    )
+
+    if times:
+        local = (np.asarray(times, dtype=np.float64) + timezone * 3600).astype("datetime64[s]")
+        values = np.asarray(intensities, dtype=np.float64)
+        timeline.scatter(local, values, s=14, alpha=0.5, color="#7b8fd6")
+        # Daily mean on top of the individual entries
+        day = local.astype("datetime64[D]")
+        days_seen, index = np.unique(day, return_inverse=True)
+        means = np.bincount(index, weights=values) / np.bincount(index)
+        timeline.plot(days_seen + np.timedelta64(12, "h"), means, color="#3a4fa8", linewidth=2)
+        timeline.xaxis.set_major_formatter(mdates.DateFormatter("%d.%m"))
+    else:
+        timeline.text(0.5, 0.5, "Нет записей с интенсивностью", ha="center", va="center",
+                      transform=timeline.transAxes, color="gray")
+    timeline.set_ylim(0, 10.5)
+    timeline.set_title(f"Интенсивность за {days} дней")
+    timeline.grid(alpha=0.3)
+
+    # Category keys start with an emoji the default font cannot draw
+    labels = [category.split(" ", 1)[-1] if category else "Своими словами" for category in categories]
+    positions = np.arange(len(labels))
+    distribution.barh(positions, category_counts, color="#9ccfa8")
+    distribution.set_yticks(positions, labels)
+    distribution.invert_yaxis()
+    distribution.set_title("Категории")
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=100)
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+def _warm_up():
+    # Importing pyplot and loading fonts take seconds; pay them when the worker starts
+    render_chart([], [], [""], [1], 0, 1)
+
+
+class ChartService:
+    def __init__(self, workers: int = CHART_WORKERS, days: int = CHART_DAYS):
+        self.workers = workers
+        self.days = days
+        self.executor: Optional[ProcessPoolExecutor] = None
+        # Values are PNG bytes until the first upload, then the Telegram file_id
+        self.cache = ResponseCache(CHART_CACHE_BYTES, RESPONSE_CACHE_TTL, name="chart_cache", sizeof=len)
+        self.in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # spawn: forking a process with running threads (logging, profiler) is unsafe.
+            # Workers re-import the main module without running it, like any spawn child
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_warm_up
+            )
+        return self.executor
+
+    def start(self):
+        """Start the workers in the background so the first /chart does not wait for them"""
+        executor = self._executor()
+        for _ in range(self.workers):
+            executor.submit(int)
+
+    def key(self, db, user_id: int) -> Hashable:
+        # The window ends today, so the date is part of the data version
+        return user_id, datetime.now().date(), db.entries_version(user_id)
+
+    async def get(self, db, key: Hashable, timezone: int) -> Optional[Union[bytes, str]]:
+        """Cached file_id or PNG bytes for a key(); None if there is nothing to draw"""
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        # Concurrent requests for the same chart share one render
+        pending = self.in_flight.get(key)
+        if pending is not None:
+            return await pending
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            png = await self._render(db, key[0], timezone)
+            if png is not None:
+                self.cache.put(key, png)
+            future.set_result(png)
+            return png
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters got the error; keep it from being reported as never retrieved
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+
+    async def _render(self, db, user_id: int, timezone: int) -> Optional[bytes]:
+        data = await db.get_chart_data(user_id, datetime.now() - timedelta(days=self.days))
+        if not data.categories:
+            return None
+        started = time.perf_counter()
+        png = await asyncio.get_running_loop().run_in_executor(
+            self._executor(), render_chart, *data, timezone, self.days
+        )
+        metrics.observe("chart.render", time.perf_counter() - started)
+        return png
+
+    def uploaded(self, key: Hashable, file_id: str):
+        """Swap the cached PNG for the file_id Telegram assigned to it"""
+        self.cache.put(key, file_id)
+        metrics.inc("chart.uploads")
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+chart_service = ChartService()
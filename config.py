@@ -5,9 +5,104 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Optional sharding: comma-separated DSNs, users are spread over them by a hash of
+# user_id and DATABASE_URL is ignored. Change the list only with rebalance.py
+DATABASE_SHARD_URLS = [url.strip() for url in os.getenv("DATABASE_SHARD_URLS", "").split(",") if url.strip()]
+# Optional streaming replica for diary/stats/summary reads (unsharded setup only)
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+# A user who just wrote reads from the primary for this many seconds
+REPLICA_READ_YOUR_WRITES = float(os.getenv("REPLICA_READ_YOUR_WRITES", "10"))
+# Entries are spooled to this local file while the database is down or slow
+ENTRY_SPOOL_PATH = os.getenv("ENTRY_SPOOL_PATH", "entry_spool.bin")
+DB_SAVE_TIMEOUT = float(os.getenv("DB_SAVE_TIMEOUT", "2.0"))  # seconds before an entry is spooled
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "3"))  # consecutive failures that open the breaker
+DB_BREAKER_RESET = float(os.getenv("DB_BREAKER_RESET", "30"))  # seconds between trial calls while open
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()]
 
 # Webhook URL - your Render URL
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "")  # e.g. https://emotion-diary-bot.onrender.com
 WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
 WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}" if WEBHOOK_HOST else ""
+
+# Bot API client: connection pool, keep-alive and DNS cache for outgoing bursts
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "200"))  # simultaneous connections
+TELEGRAM_KEEPALIVE = float(os.getenv("TELEGRAM_KEEPALIVE", "60"))  # seconds an idle connection is kept
+TELEGRAM_DNS_TTL = int(os.getenv("TELEGRAM_DNS_TTL", "3600"))  # seconds
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "60"))  # request timeout, seconds
+# Self-hosted telegram-bot-api server, e.g. http://localhost:8081; empty = api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+TELEGRAM_API_LOCAL = os.getenv("TELEGRAM_API_LOCAL", "false").lower() in ("1", "true", "yes")  # server runs with --local
+
+# "webhook" (default, needs WEBHOOK_HOST) or "polling" for local/staging runs
+BOT_MODE = os.getenv("BOT_MODE", "webhook").lower()
+POLLING_LIMIT = int(os.getenv("POLLING_LIMIT", "100"))  # updates per getUpdates call
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))  # long-poll seconds
+POLLING_WORKERS = int(os.getenv("POLLING_WORKERS", "8"))
+# Webhook mode with more than 1: a front process routes updates by chat_id to this many worker processes
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+
+# Cron jobs (daily schedules, weekly summary) run only on the replica holding this advisory lock
+LEADER_ELECTION = os.getenv("LEADER_ELECTION", "true").lower() in ("1", "true", "yes")
+LEADER_LOCK_KEY = int(os.getenv("LEADER_LOCK_KEY", "727134021"))
+
+# "stored": random ping times are generated nightly and stored in scheduled_checks
+# "derived": ping times are derived from (user_id, local date, settings version), nothing is stored
+SCHEDULE_MODE = os.getenv("SCHEDULE_MODE", "stored").lower()
+
+# Per-user anti-flood: token bucket of THROTTLE_BURST tokens refilled at THROTTLE_RATE per second.
+# Handlers cost 1 token unless tagged with a cost class listed in THROTTLE_COSTS
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1.0"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "10"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "10000"))  # buckets kept in the LRU map
+THROTTLE_COSTS = {
+    name.strip(): float(cost)
+    for name, _, cost in (item.partition("=") for item in os.getenv("THROTTLE_COSTS", "stats=5,report=3,diary=2,chart=10,import=10").split(","))
+    if name.strip()
+}
+
+# Webhook ingestion queue: 0 workers = process updates with aiogram's default handler
+UPDATE_QUEUE_WORKERS = int(os.getenv("UPDATE_QUEUE_WORKERS", "0"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "100"))  # per worker
+UPDATE_QUEUE_PUT_TIMEOUT = float(os.getenv("UPDATE_QUEUE_PUT_TIMEOUT", "1.0"))  # seconds before answering 503
+
+# Updates slower than this are logged with their span breakdown
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1000"))
+# /debug/* endpoints require this value in the X-Debug-Token header; empty = disabled
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+
+# Logging goes through a queue to a background thread; "json" or "text" lines
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # records dropped beyond this
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))  # 1-in-N per-user DEBUG lines in batches
+
+# Rendered stats/diary screens, bounded by total size; TTL covers writes made on other replicas
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(8 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+
+# Account deletion and retention run in short batches with pauses in between
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "1000"))
+DELETE_BATCH_PAUSE = float(os.getenv("DELETE_BATCH_PAUSE", "0.2"))  # seconds
+RETENTION_ENTRIES_DAYS = int(os.getenv("RETENTION_ENTRIES_DAYS", "0"))  # 0 keeps entries forever
+RETENTION_CHECKS_DAYS = int(os.getenv("RETENTION_CHECKS_DAYS", "30"))  # sent scheduled checks
+
+# /chart rendering: worker processes, days shown and cache size for PNGs and file_ids
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "2"))
+CHART_DAYS = int(os.getenv("CHART_DAYS", "30"))
+CHART_CACHE_BYTES = int(os.getenv("CHART_CACHE_BYTES", str(16 * 1024 * 1024)))
+
+# /import: largest accepted file (Telegram bots can download up to 20 MB), rows per file and rows per COPY batch
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(20 * 1024 * 1024)))
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "200000"))
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", "5000"))
+
+# Nightly insights: worker processes, window in days, users per batch and significance thresholds
+INSIGHTS_WORKERS = int(os.getenv("INSIGHTS_WORKERS", "2"))
+INSIGHTS_DAYS = int(os.getenv("INSIGHTS_DAYS", "90"))
+INSIGHTS_BATCH_USERS = int(os.getenv("INSIGHTS_BATCH_USERS", "500"))
+INSIGHTS_MIN_SUPPORT = int(os.getenv("INSIGHTS_MIN_SUPPORT", "3"))  # entries behind an insight
+INSIGHTS_MIN_LIFT = float(os.getenv("INSIGHTS_MIN_LIFT", "1.5"))  # vs. the user's own baseline
+
+# Web App API (/api/entries, /api/stats): how long an initData signature is accepted and the default page size
+WEBAPP_AUTH_MAX_AGE = int(os.getenv("WEBAPP_AUTH_MAX_AGE", str(24 * 3600)))  # seconds
+API_PAGE_SIZE = int(os.getenv("API_PAGE_SIZE", "50"))
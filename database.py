@@ -1,25 +1,123 @@
+import json
+import logging
+import time
 import asyncpg
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional
-from config import DATABASE_URL
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, List, Dict, Optional, Set, Tuple
+from config import DATABASE_URL, DATABASE_REPLICA_URL, DATABASE_SHARD_URLS, REPLICA_READ_YOUR_WRITES
+from metrics import metrics
+from models import ChartData, Entry, EntryColumns, Insight, ScheduleSettings, StatsSummary, User, WeeklySummary, columns
+from normalization import normalize_emotion
+
+logger = logging.getLogger(__name__)
+
+# Advisory lock held while creating and migrating tables
+SCHEMA_LOCK_KEY = 727134022
+
+# Tables holding a user's data with their primary keys, in deletion order:
+# everything that references users(user_id) goes before the users row
+USER_DATA_TABLES = [
+    ("scheduled_checks", "id"),
+    ("ping_skips", "user_id, local_date"),
+    ("daily_emotion_rollup", "user_id, local_date, category, emotion"),
+    ("entries", "id"),
+    ("reason_clusters", "id"),
+    ("user_insights", "user_id"),
+    ("users", "user_id"),
+]
 
 
 class Database:
-    def __init__(self):
+    def __init__(self, dsn: str = DATABASE_URL, replica_dsn: Optional[str] = DATABASE_REPLICA_URL):
+        self.dsn = dsn
+        self.replica_dsn = replica_dsn
         self.pool: Optional[asyncpg.Pool] = None
+        self.replica_pool: Optional[asyncpg.Pool] = None
+        # user_id -> monotonic time of the user's last write
+        self._recent_writes: Dict[int, float] = {}
+        # user_id -> counter bumped on every write, part of response cache keys
+        self._versions: Dict[int, int] = {}
 
     async def connect(self):
         self.pool = await asyncpg.create_pool(
-            DATABASE_URL,
+            self.dsn,
             min_size=1,
             max_size=5  # Ограничиваем количество подключений для бесплатного Supabase
         )
-        await self._create_tables()
+        # Processes starting together (supervisor workers, replicas) would race
+        # on CREATE TABLE IF NOT EXISTS, so they migrate one at a time
+        async with self.pool.acquire() as conn:
+            await conn.execute("SELECT pg_advisory_lock($1)", SCHEMA_LOCK_KEY)
+            try:
+                await self._create_tables()
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", SCHEMA_LOCK_KEY)
+
+        if self.replica_dsn:
+            try:
+                self.replica_pool = await asyncpg.create_pool(self.replica_dsn, min_size=1, max_size=5)
+                logger.info("Connected to the read replica")
+            except Exception as e:
+                # Reads simply stay on the primary
+                logger.error(f"Read replica unavailable, using the primary only: {e}")
+
+    @property
+    def shards(self) -> List["Database"]:
+        """Databases to walk for jobs that page by table ids (see sharding.py)"""
+        return [self]
 
     async def disconnect(self):
+        if self.replica_pool:
+            await self.replica_pool.close()
         if self.pool:
             await self.pool.close()
 
+    # === Read routing ===
+
+    def entries_version(self, user_id: int) -> int:
+        return self._versions.get(user_id, 0)
+
+    def _mark_write(self, user_id: int):
+        """Bump the user's version and pin their reads to the primary
+        for the read-your-writes window"""
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        if not self.replica_pool:
+            return
+        now = time.monotonic()
+        self._recent_writes[user_id] = now
+        if len(self._recent_writes) > 10_000:
+            expired = now - REPLICA_READ_YOUR_WRITES
+            self._recent_writes = {u: t for u, t in self._recent_writes.items() if t > expired}
+
+    def _read_pool(self, user_id: int) -> asyncpg.Pool:
+        """Replica for read-only per-user queries, unless the user wrote recently"""
+        if self.replica_pool:
+            written = self._recent_writes.get(user_id)
+            if written is None or time.monotonic() - written > REPLICA_READ_YOUR_WRITES:
+                metrics.inc("db_reads_replica")
+                return self.replica_pool
+        metrics.inc("db_reads_primary")
+        return self.pool
+
+    async def replica_lag(self) -> Optional[float]:
+        """Seconds since the replica replayed its last transaction, None without a replica
+        or when it has nothing replayed to measure (not a standby, or nothing replayed yet).
+        Includes idle time: on a quiet primary the value grows although nothing is missing."""
+        if not self.replica_pool:
+            return None
+        async with self.replica_pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT pg_is_in_recovery() AS standby, "
+                "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) AS lag"
+            )
+        if row["lag"] is None:
+            if row["standby"]:
+                logger.warning("Replica has not replayed any transaction yet, lag unknown")
+            else:
+                logger.warning("DATABASE_REPLICA_URL points at a server that is not a standby")
+            return None
+        return round(float(row["lag"]), 3)
+
     async def _create_tables(self):
         async with self.pool.acquire() as conn:
             await conn.execute("""
@@ -64,35 +162,136 @@ class Database:
                 await conn.execute("ALTER TABLE entries ADD COLUMN IF NOT EXISTS note TEXT")
                 await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS onboarding_complete BOOLEAN DEFAULT FALSE")
                 await conn.execute("ALTER TABLE entries ALTER COLUMN category DROP NOT NULL")
+                await conn.execute("ALTER TABLE entries ADD COLUMN IF NOT EXISTS emotion_raw TEXT")
+                await conn.execute("ALTER TABLE entries ADD COLUMN IF NOT EXISTS reason_cluster_id INTEGER")
+                await conn.execute("ALTER TABLE entries ADD COLUMN IF NOT EXISTS reason_signature INTEGER[]")
+                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS settings_version INTEGER DEFAULT 0")
+                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS settings_updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+                await conn.execute("ALTER TABLE entries ADD COLUMN IF NOT EXISTS idempotency_key TEXT")
+                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_entry_id BIGINT")
             except Exception:
                 pass
 
+            # Entries saved through the spool carry a key so a replay never duplicates them
+            await conn.execute(
+                """CREATE UNIQUE INDEX IF NOT EXISTS idx_entries_idempotency_key
+                   ON entries (idempotency_key) WHERE idempotency_key IS NOT NULL"""
+            )
+
+            # Days on which the user asked not to be pinged (derived schedule mode)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS ping_skips (
+                    user_id BIGINT REFERENCES users(user_id),
+                    local_date DATE NOT NULL,
+                    PRIMARY KEY (user_id, local_date)
+                )
+            """)
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_users_settings_updated_at ON users (settings_updated_at)"
+            )
+
+            # Per-user daily aggregates for /month and /year reports.
+            # category is '' for free-text entries so it can be part of the key
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS daily_emotion_rollup (
+                    user_id BIGINT REFERENCES users(user_id),
+                    local_date DATE NOT NULL,
+                    category TEXT NOT NULL DEFAULT '',
+                    emotion TEXT NOT NULL,
+                    entries_count INTEGER NOT NULL DEFAULT 0,
+                    intensity_sum INTEGER NOT NULL DEFAULT 0,
+                    intensity_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, local_date, category, emotion)
+                )
+            """)
+            # Rollup retention deletes by date across all users
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_rollup_local_date ON daily_emotion_rollup (local_date)"
+            )
+
+            # Per-user clusters of similar reasons (see reason_clusters.py)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS reason_clusters (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT REFERENCES users(user_id),
+                    label TEXT NOT NULL,
+                    signature INTEGER[] NOT NULL,
+                    entries_count INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_reason_clusters_user ON reason_clusters (user_id)"
+            )
+            # Entries of a cluster, for pruning clusters after entries retention
+            await conn.execute(
+                """CREATE INDEX IF NOT EXISTS idx_entries_reason_cluster ON entries (reason_cluster_id)
+                   WHERE reason_cluster_id IS NOT NULL"""
+            )
+            await conn.execute(
+                """CREATE INDEX IF NOT EXISTS idx_entries_unclustered ON entries (id)
+                   WHERE reason_cluster_id IS NULL AND reason IS NOT NULL"""
+            )
+
+            # Per-user batches in PK order, and FK checks when a users row is deleted
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_user ON entries (user_id, id)")
+            # Diary pages newest first (keyset cursors of the Web App API)
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_entries_user_created ON entries (user_id, created_at, id)"
+            )
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_scheduled_checks_user ON scheduled_checks (user_id, id)"
+            )
+
+            # Precomputed insights (see insights.py), a JSON list per user
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_insights (
+                    user_id BIGINT PRIMARY KEY REFERENCES users(user_id),
+                    insights JSONB NOT NULL,
+                    computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # /delete_me requests, carried out in batches by a background job
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS deletion_requests (
+                    user_id BIGINT PRIMARY KEY,
+                    requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    checks_per_day INTEGER
+                )
+            """)
+            # Pings per day before the request, restored if /start cancels it
+            await conn.execute("ALTER TABLE deletion_requests ADD COLUMN IF NOT EXISTS checks_per_day INTEGER")
+
     # === Users ===
 
     async def add_user(self, user_id: int, timezone: int = 3) -> bool:
         async with self.pool.acquire() as conn:
             try:
                 await conn.execute(
-                    """INSERT INTO users (user_id, timezone) VALUES ($1, $2)
+                    """INSERT INTO users (user_id, timezone, settings_updated_at) VALUES ($1, $2, $3)
                        ON CONFLICT (user_id) DO NOTHING""",
-                    user_id, timezone
+                    user_id, timezone, datetime.utcnow()
                 )
                 return True
             except Exception:
                 return False
 
-    async def get_user(self, user_id: int) -> Optional[Dict]:
+    async def get_user(self, user_id: int) -> Optional[User]:
         async with self.pool.acquire() as conn:
             row = await conn.fetchrow(
-                "SELECT * FROM users WHERE user_id = $1", user_id
+                f"SELECT {columns(User)} FROM users WHERE user_id = $1", user_id
             )
-            return dict(row) if row else None
+            return User._make(row) if row else None
 
     async def update_user_timezone(self, user_id: int, timezone: int):
+        self._mark_write(user_id)
         async with self.pool.acquire() as conn:
             await conn.execute(
-                "UPDATE users SET timezone = $1 WHERE user_id = $2",
-                timezone, user_id
+                """UPDATE users SET timezone = $1,
+                       settings_version = settings_version + 1, settings_updated_at = $3
+                   WHERE user_id = $2""",
+                timezone, user_id, datetime.utcnow()
             )
 
     async def complete_onboarding(self, user_id: int):
@@ -103,24 +302,36 @@ class Database:
             )
 
     async def update_user_settings(self, user_id: int, start_hour: int, end_hour: int, checks_per_day: int):
+        self._mark_write(user_id)
         async with self.pool.acquire() as conn:
             await conn.execute(
-                """UPDATE users SET check_start_hour = $1, check_end_hour = $2, checks_per_day = $3
+                """UPDATE users SET check_start_hour = $1, check_end_hour = $2, checks_per_day = $3,
+                       settings_version = settings_version + 1, settings_updated_at = $5
                    WHERE user_id = $4""",
-                start_hour, end_hour, checks_per_day, user_id
+                start_hour, end_hour, checks_per_day, user_id, datetime.utcnow()
             )
 
-    async def get_all_users(self) -> List[Dict]:
+    async def get_all_users(self) -> List[User]:
+        """All users except those waiting for deletion"""
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch("SELECT * FROM users")
-            return [dict(row) for row in rows]
+            rows = await conn.fetch(
+                f"""SELECT {columns(User)} FROM users u
+                    WHERE NOT EXISTS (SELECT 1 FROM deletion_requests d WHERE d.user_id = u.user_id)"""
+            )
+            return [User._make(row) for row in rows]
 
-    async def get_all_users_with_settings(self) -> List[Dict]:
+    async def get_all_users_with_settings(self) -> List[ScheduleSettings]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(f"SELECT {columns(ScheduleSettings)} FROM users")
+            return [ScheduleSettings._make(row) for row in rows]
+
+    async def get_users_with_settings_changed_since(self, since: datetime) -> List[ScheduleSettings]:
         async with self.pool.acquire() as conn:
             rows = await conn.fetch(
-                "SELECT user_id, timezone, check_start_hour, check_end_hour, checks_per_day FROM users"
+                f"SELECT {columns(ScheduleSettings)} FROM users WHERE settings_updated_at >= $1",
+                since
             )
-            return [dict(row) for row in rows]
+            return [ScheduleSettings._make(row) for row in rows]
 
     # === Entries ===
 
@@ -132,35 +343,243 @@ class Database:
         intensity: int = None,
         body_sensation: str = None,
         reason: str = None,
-        note: str = None
+        note: str = None,
+        created_at: datetime = None,
+        idempotency_key: str = None
     ):
+        created_at = created_at or datetime.now()
+        emotion, category, emotion_raw = normalize_emotion(emotion, category)
         async with self.pool.acquire() as conn:
-            await conn.execute(
-                """INSERT INTO entries (user_id, category, emotion, intensity, body_sensation, reason, note, created_at)
-                   VALUES ($1, $2, $3, $4, $5, $6, $7, $8)""",
-                user_id, category, emotion, intensity, body_sensation, reason, note, datetime.now()
+            async with conn.transaction():
+                inserted = await conn.fetchval(
+                    """INSERT INTO entries (user_id, category, emotion, emotion_raw, intensity, body_sensation,
+                                            reason, note, created_at, idempotency_key)
+                       VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                       ON CONFLICT (idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+                       RETURNING id""",
+                    user_id, category, emotion, emotion_raw, intensity, body_sensation, reason, note, created_at,
+                    idempotency_key
+                )
+                if inserted:
+                    await self._add_to_rollup(conn, user_id, created_at, category, emotion, intensity)
+                    await conn.execute("UPDATE users SET last_entry_id = $2 WHERE user_id = $1", user_id, inserted)
+        self._mark_write(user_id)
+
+    async def save_entries_bulk(self, entries: List[Dict]) -> int:
+        """Insert spooled entries (save_entry keyword dicts with created_at and
+        idempotency_key) in one transaction and update the rollup for them.
+        Entries already in the table or of deleted users are skipped.
+        Returns the number inserted."""
+        rows = []
+        for entry in entries:
+            emotion, category, emotion_raw = normalize_emotion(entry['emotion'], entry.get('category'))
+            rows.append((
+                entry['user_id'], category, emotion, emotion_raw, entry.get('intensity'),
+                entry.get('body_sensation'), entry.get('reason'), entry.get('note'),
+                entry['created_at'], entry['idempotency_key'],
+            ))
+
+        if not rows:
+            return 0
+        async with self.pool.acquire() as conn:
+            inserted = await conn.fetch(
+                """WITH ins AS (
+                       INSERT INTO entries (user_id, category, emotion, emotion_raw, intensity, body_sensation,
+                                            reason, note, created_at, idempotency_key)
+                       SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::int[],
+                                            $6::text[], $7::text[], $8::text[], $9::timestamp[], $10::text[])
+                                     AS t(user_id)
+                       -- Users may have deleted their account since the entry was spooled
+                       WHERE EXISTS (SELECT 1 FROM users u WHERE u.user_id = t.user_id)
+                       ON CONFLICT (idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+                       RETURNING id, user_id, created_at, category, emotion, intensity
+                   ), touched AS (
+                       UPDATE users u SET last_entry_id = last.id
+                       FROM (SELECT user_id, MAX(id) AS id FROM ins GROUP BY user_id) last
+                       WHERE u.user_id = last.user_id
+                   ), rollup AS (
+                       INSERT INTO daily_emotion_rollup AS r
+                           (user_id, local_date, category, emotion, entries_count, intensity_sum, intensity_count)
+                       SELECT ins.user_id, (ins.created_at + make_interval(hours => u.timezone))::date,
+                              COALESCE(ins.category, ''), ins.emotion, COUNT(*),
+                              COALESCE(SUM(ins.intensity), 0), COUNT(ins.intensity)
+                       FROM ins JOIN users u ON u.user_id = ins.user_id
+                       GROUP BY 1, 2, 3, 4
+                       ON CONFLICT (user_id, local_date, category, emotion) DO UPDATE SET
+                           entries_count = r.entries_count + EXCLUDED.entries_count,
+                           intensity_sum = r.intensity_sum + EXCLUDED.intensity_sum,
+                           intensity_count = r.intensity_count + EXCLUDED.intensity_count
+                   )
+                   SELECT user_id, COUNT(*) AS entries FROM ins GROUP BY user_id""",
+                *[list(column) for column in zip(*rows)]
             )
+        for row in inserted:
+            self._mark_write(row['user_id'])
+        return sum(row['entries'] for row in inserted)
 
-    async def get_entries(self, user_id: int, limit: int = 50, offset: int = 0) -> List[Dict]:
+    async def import_entries(self, user_id: int, batches: AsyncIterator[List[tuple]]) -> int:
+        """Load one user's imported entries (importer.IMPORT_COLUMNS records):
+        COPY every batch into a temporary table, then move them to entries and
+        the rollup in one statement. Rows already imported are skipped.
+        All or nothing; returns the number inserted."""
         async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    CREATE TEMP TABLE entries_import (
+                        category TEXT, emotion TEXT, emotion_raw TEXT, intensity INTEGER,
+                        body_sensation TEXT, reason TEXT, note TEXT, created_at TIMESTAMP, idempotency_key TEXT
+                    ) ON COMMIT DROP
+                """)
+                async for batch in batches:
+                    await conn.copy_records_to_table(
+                        "entries_import", records=batch,
+                        columns=["category", "emotion", "emotion_raw", "intensity", "body_sensation",
+                                 "reason", "note", "created_at", "idempotency_key"]
+                    )
+                inserted = await conn.fetchval(
+                    """WITH ins AS (
+                           INSERT INTO entries (user_id, category, emotion, emotion_raw, intensity, body_sensation,
+                                                reason, note, created_at, idempotency_key)
+                           SELECT $1, category, emotion, emotion_raw, intensity, body_sensation,
+                                  reason, note, created_at, idempotency_key
+                           FROM entries_import
+                           ON CONFLICT (idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+                           RETURNING id, created_at, category, emotion, intensity
+                       ), touched AS (
+                           UPDATE users SET last_entry_id = (SELECT MAX(id) FROM ins)
+                           WHERE user_id = $1 AND EXISTS (SELECT 1 FROM ins)
+                       ), rollup AS (
+                           INSERT INTO daily_emotion_rollup AS r
+                               (user_id, local_date, category, emotion, entries_count, intensity_sum, intensity_count)
+                           SELECT $1, (ins.created_at + make_interval(hours => u.timezone))::date,
+                                  COALESCE(ins.category, ''), ins.emotion, COUNT(*),
+                                  COALESCE(SUM(ins.intensity), 0), COUNT(ins.intensity)
+                           FROM ins JOIN users u ON u.user_id = $1
+                           GROUP BY 1, 2, 3, 4
+                           ON CONFLICT (user_id, local_date, category, emotion) DO UPDATE SET
+                               entries_count = r.entries_count + EXCLUDED.entries_count,
+                               intensity_sum = r.intensity_sum + EXCLUDED.intensity_sum,
+                               intensity_count = r.intensity_count + EXCLUDED.intensity_count
+                       )
+                       SELECT COUNT(*) FROM ins""",
+                    user_id
+                )
+        if inserted:
+            self._mark_write(user_id)
+        return inserted
+
+    async def _add_to_rollup(self, conn, user_id: int, created_at: datetime,
+                             category: Optional[str], emotion: str, intensity: Optional[int]):
+        """Incrementally update daily_emotion_rollup for one new entry"""
+        await conn.execute(
+            """INSERT INTO daily_emotion_rollup AS r
+                   (user_id, local_date, category, emotion, entries_count, intensity_sum, intensity_count)
+               SELECT $1, ($2::timestamp + make_interval(hours => u.timezone))::date,
+                      COALESCE($3, ''), $4, 1, COALESCE($5, 0), CASE WHEN $5 IS NULL THEN 0 ELSE 1 END
+               FROM users u WHERE u.user_id = $1
+               ON CONFLICT (user_id, local_date, category, emotion) DO UPDATE SET
+                   entries_count = r.entries_count + 1,
+                   intensity_sum = r.intensity_sum + EXCLUDED.intensity_sum,
+                   intensity_count = r.intensity_count + EXCLUDED.intensity_count""",
+            user_id, created_at, category, emotion, intensity
+        )
+
+    async def _touch_entries(self, conn, user_ids: List[int]):
+        """Change last_entry_id after entries were edited or deleted. A fresh value
+        from the entries id sequence is newer than any id the users had before."""
+        await conn.execute(
+            """UPDATE users SET last_entry_id = nextval(pg_get_serial_sequence('entries', 'id'))
+               WHERE user_id = ANY($1)""",
+            user_ids
+        )
+
+    async def get_entries(self, user_id: int, limit: int = 50, offset: int = 0) -> List[Entry]:
+        async with self._read_pool(user_id).acquire() as conn:
             rows = await conn.fetch(
-                """SELECT category, emotion, intensity, body_sensation, reason, note, created_at
-                   FROM entries WHERE user_id = $1
-                   ORDER BY created_at DESC LIMIT $2 OFFSET $3""",
+                f"""SELECT {columns(Entry)}
+                    FROM entries WHERE user_id = $1
+                    ORDER BY created_at DESC LIMIT $2 OFFSET $3""",
                 user_id, limit, offset
             )
-            return [dict(row) for row in rows]
+            return [Entry._make(row) for row in rows]
 
     async def get_entries_count(self, user_id: int) -> int:
-        async with self.pool.acquire() as conn:
+        async with self._read_pool(user_id).acquire() as conn:
             return await conn.fetchval(
                 "SELECT COUNT(*) FROM entries WHERE user_id = $1", user_id
             )
 
-    # === Statistics ===
+    async def get_last_entry_id(self, user_id: int) -> Optional[Tuple[int, int]]:
+        """(last_entry_id, timezone) of the user, None if there is no such user.
+        last_entry_id changes with every write to the user's entries (0 if none yet)."""
+        async with self._read_pool(user_id).acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT COALESCE(last_entry_id, 0), timezone FROM users WHERE user_id = $1", user_id
+            )
+            return tuple(row) if row else None
+
+    async def get_entries_page(self, user_id: int, before: Optional[Tuple[datetime, int]],
+                               limit: int) -> List[asyncpg.Record]:
+        """Up to limit entries with their ids, newest first, older than the
+        (created_at, id) of the previous page's last entry"""
+        async with self._read_pool(user_id).acquire() as conn:
+            if before is None:
+                return await conn.fetch(
+                    f"""SELECT id, {columns(Entry)} FROM entries WHERE user_id = $1
+                        ORDER BY created_at DESC, id DESC LIMIT $2""",
+                    user_id, limit
+                )
+            return await conn.fetch(
+                f"""SELECT id, {columns(Entry)} FROM entries
+                    WHERE user_id = $1 AND (created_at, id) < ($2, $3)
+                    ORDER BY created_at DESC, id DESC LIMIT $4""",
+                user_id, before[0], before[1], limit
+            )
 
-    async def get_emotion_stats(self, user_id: int) -> Dict:
+    async def renormalize_entries(self, batch_size: int = 1000) -> int:
+        """Re-run free-text normalization over free-text entries (no category,
+        or mapped from what the user typed), walking the table in id order. Rebuilds the rollup for affected users.
+        Returns the number of entries changed."""
+        updated = 0
+        affected_users = set()
+        last_id = 0
         async with self.pool.acquire() as conn:
+            while True:
+                rows = await conn.fetch(
+                    """SELECT id, user_id, category, emotion, emotion_raw FROM entries
+                       WHERE id > $1 AND (category IS NULL OR emotion_raw IS NOT NULL)
+                       ORDER BY id LIMIT $2""",
+                    last_id, batch_size
+                )
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+
+                changes = []
+                for row in rows:
+                    emotion, category, emotion_raw = normalize_emotion(row['emotion_raw'] or row['emotion'])
+                    if (emotion, category) != (row['emotion'], row['category']):
+                        changes.append((row['id'], emotion, category, emotion_raw))
+                        affected_users.add(row['user_id'])
+
+                if changes:
+                    await conn.executemany(
+                        "UPDATE entries SET emotion = $2, category = $3, emotion_raw = $4 WHERE id = $1",
+                        changes
+                    )
+                    updated += len(changes)
+
+            if affected_users:
+                await self._touch_entries(conn, list(affected_users))
+
+        if affected_users:
+            await self.backfill_daily_rollup(list(affected_users))
+        return updated
+
+    # === Statistics ===
+
+    async def get_emotion_stats(self, user_id: int) -> StatsSummary:
+        async with self._read_pool(user_id).acquire() as conn:
             top_emotions = await conn.fetch(
                 """SELECT emotion, COUNT(*) as count
                    FROM entries WHERE user_id = $1
@@ -186,13 +605,13 @@ class Database:
             # Streak calculation
             streak = await self._calculate_streak(conn, user_id)
 
-            return {
-                "total": total,
-                "top_emotions": [dict(r) for r in top_emotions],
-                "top_categories": [dict(r) for r in top_categories],
-                "avg_intensity": round(avg_intensity, 1) if avg_intensity else None,
-                "streak": streak
-            }
+            return StatsSummary(
+                total=total,
+                streak=streak,
+                avg_intensity=round(avg_intensity, 1) if avg_intensity else None,
+                top_emotions=[tuple(r) for r in top_emotions],
+                top_categories=[tuple(r) for r in top_categories],
+            )
 
     async def _calculate_streak(self, conn, user_id: int) -> int:
         rows = await conn.fetch(
@@ -220,8 +639,8 @@ class Database:
 
         return streak
 
-    async def get_weekly_summary(self, user_id: int) -> Dict:
-        async with self.pool.acquire() as conn:
+    async def get_weekly_summary(self, user_id: int) -> WeeklySummary:
+        async with self._read_pool(user_id).acquire() as conn:
             week_ago = datetime.now() - timedelta(days=7)
 
             total = await conn.fetchval(
@@ -244,11 +663,13 @@ class Database:
                 user_id, week_ago
             )
 
-            # Top reasons/triggers
+            # Top reasons/triggers, grouped by precomputed cluster; one-offs are noise
             top_reasons = await conn.fetch(
-                """SELECT reason, COUNT(*) as count
-                   FROM entries WHERE user_id = $1 AND created_at >= $2 AND reason IS NOT NULL AND reason != ''
-                   GROUP BY reason ORDER BY count DESC LIMIT 3""",
+                """SELECT c.label as reason, COUNT(*) as count
+                   FROM entries e JOIN reason_clusters c ON c.id = e.reason_cluster_id
+                   WHERE e.user_id = $1 AND e.created_at >= $2
+                   GROUP BY c.id, c.label HAVING COUNT(*) > 1
+                   ORDER BY count DESC LIMIT 3""",
                 user_id, week_ago
             )
 
@@ -279,15 +700,185 @@ class Database:
                 user_id, week_ago
             )
 
-            return {
-                "total": total,
-                "top_categories": [dict(r) for r in top_categories],
-                "top_emotions": [dict(r) for r in top_emotions],
-                "top_reasons": [dict(r) for r in top_reasons],
-                "peak_time": time_distribution[0]['time_of_day'] if time_distribution else None,
-                "avg_intensity": round(avg_intensity, 1) if avg_intensity else None,
-                "days_with_entries": days_with_entries
-            }
+            return WeeklySummary(
+                total=total,
+                days_with_entries=days_with_entries,
+                avg_intensity=round(avg_intensity, 1) if avg_intensity else None,
+                peak_time=time_distribution[0]['time_of_day'] if time_distribution else None,
+                top_emotions=[tuple(r) for r in top_emotions],
+                top_categories=[tuple(r) for r in top_categories],
+                top_reasons=[tuple(r) for r in top_reasons],
+            )
+
+    # === Daily rollup ===
+
+    async def get_chart_data(self, user_id: int, since: datetime) -> ChartData:
+        """Entries since a date as a handful of arrays instead of one record per row"""
+        async with self._read_pool(user_id).acquire() as conn:
+            row = await conn.fetchrow(
+                """WITH e AS (
+                       SELECT created_at, intensity, COALESCE(category, '') AS category
+                       FROM entries WHERE user_id = $1 AND created_at >= $2
+                   ), c AS (
+                       SELECT category, COUNT(*) AS n FROM e GROUP BY category
+                   )
+                   SELECT
+                       (SELECT array_agg(EXTRACT(EPOCH FROM created_at)::float8 ORDER BY created_at)
+                        FROM e WHERE intensity IS NOT NULL) AS times,
+                       (SELECT array_agg(intensity ORDER BY created_at)
+                        FROM e WHERE intensity IS NOT NULL) AS intensities,
+                       (SELECT array_agg(category ORDER BY n DESC, category) FROM c) AS categories,
+                       (SELECT array_agg(n ORDER BY n DESC, category) FROM c) AS category_counts""",
+                user_id, since
+            )
+        return ChartData._make(value or [] for value in row)
+
+    async def get_daily_rollup(self, user_id: int, since: date, until: date) -> List[asyncpg.Record]:
+        """Rollup rows for local dates in [since, until]"""
+        async with self._read_pool(user_id).acquire() as conn:
+            rows = await conn.fetch(
+                """SELECT local_date, category, emotion, entries_count, intensity_sum, intensity_count
+                   FROM daily_emotion_rollup
+                   WHERE user_id = $1 AND local_date BETWEEN $2 AND $3""",
+                user_id, since, until
+            )
+            # Records support row['key'] already; report building only reads them
+            return rows
+
+    async def rollup_needs_backfill(self) -> bool:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(
+                """SELECT EXISTS (SELECT 1 FROM entries)
+                   AND NOT EXISTS (SELECT 1 FROM daily_emotion_rollup)"""
+            )
+
+    async def backfill_daily_rollup(self, user_ids: List[int] = None, batch_size: int = 500) -> int:
+        """Rebuild rollup rows from entries, one batch of users per transaction.
+        Rebuilds every user when user_ids is None. Returns the number of users processed."""
+        async with self.pool.acquire() as conn:
+            if user_ids is None:
+                user_ids = [row['user_id'] for row in await conn.fetch(
+                    "SELECT DISTINCT user_id FROM entries WHERE user_id IS NOT NULL"
+                )]
+
+            for i in range(0, len(user_ids), batch_size):
+                batch = user_ids[i:i + batch_size]
+                async with conn.transaction():
+                    await conn.execute(
+                        "DELETE FROM daily_emotion_rollup WHERE user_id = ANY($1)", batch
+                    )
+                    await conn.execute(
+                        """INSERT INTO daily_emotion_rollup
+                               (user_id, local_date, category, emotion, entries_count, intensity_sum, intensity_count)
+                           SELECT e.user_id, (e.created_at + make_interval(hours => u.timezone))::date,
+                                  COALESCE(e.category, ''), e.emotion, COUNT(*),
+                                  COALESCE(SUM(e.intensity), 0), COUNT(e.intensity)
+                           FROM entries e JOIN users u ON u.user_id = e.user_id
+                           WHERE e.user_id = ANY($1)
+                           GROUP BY 1, 2, 3, 4""",
+                        batch
+                    )
+            return len(user_ids)
+
+    # === Reason clusters ===
+
+    async def get_unclustered_reasons(self, after_id: int, limit: int) -> List[asyncpg.Record]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                """SELECT id, user_id, reason FROM entries
+                   WHERE id > $1 AND reason_cluster_id IS NULL AND reason IS NOT NULL AND reason != ''
+                   ORDER BY id LIMIT $2""",
+                after_id, limit
+            )
+            return rows
+
+    async def get_reason_clusters(self, user_ids: List[int]) -> List[asyncpg.Record]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                """SELECT id, user_id, label, signature, entries_count
+                   FROM reason_clusters WHERE user_id = ANY($1)""",
+                user_ids
+            )
+            return rows
+
+    async def save_reason_clusters(self, users: list, assignments: List[tuple]):
+        """Persist changed clusters of UserClusters objects and point entries at them.
+        assignments are (entry_id, user_id, cluster_id, signature); negative
+        cluster ids are new clusters and get replaced with real ids."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                real_ids = {}
+                for user in users:
+                    for cluster_id, cluster in user.clusters.items():
+                        if not cluster.get('changed'):
+                            continue
+                        if cluster_id < 0:
+                            real_ids[(user.user_id, cluster_id)] = await conn.fetchval(
+                                """INSERT INTO reason_clusters (user_id, label, signature, entries_count)
+                                   VALUES ($1, $2, $3, $4) RETURNING id""",
+                                user.user_id, cluster['label'], cluster['signature'], cluster['entries_count']
+                            )
+                        else:
+                            await conn.execute(
+                                """UPDATE reason_clusters SET entries_count = $2, updated_at = CURRENT_TIMESTAMP
+                                   WHERE id = $1""",
+                                cluster_id, cluster['entries_count']
+                            )
+
+                await conn.executemany(
+                    "UPDATE entries SET reason_cluster_id = $2, reason_signature = $3 WHERE id = $1",
+                    [
+                        (entry_id, real_ids.get((user_id, cluster_id), cluster_id), sig)
+                        for entry_id, user_id, cluster_id, sig in assignments
+                    ]
+                )
+
+    # === Insights ===
+
+    async def get_user_ids_page(self, after_id: int, limit: int) -> List[int]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2", after_id, limit
+            )
+            return [row['user_id'] for row in rows]
+
+    async def get_entry_columns(self, user_ids: List[int], since: datetime) -> EntryColumns:
+        """Entries of the given users since a date as parallel arrays"""
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(
+                """SELECT array_agg(e.user_id ORDER BY e.user_id),
+                          array_agg(e.emotion ORDER BY e.user_id),
+                          array_agg(COALESCE(e.body_sensation, '') ORDER BY e.user_id),
+                          array_agg(COALESCE(e.intensity, -1) ORDER BY e.user_id),
+                          array_agg(EXTRACT(HOUR FROM e.created_at + make_interval(hours => u.timezone))::int
+                                    ORDER BY e.user_id)
+                   FROM entries e JOIN users u ON u.user_id = e.user_id
+                   WHERE e.user_id = ANY($1::bigint[]) AND e.created_at >= $2""",
+                user_ids, since
+            )
+        return EntryColumns._make(value or [] for value in row)
+
+    async def save_insights(self, rows: List[Tuple[int, List[Insight]]]):
+        if not rows:
+            return
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """INSERT INTO user_insights (user_id, insights, computed_at)
+                   SELECT i.user_id, i.insights::jsonb, $3
+                   FROM unnest($1::bigint[], $2::text[]) AS i(user_id, insights)
+                   -- Users deleted while the job ran are skipped
+                   WHERE EXISTS (SELECT 1 FROM users u WHERE u.user_id = i.user_id)
+                   ON CONFLICT (user_id) DO UPDATE SET
+                       insights = EXCLUDED.insights, computed_at = EXCLUDED.computed_at""",
+                [user_id for user_id, _ in rows],
+                [json.dumps([list(insight) for insight in insights], ensure_ascii=False) for _, insights in rows],
+                datetime.utcnow()
+            )
+
+    async def get_insights(self, user_id: int) -> List[Insight]:
+        async with self._read_pool(user_id).acquire() as conn:
+            payload = await conn.fetchval("SELECT insights FROM user_insights WHERE user_id = $1", user_id)
+        return [Insight._make(item) for item in json.loads(payload)] if payload else []
 
     # === Scheduled Checks ===
 
@@ -315,6 +906,25 @@ class Database:
                     user_id, check_time
                 )
 
+    async def replace_pending_checks(self, records: List[Tuple[int, datetime]],
+                                     user_ids: Optional[List[int]] = None) -> int:
+        """Swap unsent checks for (user_id, scheduled_time) records in one
+        transaction, written with COPY. Without user_ids every unsent check
+        is replaced, otherwise only those of the given users."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if user_ids is None:
+                    await conn.execute("DELETE FROM scheduled_checks WHERE sent = FALSE")
+                else:
+                    await conn.execute(
+                        "DELETE FROM scheduled_checks WHERE sent = FALSE AND user_id = ANY($1::bigint[])",
+                        user_ids
+                    )
+                await conn.copy_records_to_table(
+                    'scheduled_checks', records=records, columns=['user_id', 'scheduled_time']
+                )
+        return len(records)
+
     async def add_delayed_check(self, user_id: int, delay_minutes: int = 15):
         """Add a delayed check (for 'Remind me later' feature)"""
         async with self.pool.acquire() as conn:
@@ -336,6 +946,32 @@ class Database:
                 user_id, today_start, today_end
             )
 
+    async def add_ping_skip(self, user_id: int, local_date: date):
+        """Remember that the user skipped pings for the rest of local_date"""
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """INSERT INTO ping_skips (user_id, local_date) VALUES ($1, $2)
+                   ON CONFLICT DO NOTHING""",
+                user_id, local_date
+            )
+
+    async def get_skipped_users(self, due: List[Tuple[int, date]]) -> Set[int]:
+        """Filter (user_id, local_date) pairs down to users who skipped that day"""
+        if not due:
+            return set()
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                """SELECT s.user_id FROM ping_skips s
+                   JOIN unnest($1::bigint[], $2::date[]) AS d(user_id, local_date)
+                     ON s.user_id = d.user_id AND s.local_date = d.local_date""",
+                [user_id for user_id, _ in due], [local_date for _, local_date in due]
+            )
+            return {row['user_id'] for row in rows}
+
+    async def delete_old_ping_skips(self, before: date):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM ping_skips WHERE local_date < $1", before)
+
     async def get_and_mark_pending_checks(self, current_time: datetime) -> List[int]:
         """Atomically get pending checks and mark them as sent.
         Returns list of unique user_ids that need to be notified.
@@ -365,4 +1001,166 @@ class Database:
                 return user_ids
 
 
-db = Database()
+    # === Deletion and retention ===
+
+    async def request_deletion(self, user_id: int):
+        """Queue the user's data for deletion and stop pinging them right away"""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """INSERT INTO deletion_requests (user_id, checks_per_day)
+                       VALUES ($1, (SELECT checks_per_day FROM users WHERE user_id = $1))
+                       ON CONFLICT DO NOTHING""",
+                    user_id
+                )
+                # A settings change also takes the user out of derived schedules on every replica
+                await conn.execute(
+                    """UPDATE users SET checks_per_day = 0,
+                           settings_version = settings_version + 1, settings_updated_at = $2
+                       WHERE user_id = $1""",
+                    user_id, datetime.utcnow()
+                )
+                await conn.execute("DELETE FROM scheduled_checks WHERE user_id = $1 AND sent = FALSE", user_id)
+        self._mark_write(user_id)
+
+    async def cancel_deletion(self, user_id: int) -> Optional[int]:
+        """Withdraw a pending deletion request and turn pings back on.
+        Returns the restored checks_per_day, None if there was no request."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    "DELETE FROM deletion_requests WHERE user_id = $1 RETURNING checks_per_day", user_id
+                )
+                if row is None:
+                    return None
+                checks_per_day = await conn.fetchval(
+                    """UPDATE users SET checks_per_day = COALESCE($2, 4),
+                           settings_version = settings_version + 1, settings_updated_at = $3
+                       WHERE user_id = $1
+                       RETURNING checks_per_day""",
+                    user_id, row['checks_per_day'], datetime.utcnow()
+                )
+        self._mark_write(user_id)
+        return checks_per_day
+
+    async def get_deletion_requests(self, limit: int = 10) -> List[int]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM deletion_requests ORDER BY requested_at LIMIT $1", limit
+            )
+            return [row['user_id'] for row in rows]
+
+    async def delete_user_rows(self, table: str, user_id: int, limit: int) -> int:
+        """Delete up to limit of the user's rows in table, in primary key order.
+        Rows locked by someone else (the minute poll) are skipped, not waited for.
+        Deletes nothing once the request has been cancelled."""
+        key = dict(USER_DATA_TABLES)[table]
+        async with self.pool.acquire() as conn:
+            result = await conn.execute(
+                f"""DELETE FROM {table} WHERE ({key}) IN (
+                        SELECT {key} FROM {table} WHERE user_id = $1
+                          AND EXISTS (SELECT 1 FROM deletion_requests WHERE user_id = $1)
+                        ORDER BY {key} LIMIT $2 FOR UPDATE SKIP LOCKED
+                    )""",
+                user_id, limit
+            )
+            deleted = int(result.split()[-1])
+            if table == "entries" and deleted:
+                await self._touch_entries(conn, [user_id])
+        return deleted
+
+    async def finish_deletion(self, user_id: int) -> Optional[bool]:
+        """Delete the users row and the request once no other table references
+        the user. False if rows were left behind (locked or added meanwhile),
+        None if the request was cancelled by /start in the meantime."""
+        async with self.pool.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    requested = await conn.fetchval(
+                        "DELETE FROM deletion_requests WHERE user_id = $1 RETURNING user_id", user_id
+                    )
+                    if requested is None:
+                        return None
+                    await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
+            except asyncpg.ForeignKeyViolationError:
+                return False
+        self._mark_write(user_id)
+        return True
+
+    async def delete_expired_batch(self, table: str, condition: str, cutoff: datetime,
+                                   after_id: int, limit: int) -> Tuple[int, int]:
+        """Delete up to limit rows of table matching condition ($3 is cutoff)
+        with id > after_id, in id order. Returns (deleted, last id) so the
+        next batch continues where this one stopped."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"""DELETE FROM {table} WHERE id IN (
+                        SELECT id FROM {table} WHERE id > $1 AND {condition}
+                        ORDER BY id LIMIT $2 FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, user_id""",
+                after_id, limit, cutoff
+            )
+            # Old scheduled_checks rows feed no cached screen, so only entries mark users
+            user_ids = list({row['user_id'] for row in rows}) if table == "entries" else []
+            if user_ids:
+                await self._touch_entries(conn, user_ids)
+        for user_id in user_ids:
+            self._mark_write(user_id)
+        return len(rows), max((row['id'] for row in rows), default=after_id)
+
+
+    async def delete_expired_rollup_batch(self, cutoff: date, limit: int) -> int:
+        """Delete up to limit rollup rows for local dates before cutoff"""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                """DELETE FROM daily_emotion_rollup WHERE (user_id, local_date, category, emotion) IN (
+                       SELECT user_id, local_date, category, emotion FROM daily_emotion_rollup
+                       WHERE local_date < $1 LIMIT $2 FOR UPDATE SKIP LOCKED
+                   )
+                   RETURNING user_id""",
+                cutoff, limit
+            )
+            user_ids = list({row['user_id'] for row in rows})
+            if user_ids:
+                await self._touch_entries(conn, user_ids)
+        for user_id in user_ids:
+            self._mark_write(user_id)
+        return len(rows)
+
+    async def prune_reason_clusters(self, after_id: int, limit: int) -> Tuple[int, int, int]:
+        """For up to limit clusters with id > after_id, in id order: delete the
+        ones no entry references any more, recount the rest and relabel them
+        with the reason of their oldest remaining entry. Returns (clusters
+        looked at, deleted, last id)."""
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(
+                """WITH page AS (
+                       SELECT c.id, c.label, c.entries_count,
+                              (SELECT COUNT(*) FROM entries e WHERE e.reason_cluster_id = c.id) AS remaining,
+                              (SELECT left(trim(e.reason), 60) FROM entries e
+                               WHERE e.reason_cluster_id = c.id ORDER BY e.id LIMIT 1) AS oldest_reason
+                       FROM reason_clusters c WHERE c.id > $1 ORDER BY c.id LIMIT $2
+                   ), dropped AS (
+                       DELETE FROM reason_clusters c USING page
+                       WHERE c.id = page.id AND page.remaining = 0
+                       RETURNING c.id
+                   ), kept AS (
+                       UPDATE reason_clusters c
+                       SET entries_count = page.remaining, label = page.oldest_reason, updated_at = CURRENT_TIMESTAMP
+                       FROM page
+                       WHERE c.id = page.id AND page.remaining > 0
+                         AND (page.entries_count <> page.remaining OR page.label <> page.oldest_reason)
+                   )
+                   SELECT (SELECT COUNT(*) FROM page) AS seen, (SELECT COUNT(*) FROM dropped) AS deleted,
+                          (SELECT MAX(id) FROM page) AS last_id""",
+                after_id, limit
+            )
+        return row['seen'], row['deleted'], row['last_id'] or after_id
+
+
+if DATABASE_SHARD_URLS:
+    from sharding import ShardedDatabase
+    db = ShardedDatabase(DATABASE_SHARD_URLS)
+else:
+    db = Database()
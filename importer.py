@@ -0,0 +1,282 @@
+"""Import diary history from CSV or JSON (/import).
+
+Accepted documents:
+
+    CSV with a header row, "," ";" or tab separated:
+        date,emotion,category,intensity,body_sensation,reason,note
+    JSON: an array of objects with the same keys, or one object per line
+
+Only date and emotion are required; Russian column names (дата, эмоция,
+категория, ...) work too. Dates without an offset are the user's local
+time. Rows are parsed, validated and normalized one at a time (a category
+and an emotion from emotions.EMOTIONS are kept as is, anything else goes
+through normalization.normalize_emotion), and Database.import_entries
+COPYs them in batches of IMPORT_BATCH_ROWS. Every row gets an idempotency
+key from its content, so uploading the same file twice adds nothing.
+"""
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone as tz
+from itertools import islice
+from typing import AsyncIterator, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from config import IMPORT_BATCH_ROWS, IMPORT_MAX_ROWS
+from emotions import EMOTIONS
+from metrics import metrics
+from normalization import normalize_emotion, normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Staging columns, in the order of the records validate_row() returns
+IMPORT_COLUMNS = [
+    "category", "emotion", "emotion_raw", "intensity", "body_sensation", "reason", "note",
+    "created_at", "idempotency_key",
+]
+
+_FIELD_ALIASES = {
+    "date": ["date", "datetime", "created_at", "time", "timestamp", "дата", "время"],
+    "emotion": ["emotion", "mood", "эмоция", "настроение"],
+    "category": ["category", "категория"],
+    "intensity": ["intensity", "интенсивность", "сила"],
+    "body_sensation": ["body_sensation", "body", "ощущения", "ощущение", "тело"],
+    "reason": ["reason", "cause", "причина"],
+    "note": ["note", "notes", "comment", "заметка", "комментарий"],
+}
+_FIELDS = {alias: field for field, aliases in _FIELD_ALIASES.items() for alias in aliases}
+
+# "😊 Радость" and plain "радость" both name the category
+_CATEGORIES: Dict[str, str] = {}
+for _category in EMOTIONS:
+    _CATEGORIES[_category] = _category
+    _CATEGORIES[normalize_text(_category)] = _category
+    _CATEGORIES[normalize_text(_category.split(" ", 1)[-1])] = _category
+
+_DATE_FORMATS = ["%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y", "%d/%m/%Y %H:%M", "%d/%m/%Y"]
+_EARLIEST = datetime(2000, 1, 1)
+MAX_EMOTION_LENGTH = 100
+MAX_TEXT_LENGTH = 2000
+# Row errors kept for the reply; the rest are only counted
+MAX_REPORTED_ERRORS = 5
+
+
+class ImportResult(NamedTuple):
+    rows: int
+    imported: int
+    duplicates: int  # valid rows already in the diary
+    errors: int
+    first_errors: List[Tuple[int, str]]
+
+
+class RowError(ValueError):
+    pass
+
+
+def iter_rows(data: bytes) -> Iterator[Tuple[int, Dict[str, object]]]:
+    """(line or item number, raw dict) for every row of a CSV or JSON document"""
+    text = data.decode("utf-8-sig")
+    start = text.lstrip()[:1]
+    if start == "[":
+        yield from _iter_json_array(text)
+    elif start == "{":
+        for number, line in enumerate(io.StringIO(text), 1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except json.JSONDecodeError:
+                    yield number, RowError("некорректный JSON")
+    else:
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def _iter_json_array(text: str) -> Iterator[Tuple[int, Dict[str, object]]]:
+    # raw_decode one element at a time instead of building the whole list
+    decoder = json.JSONDecoder()
+    position = text.index("[") + 1
+    number = 0
+    while True:
+        while position < len(text) and text[position] in " \t\r\n,":
+            position += 1
+        if position >= len(text) or text[position] == "]":
+            return
+        number += 1
+        try:
+            item, position = decoder.raw_decode(text, position)
+        except json.JSONDecodeError as e:
+            raise RowError(f"элемент {number}: некорректный JSON") from e
+        yield number, item
+
+
+def _text(value, limit: int) -> Optional[str]:
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value[:limit] if value else None
+
+
+def _parse_date(value, timezone: int) -> datetime:
+    """UTC timestamp of an ISO or dd.mm.yyyy date; no offset means user's local time"""
+    value = str(value or "").strip()
+    if not value:
+        raise RowError("не указана дата")
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        for date_format in _DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(value, date_format)
+                break
+            except ValueError:
+                continue
+        else:
+            raise RowError(f"непонятная дата «{value[:30]}»")
+    if parsed.tzinfo is not None:
+        return parsed.astimezone(tz.utc).replace(tzinfo=None)
+    return parsed - timedelta(hours=timezone)
+
+
+def validate_row(user_id: int, timezone: int, raw: Dict[str, object], now: datetime) -> tuple:
+    """Staging record (IMPORT_COLUMNS order) for one raw row, or RowError"""
+    if not isinstance(raw, dict):
+        raise RowError("ожидался объект с полями")
+    row = {}
+    for key, value in raw.items():
+        field = _FIELDS.get(key) or _FIELDS.get(str(key).strip().lower())
+        if field and value is not None and value != "":
+            row[field] = value
+
+    emotion = _text(row.get("emotion"), MAX_EMOTION_LENGTH + 1)
+    if not emotion:
+        raise RowError("не указана эмоция")
+    if len(emotion) > MAX_EMOTION_LENGTH:
+        raise RowError("слишком длинная эмоция")
+
+    created_at = _parse_date(row.get("date"), timezone)
+    if not _EARLIEST <= created_at <= now + timedelta(days=1):
+        raise RowError("дата вне допустимого диапазона")
+
+    intensity = row.get("intensity")
+    if intensity is not None:
+        try:
+            intensity = int(float(str(intensity).split("/")[0].replace(",", ".")))
+        except ValueError:
+            raise RowError("интенсивность должна быть числом от 0 до 10")
+        if not 0 <= intensity <= 10:
+            raise RowError("интенсивность должна быть числом от 0 до 10")
+
+    category = row.get("category")
+    if category is not None:
+        category = _CATEGORIES.get(category) or _CATEGORIES.get(normalize_text(str(category)))
+    if category and emotion.lower() in EMOTIONS[category]["emotions"]:
+        emotion, emotion_raw = emotion.lower(), None
+    else:
+        emotion, category, emotion_raw = normalize_emotion(emotion)
+
+    body_sensation = _text(row.get("body_sensation"), MAX_TEXT_LENGTH)
+    reason = _text(row.get("reason"), MAX_TEXT_LENGTH)
+    note = _text(row.get("note"), MAX_TEXT_LENGTH)
+
+    digest = hashlib.blake2b(
+        "\x1f".join(map(str, (created_at, emotion_raw or emotion, intensity, body_sensation, reason, note))).encode(),
+        digest_size=12,
+    ).hexdigest()
+    return (
+        category, emotion, emotion_raw, intensity, body_sensation, reason, note,
+        created_at, f"import:{user_id}:{digest}",
+    )
+
+
+class _Validator:
+    """Wraps iter_rows() into valid records, counting rows and errors on the way"""
+
+    def __init__(self, user_id: int, timezone: int, data: bytes, max_rows: int):
+        self.user_id = user_id
+        self.timezone = timezone
+        self.data = data
+        self.max_rows = max_rows
+        self.rows = 0
+        self.valid = 0
+        self.errors = 0
+        self.first_errors: List[Tuple[int, str]] = []
+
+    def _error(self, number: int, message: str):
+        self.errors += 1
+        if len(self.first_errors) < MAX_REPORTED_ERRORS:
+            self.first_errors.append((number, message))
+
+    def __iter__(self) -> Iterator[tuple]:
+        now = datetime.utcnow()
+        rows = iter_rows(self.data)
+        while True:
+            try:
+                number, raw = next(rows)
+            except StopIteration:
+                return
+            except (RowError, UnicodeDecodeError, csv.Error) as e:
+                # The document itself is broken past this point
+                self._error(self.rows + 1, str(e) if isinstance(e, RowError) else "файл не читается")
+                return
+            if self.rows >= self.max_rows:
+                self._error(number, f"больше {self.max_rows} строк, остальные пропущены")
+                return
+            self.rows += 1
+            if isinstance(raw, RowError):
+                self._error(number, str(raw))
+                continue
+            try:
+                record = validate_row(self.user_id, self.timezone, raw, now)
+            except RowError as e:
+                self._error(number, str(e))
+                continue
+            self.valid += 1
+            yield record
+
+
+async def _batches(records: Iterator[tuple], size: int) -> AsyncIterator[List[tuple]]:
+    # Parsing is CPU work: run each batch in a thread, off the event loop,
+    # and parse the next batch while the database copies this one
+    def parse():
+        return asyncio.ensure_future(asyncio.to_thread(list, islice(records, size)))
+
+    pending = parse()
+    try:
+        while True:
+            batch = await pending
+            if not batch:
+                return
+            pending = parse()
+            yield batch
+    finally:
+        if not pending.done():
+            # The generator is not thread-safe: let the running batch finish first
+            await asyncio.wait([pending])
+
+
+async def import_document(db, user_id: int, timezone: int, data: bytes,
+                          batch_size: int = IMPORT_BATCH_ROWS, max_rows: int = IMPORT_MAX_ROWS) -> ImportResult:
+    """Validate and load a CSV/JSON document into the user's diary"""
+    started = time.perf_counter()
+    validator = _Validator(user_id, timezone, data, max_rows)
+    imported = await db.import_entries(user_id, _batches(iter(validator), batch_size))
+
+    elapsed = time.perf_counter() - started
+    metrics.inc("import.rows", validator.rows)
+    metrics.inc("import.entries", imported)
+    metrics.observe("import.run", elapsed)
+    logger.info(
+        f"Import for user {user_id}: {validator.rows} rows, {imported} imported, "
+        f"{validator.errors} errors in {elapsed:.2f}s"
+    )
+    return ImportResult(
+        validator.rows, imported, validator.valid - imported, validator.errors, validator.first_errors
+    )
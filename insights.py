@@ -0,0 +1,174 @@
+"""Nightly per-user insights from entries.
+
+    "тревога" чаще всего бывает вечером        (emotion x time of day)
+    напряжение в плечах часто вместе с «злость» (emotion x body sensation)
+    самые сильные эмоции — вечером              (intensity x time of day)
+
+The job walks users in pages of INSIGHTS_BATCH_USERS, fetches each page's
+entries of the last INSIGHTS_DAYS days as columns, and hands the columns to
+worker processes. compute_insights() builds the per-user contingency tables
+of a whole page at once with NumPy, in sparse form (np.unique over combined
+codes), scores every cell by lift over the user's baseline and keeps the
+best cell of each kind per user. Results go to user_insights, so stats and
+weekly summaries only read a row.
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from config import (
+    INSIGHTS_BATCH_USERS, INSIGHTS_DAYS, INSIGHTS_MIN_LIFT, INSIGHTS_MIN_SUPPORT, INSIGHTS_WORKERS,
+)
+from metrics import metrics
+from models import EntryColumns, Insight
+
+logger = logging.getLogger(__name__)
+
+# Same boundaries as the weekly summary's peak time
+TIMES_OF_DAY = ["ночь", "утро", "день", "вечер"]
+TIME_OF_DAY_ADVERB = {"ночь": "ночью", "утро": "утром", "день": "днём", "вечер": "вечером"}
+# A time of day needs this share of an emotion's entries to be called "most frequent"
+MIN_TIME_SHARE = 0.4
+# Mean intensity at a time of day must exceed the user's mean by this much
+MIN_INTENSITY_DELTA = 1.0
+
+
+def _time_of_day(hours):
+    import numpy as np
+    # 0-5 night, 6-11 morning, 12-17 day, 18-22 evening, 23 night
+    return np.select([hours < 6, hours < 12, hours < 18, hours < 23], [0, 1, 2, 3], 0)
+
+
+def _best_pairs(users, a, b, min_share: float = 0.0):
+    """Best (a, b) cell per user for a-to-b association, scored by
+    support * log(lift) so a strong pattern beats a lucky handful of entries.
+    Returns user, a, b, support and lift arrays, one row per user."""
+    import numpy as np
+
+    n_a = int(a.max()) + 1
+    n_b = int(b.max()) + 1
+    joint_keys, joint = np.unique((users * n_a + a) * n_b + b, return_counts=True)
+    user_of = joint_keys // (n_a * n_b)
+    a_of = joint_keys // n_b % n_a
+    b_of = joint_keys % n_b
+
+    per_user = np.bincount(users)
+    per_a = np.bincount(users * n_a + a)[user_of * n_a + a_of]
+    per_b = np.bincount(users * n_b + b)[user_of * n_b + b_of]
+    lift = joint * per_user[user_of] / (per_a * per_b)
+
+    keep = (joint >= INSIGHTS_MIN_SUPPORT) & (lift >= INSIGHTS_MIN_LIFT) & (joint >= min_share * per_a)
+    user_of, a_of, b_of, joint, lift = user_of[keep], a_of[keep], b_of[keep], joint[keep], lift[keep]
+    # Best score first within each user, then the first row of every user
+    order = np.lexsort((-joint * np.log(lift), user_of))
+    _, first = np.unique(user_of[order], return_index=True)
+    pick = order[first]
+    return user_of[pick], a_of[pick], b_of[pick], joint[pick], lift[pick]
+
+
+def compute_insights(columns: EntryColumns) -> List[Tuple[int, List[Insight]]]:
+    """Insights for every user of a page; runs in a worker process"""
+    import numpy as np
+
+    if not columns.user_ids:
+        return []
+    user_ids, users = np.unique(np.asarray(columns.user_ids, dtype=np.int64), return_inverse=True)
+    emotion_names, emotions = np.unique(np.asarray(columns.emotions, dtype=str), return_inverse=True)
+    bodies_raw = np.char.lower(np.char.strip(np.asarray(columns.body_sensations, dtype=str)))
+    body_names, bodies = np.unique(bodies_raw, return_inverse=True)
+    times = _time_of_day(np.asarray(columns.hours, dtype=np.int64))
+    intensities = np.asarray(columns.intensities, dtype=np.float64)
+
+    found: Dict[int, List[Insight]] = {int(user_id): [] for user_id in user_ids}
+
+    # Emotion x time of day
+    for u, e, t, n, lift in zip(*_best_pairs(users, emotions, times, MIN_TIME_SHARE)):
+        found[int(user_ids[u])].append(
+            Insight("time", str(emotion_names[e]), TIMES_OF_DAY[t], int(n), round(float(lift), 2))
+        )
+
+    # Emotion x body sensation, only entries where a sensation was given
+    given = bodies_raw != ""
+    if given.any():
+        for u, e, b, n, lift in zip(*_best_pairs(users[given], emotions[given], bodies[given])):
+            found[int(user_ids[u])].append(
+                Insight("body", str(emotion_names[e]), str(body_names[b]), int(n), round(float(lift), 2))
+            )
+
+    # Mean intensity by time of day against the user's overall mean
+    rated = intensities >= 0
+    if rated.any():
+        u, t, x = users[rated], times[rated], intensities[rated]
+        cells = u * 4 + t
+        count = np.bincount(cells, minlength=len(user_ids) * 4).reshape(-1, 4)
+        total = np.bincount(cells, weights=x, minlength=len(user_ids) * 4).reshape(-1, 4)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / count
+            overall = total.sum(axis=1) / count.sum(axis=1)
+        mean[count < INSIGHTS_MIN_SUPPORT] = -np.inf
+        best = mean.argmax(axis=1)
+        best_mean = mean[np.arange(len(user_ids)), best]
+        for u in np.flatnonzero(best_mean - overall >= MIN_INTENSITY_DELTA):
+            found[int(user_ids[u])].append(Insight(
+                "intensity", TIMES_OF_DAY[best[u]], f"{best_mean[u]:.1f}",
+                int(count[u, best[u]]), round(float(best_mean[u] / overall[u]), 2),
+            ))
+
+    return list(found.items())
+
+
+def render_insight(insight: Insight) -> str:
+    if insight.kind == "time":
+        return f"«{insight.subject}» чаще всего бывает {TIME_OF_DAY_ADVERB[insight.detail]}"
+    if insight.kind == "body":
+        return f"{insight.detail.capitalize()} часто бывает вместе с «{insight.subject}»"
+    return f"Самые сильные эмоции — {TIME_OF_DAY_ADVERB[insight.subject]} (в среднем {insight.detail}/10)"
+
+
+async def update_insights(db, now: datetime = None) -> int:
+    """Recompute insights of all users; returns the number of users processed"""
+    now = now or datetime.utcnow()
+    since = now - timedelta(days=INSIGHTS_DAYS)
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    processed = 0
+
+    async def store(future, user_ids: List[int]):
+        results = dict(await future)
+        # Users without entries in the window get an empty list, replacing stale insights
+        await db.save_insights([(user_id, results.get(user_id, [])) for user_id in user_ids])
+
+    # spawn: the bot process runs threads that a fork would copy mid-state
+    executor = ProcessPoolExecutor(INSIGHTS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        pending = set()
+        after_id = 0
+        while True:
+            user_ids = await db.get_user_ids_page(after_id, INSIGHTS_BATCH_USERS)
+            if not user_ids:
+                break
+            after_id = user_ids[-1]
+            columns = await db.get_entry_columns(user_ids, since)
+            # The next page is fetched while workers compute this one
+            computed = loop.run_in_executor(executor, compute_insights, columns)
+            pending.add(asyncio.ensure_future(store(computed, user_ids)))
+            processed += len(user_ids)
+            if len(pending) >= INSIGHTS_WORKERS * 2:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, Exception):
+                raise result
+    finally:
+        # shutdown() waits for running batches: off the loop, and queued ones
+        # are dropped when a failure got us here
+        await asyncio.to_thread(executor.shutdown, cancel_futures=True)
+
+    metrics.observe("insights.run", time.perf_counter() - started)
+    logger.info(f"Insights updated for {processed} users in {time.perf_counter() - started:.1f}s")
+    return processed
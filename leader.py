@@ -0,0 +1,100 @@
+import asyncio
+import functools
+import logging
+from typing import Optional
+
+import asyncpg
+
+from config import DATABASE_SHARD_URLS, DATABASE_URL, LEADER_ELECTION, LEADER_LOCK_KEY
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """Leader election between replicas using a Postgres session advisory lock.
+
+    The lock is taken on a dedicated connection (outside the pool) and held
+    for as long as that connection lives. If the leader dies its connection
+    drops, the lock is released and another replica takes over the next time
+    a cron job fires.
+    """
+
+    def __init__(self, dsn: str, lock_key: int, enabled: bool = True):
+        self.dsn = dsn
+        self.lock_key = lock_key
+        self.enabled = enabled
+        self._conn: Optional[asyncpg.Connection] = None
+        self._lock = asyncio.Lock()
+
+        metrics.gauge("leader.is_leader", lambda: int(self.is_leader))
+
+    @property
+    def is_leader(self) -> bool:
+        if not self.enabled:
+            return True
+        return self._conn is not None and not self._conn.is_closed()
+
+    async def ensure(self) -> bool:
+        """Return True if this process is (or has just become) the leader"""
+        if not self.enabled:
+            return True
+
+        async with self._lock:
+            if self._conn is not None:
+                try:
+                    await self._conn.fetchval("SELECT 1")
+                    return True
+                except Exception as e:
+                    logger.warning(f"Lost leader connection: {e}")
+                    await self._close()
+
+            try:
+                conn = await asyncpg.connect(self.dsn)
+            except Exception as e:
+                logger.error(f"Leader election failed to connect: {e}")
+                return False
+
+            acquired = await conn.fetchval("SELECT pg_try_advisory_lock($1)", self.lock_key)
+            if not acquired:
+                await conn.close()
+                return False
+
+            self._conn = conn
+            metrics.inc("leader.acquired")
+            logger.info("Acquired cron leadership")
+            return True
+
+    async def release(self):
+        async with self._lock:
+            if self._conn is not None and not self._conn.is_closed():
+                try:
+                    await self._conn.execute("SELECT pg_advisory_unlock($1)", self.lock_key)
+                except Exception:
+                    pass
+            await self._close()
+
+    async def _close(self):
+        if self._conn is not None:
+            try:
+                await self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+
+
+# With shards the lock lives on the first one
+leader = LeaderElection(
+    DATABASE_SHARD_URLS[0] if DATABASE_SHARD_URLS else DATABASE_URL, LEADER_LOCK_KEY, enabled=LEADER_ELECTION
+)
+
+
+def leader_only(job):
+    """Run a cron job only on the replica that holds leadership"""
+    @functools.wraps(job)
+    async def wrapper(*args, **kwargs):
+        if not await leader.ensure():
+            logger.info(f"Skipping {job.__name__}: another replica is the cron leader")
+            return None
+        return await job(*args, **kwargs)
+    return wrapper
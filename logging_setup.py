@@ -0,0 +1,144 @@
+"""Logging off the event loop.
+
+setup_logging() routes every record through a QueueHandler: the event-loop
+thread only enqueues, and a QueueListener thread formats (JSON lines by
+default) and writes. If the queue is full, records are dropped and counted
+instead of blocking a handler.
+
+High-volume per-user lines (pings, weekly summaries) go through LogBatch:
+one summary line per batch, individual lines only for the first few
+failures and for a 1-in-N sample of successes at DEBUG.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from config import LOG_FORMAT, LOG_LEVEL, LOG_QUEUE_SIZE, LOG_SAMPLE_EVERY
+from metrics import metrics
+
+# Attributes every LogRecord has; anything else came from extra={...}
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller: a full queue drops the record"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock prepare() formats and copies the record on the caller's
+        # thread for pickling; an in-process queue only needs args bound now
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log.dropped")
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, queue_size: int = LOG_QUEUE_SIZE,
+                  stream=None) -> logging.handlers.QueueListener:
+    """Replace root handlers with the queue pipeline; safe to call again"""
+    global _listener
+    stop_logging()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    root = logging.getLogger()
+    root.handlers = [DroppingQueueHandler(log_queue)]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    metrics.gauge("log.queue_depth", log_queue.qsize)
+    return _listener
+
+
+@atexit.register
+def stop_logging():
+    """Write out whatever is still queued and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class LogBatch:
+    """Aggregate per-user events of one batch into a single summary line.
+
+        batch = LogBatch(logger, "ping")
+        batch.ok(user_id) / batch.failed(user_id, error)
+        batch.flush()   # INFO ping batch: 1520 ok, 3 failed
+    """
+
+    MAX_FAILURE_LINES = 10
+
+    def __init__(self, logger: logging.Logger, event: str, sample_every: int = LOG_SAMPLE_EVERY):
+        self.logger = logger
+        self.event = event
+        self.sample_every = sample_every
+        self.succeeded = 0
+        self.failures: List[Tuple[int, str]] = []
+        self.errors: Dict[str, int] = {}
+        self.started = time.perf_counter()
+
+    def ok(self, user_id: int):
+        self.succeeded += 1
+        if self.sample_every and (self.succeeded - 1) % self.sample_every == 0:
+            self.logger.debug(f"{self.event} ok for user {user_id}", extra={"event": self.event, "user_id": user_id})
+
+    def failed(self, user_id: int, error: Exception):
+        kind = type(error).__name__
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+        if len(self.failures) < self.MAX_FAILURE_LINES:
+            self.failures.append((user_id, kind))
+            self.logger.error(f"{self.event} failed for user {user_id}: {error}",
+                              extra={"event": self.event, "user_id": user_id})
+
+    def flush(self, **extra):
+        if not self.succeeded and not self.errors:
+            return
+        failed = sum(self.errors.values())
+        self.logger.info(
+            f"{self.event} batch: {self.succeeded} ok, {failed} failed",
+            extra={
+                "event": f"{self.event}_batch",
+                "ok": self.succeeded,
+                "failed": failed,
+                "errors": self.errors,
+                "duration_ms": round((time.perf_counter() - self.started) * 1000, 1),
+                **extra,
+            },
+        )
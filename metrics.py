@@ -0,0 +1,56 @@
+import time
+from collections import defaultdict, deque
+from typing import Callable, Dict
+
+
+class Metrics:
+    """Tiny in-process metrics registry exported as JSON on /metrics"""
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.timings: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.window))
+        self.started_at = time.time()
+
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        """Register a callable evaluated on every snapshot"""
+        self.gauges[name] = fn
+
+    def observe(self, name: str, seconds: float):
+        """Record a duration; only the last `window` samples are kept"""
+        self.timings[name].append(seconds)
+
+    def snapshot(self) -> Dict:
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception:
+                gauges[name] = None
+
+        timings = {}
+        for name, samples in self.timings.items():
+            values = sorted(samples)
+            if not values:
+                continue
+            timings[name] = {
+                "count": len(values),
+                "p50_ms": round(values[len(values) // 2] * 1000, 2),
+                "p95_ms": round(values[int(len(values) * 0.95)] * 1000, 2),
+                "p99_ms": round(values[int(len(values) * 0.99)] * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+            }
+
+        return {
+            "uptime_s": round(time.time() - self.started_at),
+            "counters": dict(self.counters),
+            "gauges": gauges,
+            "timings": timings,
+        }
+
+
+metrics = Metrics()
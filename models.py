@@ -0,0 +1,93 @@
+"""Typed rows returned by Database.
+
+Models are NamedTuples built straight from asyncpg Records with
+Model._make(record), so queries select exactly the model's columns in
+field order (see columns()). Compared to dict(row) there is no per-row
+hash table: a row costs one tuple and fields are read by attribute.
+"""
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+
+def columns(model, prefix: str = "") -> str:
+    """SELECT list matching the model's fields"""
+    return ", ".join(f"{prefix}{field}" for field in model._fields)
+
+
+class User(NamedTuple):
+    user_id: int
+    timezone: int
+    check_start_hour: int
+    check_end_hour: int
+    checks_per_day: int
+    onboarding_complete: bool
+    settings_version: int
+
+
+class ScheduleSettings(NamedTuple):
+    """The part of a user row that determines ping times"""
+    user_id: int
+    timezone: int
+    check_start_hour: int
+    check_end_hour: int
+    checks_per_day: int
+    settings_version: int
+
+
+class Entry(NamedTuple):
+    category: Optional[str]
+    emotion: str
+    emotion_raw: Optional[str]
+    intensity: Optional[int]
+    body_sensation: Optional[str]
+    reason: Optional[str]
+    note: Optional[str]
+    created_at: datetime
+
+    @property
+    def display_emotion(self) -> str:
+        """What the user typed, falling back to the normalized emotion"""
+        return self.emotion_raw or self.emotion
+
+
+class StatsSummary(NamedTuple):
+    total: int
+    streak: int
+    avg_intensity: Optional[float]
+    top_emotions: List[Tuple[str, int]]  # (emotion, count)
+    top_categories: List[Tuple[str, int]]  # (category, count)
+
+
+class WeeklySummary(NamedTuple):
+    total: int
+    days_with_entries: int
+    avg_intensity: Optional[float]
+    peak_time: Optional[str]
+    top_emotions: List[Tuple[str, int]]  # (emotion, count)
+    top_categories: List[Tuple[str, int]]  # (category, count)
+    top_reasons: List[Tuple[str, int]]  # (cluster label, count)
+
+
+class ChartData(NamedTuple):
+    """Columns for /chart, one array per field as returned by array_agg"""
+    times: List[float]  # epoch seconds of entries with an intensity, ascending
+    intensities: List[int]
+    categories: List[str]  # '' for free-text entries, most frequent first
+    category_counts: List[int]
+
+
+class EntryColumns(NamedTuple):
+    """Entries of a batch of users as parallel arrays, ordered by user_id"""
+    user_ids: List[int]
+    emotions: List[str]
+    body_sensations: List[str]  # '' when not given
+    intensities: List[int]  # -1 when not given
+    hours: List[int]  # hour of day in the user's timezone
+
+
+class Insight(NamedTuple):
+    kind: str  # "time", "body" or "intensity"
+    subject: str  # emotion, or the time of day for "intensity"
+    detail: str  # time of day or body sensation; mean intensity for "intensity"
+    support: int  # entries behind the insight
+    lift: float  # how much more often than the user's baseline
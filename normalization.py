@@ -0,0 +1,226 @@
+"""Map free-text emotions to the EMOTIONS taxonomy.
+
+The index is built once from emotions.EMOTIONS plus emotion_synonyms.txt:
+exact normalized forms and stems go into a dict, stems also go into a trie
+for longest-prefix matches ("раздражённая" -> "раздраж" -> раздражение).
+
+    python -m normalization --renormalize   # re-normalize existing entries
+"""
+import logging
+import os
+import string
+from typing import Dict, List, Optional, Tuple
+
+from emotions import EMOTIONS
+
+logger = logging.getLogger(__name__)
+
+SYNONYMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "emotion_synonyms.txt")
+
+# Shortest stem accepted for a prefix match, to avoid "ра" -> радость
+MIN_PREFIX = 4
+
+# Slow-path lookups remembered per raw input
+CACHE_SIZE = 10_000
+
+# A matched word after one of these is negated ("не радостно", "ничего хорошего"):
+# the input is then kept as normalized text without a category
+NEGATIONS = frozenset({"не", "нет", "ни", "ничего", "без"})
+
+_REFLEXIVE = ("ся", "сь")
+_SUFFIXES = sorted([
+    # derivational, so тревожно/тревожность/тревожный share a stem
+    "ость", "ости", "остью", "ность", "ности",
+    # adjectives and participles
+    "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой", "ого", "его", "ому", "ему",
+    "ую", "юю", "ым", "им", "ыми", "ими", "ых", "их", "ей",
+    # nouns
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "ом", "ем", "ам", "ям", "ами", "ями",
+    "ах", "ях", "ов", "ев", "ию", "ья", "ье", "ия",
+    # verbs
+    "ть", "ешь", "ет", "ют", "ут", "ла", "ло", "ли", "л", "ал", "ала", "ено", "ена",
+], key=len, reverse=True)
+
+# str.translate is several times faster than a regex substitution here
+_TRANSLATION = str.maketrans(
+    {**{c: " " for c in string.punctuation.replace("-", "") + "«»—–…“”„‘’№"}, "ё": "е"}
+)
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, ё -> е, no punctuation, single spaces"""
+    return " ".join(text.lower().translate(_TRANSLATION).split())
+
+
+# Suffixes grouped by length, longest first: one set lookup per length
+_SUFFIXES_BY_LENGTH = [
+    (length, frozenset(s for s in _SUFFIXES if len(s) == length))
+    for length in sorted({len(s) for s in _SUFFIXES}, reverse=True)
+]
+
+
+def stem(word: str) -> str:
+    """Very light Russian stemmer: strip a reflexive ending and one suffix"""
+    if word[-2:] in _REFLEXIVE and len(word) >= 5:
+        word = word[:-2]
+    for length, suffixes in _SUFFIXES_BY_LENGTH:
+        if len(word) - length >= 3 and word[-length:] in suffixes:
+            return word[:-length]
+    return word
+
+
+class _TrieNode:
+    __slots__ = ("children", "value")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.value: Optional[Tuple[str, str]] = None
+
+
+class EmotionNormalizer:
+    def __init__(self):
+        self.exact: Dict[str, Tuple[str, str]] = {}
+        self.stems: Dict[str, Tuple[str, str]] = {}
+        self._root = _TrieNode()
+        self._cache: Dict[str, Optional[Tuple[str, str]]] = {}
+
+    @classmethod
+    def from_taxonomy(cls, synonyms_path: str = SYNONYMS_PATH) -> "EmotionNormalizer":
+        normalizer = cls()
+        canonical = {}
+        for category, data in EMOTIONS.items():
+            for emotion in data["emotions"]:
+                canonical[normalize_text(emotion)] = (emotion, category)
+                normalizer.add(emotion, emotion, category)
+
+        if synonyms_path and os.path.exists(synonyms_path):
+            for target, synonyms in load_synonyms(synonyms_path):
+                match = canonical.get(normalize_text(target))
+                if not match:
+                    logger.warning(f"Unknown emotion in synonyms file: {target}")
+                    continue
+                for synonym in synonyms:
+                    normalizer.add(synonym, *match)
+        return normalizer
+
+    def add(self, text: str, emotion: str, category: str):
+        key = normalize_text(text)
+        if not key:
+            return
+        self.exact.setdefault(key, (emotion, category))
+        self._cache.clear()
+        if " " in key:
+            return
+        key_stem = stem(key)
+        self.stems.setdefault(key_stem, (emotion, category))
+
+        node = self._root
+        for char in key_stem:
+            node = node.children.setdefault(char, _TrieNode())
+        if node.value is None:
+            node.value = (emotion, category)
+
+    def _prefix_match(self, word: str) -> Optional[Tuple[str, str]]:
+        """Longest indexed stem that is a prefix of the word"""
+        node = self._root
+        best = None
+        for depth, char in enumerate(word, 1):
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.value is not None and depth >= MIN_PREFIX:
+                best = node.value
+        return best
+
+    def lookup(self, text: str) -> Optional[Tuple[str, str]]:
+        """(canonical emotion, category) for free text, or None"""
+        # Fast path: most input is a single word that only differs in case
+        match = self.exact.get(text.strip().lower())
+        if match:
+            return match
+
+        # Users repeat themselves a lot; remember slow-path results
+        if text in self._cache:
+            return self._cache[text]
+        match = self._lookup_slow(text)
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[text] = match
+        return match
+
+    def _lookup_slow(self, text: str) -> Optional[Tuple[str, str]]:
+        key = normalize_text(text)
+        if not key:
+            return None
+        match = self.exact.get(key)
+        if match:
+            return match
+
+        words = key.split(" ")
+        negated = next((i for i, word in enumerate(words) if word in NEGATIONS), len(words))
+        for i, word in enumerate(words):
+            match = self.exact.get(word) or self.stems.get(stem(word))
+            if match:
+                return match if i < negated else None
+        for i, word in enumerate(words):
+            match = self._prefix_match(word)
+            if match:
+                return match if i < negated else None
+        return None
+
+
+def load_synonyms(path: str) -> List[Tuple[str, List[str]]]:
+    """Lines of "canonical: synonym, synonym"; # starts a comment"""
+    result = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line or ":" not in line:
+                continue
+            target, _, synonyms = line.partition(":")
+            result.append((target.strip(), [s.strip() for s in synonyms.split(",") if s.strip()]))
+    return result
+
+
+normalizer = EmotionNormalizer.from_taxonomy()
+
+
+def normalize_emotion(text: str, category: Optional[str] = None) -> Tuple[str, Optional[str], Optional[str]]:
+    """Returns (emotion, category, emotion_raw) to store for user input.
+    Entries picked from the taxonomy are kept as is; free text is mapped to a
+    canonical emotion when possible, otherwise just normalized. emotion_raw
+    keeps what the user typed when it differs from the stored emotion."""
+    if category:
+        return text, category, None
+
+    match = normalizer.lookup(text)
+    if match:
+        emotion, category = match
+    else:
+        emotion = normalize_text(text) or text.strip()
+
+    raw = text.strip()
+    return emotion, category, raw if raw != emotion else None
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    from database import db
+
+    parser = argparse.ArgumentParser(description="Re-normalize free-text emotions in existing entries")
+    parser.add_argument("--renormalize", action="store_true", required=True)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def run():
+        await db.connect()
+        try:
+            updated = await db.renormalize_entries(batch_size=args.batch_size)
+            logger.info(f"Re-normalized {updated} entries")
+        finally:
+            await db.disconnect()
+
+    asyncio.run(run())
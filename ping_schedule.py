@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from models import ScheduleSettings
+
+logger = logging.getLogger(__name__)
+
+
+def pick_check_minutes(rng: random.Random, start_hour: int, end_hour: int, count: int) -> List[int]:
+    """Sorted random minutes after start_hour, one per check"""
+    total_minutes = (end_hour - start_hour) * 60
+    if total_minutes <= 0 or count <= 0:
+        return []
+    if total_minutes <= count:
+        return list(range(0, total_minutes, max(1, total_minutes // count)))[:count]
+    return sorted(rng.sample(range(total_minutes), count))
+
+
+def generate_bulk_check_times(user_ids, timezones, start_hours, end_hours, counts,
+                              local_date: date, seed: Optional[int] = None):
+    """Check times for every user on local_date in one NumPy pass.
+
+    Takes the settings table as equal-length arrays and returns a pair of
+    arrays (user_ids, UTC times as datetime64[m]), one element per check,
+    sorted in time within each user. Same rules as pick_check_minutes: a
+    window shorter than checks_per_day gets one check per minute.
+    """
+    import numpy as np
+
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    timezones = np.asarray(timezones, dtype=np.int64)
+    start_hours = np.asarray(start_hours, dtype=np.int64)
+    total = (np.asarray(end_hours, dtype=np.int64) - start_hours) * 60
+    counts = np.clip(np.minimum(np.asarray(counts, dtype=np.int64), total), 0, None)
+
+    width = int(counts.max()) if len(counts) else 0
+    if width == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype="datetime64[m]")
+
+    # Draw `count` sorted offsets from [0, total - count] and add 0, 1, 2...:
+    # the minutes come out strictly increasing and inside [0, total)
+    rng = np.random.default_rng(seed)
+    slots = np.arange(width)
+    used = slots < counts[:, None]
+    offsets = np.floor(rng.random((len(counts), width)) * (total - counts + 1)[:, None]).astype(np.int64)
+    offsets[~used] = total.max()  # sorts after every real offset
+    offsets.sort(axis=1)
+    minutes = offsets + slots
+
+    # Local minute of day -> UTC minute relative to local midnight
+    minutes += (start_hours * 60 - timezones * 60)[:, None]
+    times = np.datetime64(local_date, "m") + minutes[used].astype("timedelta64[m]")
+    return np.repeat(user_ids, counts), times
+
+
+def schedule_seed(user_id: int, local_date: date, settings_version: int) -> int:
+    key = f"{user_id}:{local_date.isoformat()}:{settings_version}".encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+def derive_check_minutes(user_id: int, local_date: date, settings_version: int,
+                         start_hour: int, end_hour: int, count: int) -> List[int]:
+    """Minutes after local midnight at which the user is pinged on local_date.
+    Deterministic: the same inputs always give the same schedule, so nothing
+    has to be stored. Changing settings bumps settings_version and reshuffles."""
+    rng = random.Random(schedule_seed(user_id, local_date, settings_version))
+    return [start_hour * 60 + m for m in pick_check_minutes(rng, start_hour, end_hour, count)]
+
+
+def _user_day_slots(user_id: int, settings: Tuple[int, int, int, int, int],
+                    day: date) -> List[Tuple[int, Tuple[int, date]]]:
+    """(UTC minute of day, (user_id, local_date)) for the user's pings on UTC day"""
+    timezone, start_hour, end_hour, count, version = settings
+    slots = []
+    # A UTC day overlaps the previous, same and next local days
+    for local_date in (day - timedelta(days=1), day, day + timedelta(days=1)):
+        local_midnight = datetime.combine(local_date, datetime.min.time())
+        for minute in derive_check_minutes(user_id, local_date, version, start_hour, end_hour, count):
+            utc_time = local_midnight + timedelta(minutes=minute, hours=-timezone)
+            if utc_time.date() == day:
+                slots.append((utc_time.hour * 60 + utc_time.minute, (user_id, local_date)))
+    return slots
+
+
+def _build_day(users: Dict[int, Tuple[int, int, int, int, int]], day: date):
+    """Buckets and per-user slots of one UTC day for a snapshot of the settings"""
+    buckets: Dict[int, Set[Tuple[int, date]]] = {}
+    slots: Dict[int, List[Tuple[date, int, Tuple[int, date]]]] = {}
+    for user_id, settings in users.items():
+        user_slots = _user_day_slots(user_id, settings, day)
+        for minute, item in user_slots:
+            buckets.setdefault(minute, set()).add(item)
+        slots[user_id] = [(day, minute, item) for minute, item in user_slots]
+    return buckets, slots
+
+
+class PingIndex:
+    """In-memory index of derived ping times: UTC minute -> users due.
+
+    Built from user settings only. A UTC day's buckets take seconds for 100k
+    users, so prepare() builds them in a thread, off the event loop, and the
+    minute job starts on tomorrow's well before midnight. A settings change
+    re-derives just that user's slots.
+    """
+
+    def __init__(self):
+        self.users: Dict[int, Tuple[int, int, int, int, int]] = {}
+        self._days: Dict[date, Dict[int, Set[Tuple[int, date]]]] = {}
+        self._slots: Dict[int, List[Tuple[date, int, Tuple[int, date]]]] = defaultdict(list)
+        self._building: Dict[date, asyncio.Task] = {}
+        self._synced_at: Optional[datetime] = None
+
+    def __len__(self):
+        return len(self.users)
+
+    async def refresh(self, db):
+        """Load all settings on first call, afterwards only users changed since
+        the previous refresh (with overlap, updates are idempotent)"""
+        started = datetime.utcnow()
+        if self._synced_at is None:
+            rows = await db.get_all_users_with_settings()
+            self.users.clear()
+            self._days.clear()
+            self._slots.clear()
+            for task in self._building.values():
+                task.cancel()
+            self._building.clear()
+            for row in rows:
+                self.update(row)
+            logger.info(f"Ping index loaded for {len(rows)} users")
+        else:
+            rows = await db.get_users_with_settings_changed_since(self._synced_at - timedelta(minutes=5))
+            for row in rows:
+                self.update(row)
+        self._synced_at = started
+
+    def update(self, row: ScheduleSettings):
+        user_id = row.user_id
+        settings = (
+            row.timezone, row.check_start_hour, row.check_end_hour,
+            row.checks_per_day, row.settings_version or 0,
+        )
+        if self.users.get(user_id) == settings:
+            return
+        self.remove(user_id)
+        self.users[user_id] = settings
+        for day in self._days:
+            self._add_user_to_day(user_id, day)
+
+    def remove(self, user_id: int):
+        self.users.pop(user_id, None)
+        for day, minute, item in self._slots.pop(user_id, []):
+            bucket = self._days.get(day, {}).get(minute)
+            if bucket:
+                bucket.discard(item)
+
+    def _add_user_to_day(self, user_id: int, day: date):
+        buckets = self._days[day]
+        for minute, item in _user_day_slots(user_id, self.users[user_id], day):
+            buckets.setdefault(minute, set()).add(item)
+            self._slots[user_id].append((day, minute, item))
+
+    def _remove_user_from_day(self, user_id: int, day: date):
+        kept = []
+        for slot in self._slots.get(user_id, []):
+            if slot[0] == day:
+                self._days[day].get(slot[1], set()).discard(slot[2])
+            else:
+                kept.append(slot)
+        self._slots[user_id] = kept
+
+    async def _build(self, day: date):
+        snapshot = dict(self.users)
+        started = time.perf_counter()
+        buckets, slots = await asyncio.to_thread(_build_day, snapshot, day)
+
+        # Keep only the day before this one and later ones around
+        for old in [d for d in self._days if d < day - timedelta(days=1)]:
+            del self._days[old]
+            for user_id in list(self._slots):
+                self._slots[user_id] = [s for s in self._slots[user_id] if s[0] != old]
+        self._days[day] = buckets
+        for user_id, user_slots in slots.items():
+            self._slots[user_id].extend(user_slots)
+
+        # Settings that changed while the thread was running
+        for user_id in snapshot.keys() | self.users.keys():
+            if snapshot.get(user_id) != self.users.get(user_id):
+                self._remove_user_from_day(user_id, day)
+                if user_id in self.users:
+                    self._add_user_to_day(user_id, day)
+        logger.info(f"Ping index built for {day} ({len(snapshot)} users) in {time.perf_counter() - started:.1f}s")
+
+    def build_ahead(self, day: date) -> asyncio.Task:
+        """Start building a UTC day's buckets in the background unless done or running"""
+        task = self._building.get(day)
+        if task is None:
+            task = self._building[day] = asyncio.create_task(self._build(day))
+            task.add_done_callback(lambda _: self._building.pop(day, None))
+        return task
+
+    async def prepare(self, after: datetime, until: datetime):
+        """Make sure the UTC days of (after, until] are built"""
+        for day in {after.date(), until.date()}:
+            if day not in self._days:
+                await asyncio.shield(self.build_ahead(day))
+
+    def due(self, after: datetime, until: datetime) -> List[Tuple[int, date]]:
+        """(user_id, local_date) pairs scheduled in the UTC minutes (after, until];
+        the days must have been built with prepare()"""
+        result = []
+        minute = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        while minute <= until:
+            bucket = self._days.get(minute.date(), {}).get(minute.hour * 60 + minute.minute)
+            if bucket:
+                result.extend(bucket)
+            minute += timedelta(minutes=1)
+        return result
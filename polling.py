@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+from aiogram import Bot
+
+from metrics import metrics
+from update_queue import UpdateQueue
+
+logger = logging.getLogger(__name__)
+
+
+async def poll_updates(
+    bot: Bot,
+    queue: UpdateQueue,
+    limit: int = 100,
+    timeout: int = 30,
+    allowed_updates: Optional[List[str]] = None,
+):
+    """Long-poll getUpdates and hand updates to the queue.
+
+    Unlike Dispatcher.start_polling, processing is delegated to UpdateQueue,
+    so updates are handled concurrently across chats but in order per chat.
+    A full queue blocks the loop, which stops fetching until workers catch up.
+    """
+    offset = None
+    backoff = 1.0
+
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset,
+                limit=limit,
+                timeout=timeout,
+                allowed_updates=allowed_updates,
+                request_timeout=timeout + 10,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to fetch updates: {e}, retrying in {backoff:.0f}s")
+            metrics.inc("polling.errors")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+            continue
+
+        backoff = 1.0
+        metrics.inc("polling.requests")
+        metrics.inc("polling.updates", len(updates))
+
+        for update in updates:
+            await queue.put(update)
+            offset = update.update_id + 1
@@ -0,0 +1,52 @@
+"""Sampling profiler for the running event loop.
+
+A helper thread snapshots the loop thread's stack every few milliseconds
+and counts identical stacks. The output is in "collapsed stacks" format
+(frame;frame;frame count), which flamegraph.pl and speedscope read directly.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def _stack(frame) -> str:
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+def sample_thread(thread_id: int, seconds: float, interval: float = 0.005) -> Counter:
+    """Collapsed stacks of thread_id sampled for `seconds`; blocks the caller"""
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[_stack(frame)] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def render_collapsed(stacks: Counter, seconds: float, interval: float) -> str:
+    total = sum(stacks.values())
+    lines = [f"# {total} samples over {seconds:g} s, every {interval * 1000:g} ms"]
+    lines.extend(f"{stack} {count}" for stack, count in stacks.most_common())
+    return "\n".join(lines) + "\n"
+
+
+_running = threading.Lock()
+
+
+def profile_loop_thread(thread_id: int, seconds: float, interval: float = 0.005) -> str:
+    """Run one profile at a time; raises RuntimeError if one is in progress"""
+    if not _running.acquire(blocking=False):
+        raise RuntimeError("profile already running")
+    try:
+        return render_collapsed(sample_thread(thread_id, seconds, interval), seconds, interval)
+    finally:
+        _running.release()
@@ -0,0 +1,111 @@
+"""Cluster free-text reasons ("что поспособствовало") per user.
+
+Reasons are tokenized into stemmed words, turned into MinHash signatures
+and greedily assigned to the user's most similar cluster. The batch job
+only touches entries that have no cluster yet, so it is incremental.
+Weekly summaries then group by cluster id instead of by raw text.
+"""
+import logging
+import random
+import zlib
+from typing import Dict, List, Optional, Set
+
+from normalization import normalize_text, stem
+
+logger = logging.getLogger(__name__)
+
+NUM_HASHES = 32
+# Estimated Jaccard similarity needed to join an existing cluster
+SIMILARITY_THRESHOLD = 0.4
+_PRIME = 2 ** 31 - 1  # keeps every component inside a Postgres INTEGER
+
+_rng = random.Random(20240601)
+_COEFFICIENTS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_HASHES)]
+
+STOPWORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "не", "что", "я", "меня", "мне", "мной", "у", "к", "ко",
+    "о", "об", "из", "за", "от", "а", "но", "это", "очень", "был", "была", "было", "были", "так",
+    "как", "то", "же", "ли", "бы", "просто", "опять", "снова", "еще", "уже", "весь", "все", "всё",
+    "мой", "моя", "мое", "мои", "моего", "моей", "его", "ее", "их", "он", "она", "они", "мы", "вы",
+    "ты", "там", "тут", "до", "после", "при", "для", "про", "из-за", "потому", "сегодня", "вчера",
+}
+
+
+def tokenize(reason: str) -> Set[str]:
+    words = normalize_text(reason).split(" ")
+    tokens = {stem(w) for w in words if w and w not in STOPWORDS}
+    if not tokens:
+        # Only stopwords: fall back to the whole text as one token
+        tokens = {normalize_text(reason)}
+    return tokens
+
+
+def signature(reason: str) -> List[int]:
+    """MinHash signature of the reason's token set"""
+    hashes = [zlib.crc32(token.encode()) for token in tokenize(reason)]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _COEFFICIENTS]
+
+
+def similarity(sig_a: List[int], sig_b: List[int]) -> float:
+    """Estimated Jaccard similarity of two signatures"""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / NUM_HASHES
+
+
+class UserClusters:
+    """A user's clusters; new ones get negative temporary ids until saved"""
+
+    def __init__(self, user_id: int, rows: List[Dict]):
+        self.user_id = user_id
+        self.clusters: Dict[int, Dict] = {row['id']: dict(row) for row in rows}
+        self._next_temp_id = -1
+
+    def assign(self, reason: str, sig: List[int]) -> int:
+        best_id: Optional[int] = None
+        best = SIMILARITY_THRESHOLD
+        for cluster_id, cluster in self.clusters.items():
+            score = similarity(sig, cluster['signature'])
+            if score >= best:
+                best_id, best = cluster_id, score
+
+        if best_id is None:
+            best_id = self._next_temp_id
+            self._next_temp_id -= 1
+            self.clusters[best_id] = {
+                "id": best_id, "label": reason.strip()[:60], "signature": sig, "entries_count": 0,
+            }
+
+        self.clusters[best_id]['entries_count'] += 1
+        self.clusters[best_id]['changed'] = True
+        return best_id
+
+
+async def cluster_new_reasons(db, batch_size: int = 2000) -> int:
+    """Assign clusters to every entry with a reason but no cluster yet.
+    Returns the number of entries clustered."""
+    total = 0
+    last_id = 0
+    while True:
+        rows = await db.get_unclustered_reasons(after_id=last_id, limit=batch_size)
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+
+        user_ids = sorted({row['user_id'] for row in rows})
+        existing = await db.get_reason_clusters(user_ids)
+        users = {
+            user_id: UserClusters(user_id, [c for c in existing if c['user_id'] == user_id])
+            for user_id in user_ids
+        }
+
+        assignments = []
+        for row in rows:
+            sig = signature(row['reason'])
+            cluster_id = users[row['user_id']].assign(row['reason'], sig)
+            assignments.append((row['id'], row['user_id'], cluster_id, sig))
+
+        await db.save_reason_clusters(list(users.values()), assignments)
+        total += len(rows)
+
+    if total:
+        logger.info(f"Clustered {total} reasons")
+    return total
@@ -0,0 +1,119 @@
+"""Move users between shards after the shard list changes.
+
+    python rebalance.py --from postgresql://.../a,postgresql://.../b \
+                        --to postgresql://.../a,postgresql://.../b,postgresql://.../c [--dry-run]
+
+Offline tool: stop the bot first and let its entry spool drain. Every user
+on an old shard whose owner under the new list (sharding.shard_index) is a
+different database is copied to it in one transaction and then deleted
+from the source in another. If the tool stops in between, the next run
+finds the user on both databases, skips the copy and finishes the delete.
+
+Row ids are not copied, since every database has its own sequences. The
+copies get new ids, and entries.reason_cluster_id is remapped to the new
+ids of the user's clusters.
+"""
+import argparse
+import asyncio
+from typing import Dict, List
+
+from database import USER_DATA_TABLES, Database
+from sharding import shard_index
+
+# Besides USER_DATA_TABLES; has no foreign key, so it is copied and deleted last
+EXTRA_TABLES = ["deletion_requests"]
+
+
+async def copy_user(source, target, user_id: int):
+    async with source.acquire() as src:
+        rows = {
+            table: await src.fetch(f"SELECT * FROM {table} WHERE user_id = $1", user_id)
+            for table in [table for table, _ in USER_DATA_TABLES] + EXTRA_TABLES
+        }
+
+    async with target.acquire() as dst:
+        async with dst.transaction():
+            if await dst.fetchval("SELECT 1 FROM users WHERE user_id = $1", user_id):
+                return False
+
+            # Parents first: the reverse of the deletion order
+            clusters: Dict[int, int] = {}
+            for table in ["users", "reason_clusters"] + [
+                table for table, _ in USER_DATA_TABLES if table not in ("users", "reason_clusters")
+            ] + EXTRA_TABLES:
+                records = rows[table]
+                if not records:
+                    continue
+                names = [name for name in records[0].keys() if name != "id"]
+                if table == "reason_clusters":
+                    for record in records:
+                        clusters[record["id"]] = await dst.fetchval(
+                            f"""INSERT INTO reason_clusters ({", ".join(names)})
+                                VALUES ({", ".join(f"${i}" for i in range(1, len(names) + 1))})
+                                RETURNING id""",
+                            *[record[name] for name in names]
+                        )
+                    continue
+                values = [[record[name] for name in names] for record in records]
+                if table == "entries":
+                    cluster = names.index("reason_cluster_id")
+                    for value in values:
+                        value[cluster] = clusters.get(value[cluster])
+                await dst.copy_records_to_table(table, records=values, columns=names)
+    return True
+
+
+async def delete_user(source, user_id: int):
+    async with source.acquire() as src:
+        async with src.transaction():
+            for table in [table for table, _ in USER_DATA_TABLES] + EXTRA_TABLES:
+                await src.execute(f"DELETE FROM {table} WHERE user_id = $1", user_id)
+
+
+async def rebalance(old: List[str], new: List[str], dry_run: bool = False, page: int = 1000):
+    # One Database per DSN, also when it appears in both lists
+    databases: Dict[str, Database] = {dsn: Database(dsn, replica_dsn=None) for dsn in old + new}
+    for database in databases.values():
+        await database.connect()
+
+    try:
+        moves: Dict[tuple, int] = {}
+        for source_dsn in dict.fromkeys(old):
+            source = databases[source_dsn]
+            after_id = 0
+            while True:
+                user_ids = await source.get_user_ids_page(after_id, page)
+                if not user_ids:
+                    break
+                after_id = user_ids[-1]
+                for user_id in user_ids:
+                    target_dsn = new[shard_index(user_id, len(new))]
+                    if target_dsn == source_dsn:
+                        continue
+                    moves[(source_dsn, target_dsn)] = moves.get((source_dsn, target_dsn), 0) + 1
+                    if dry_run:
+                        continue
+                    await copy_user(source.pool, databases[target_dsn].pool, user_id)
+                    await delete_user(source.pool, user_id)
+    finally:
+        for database in databases.values():
+            await database.disconnect()
+
+    for (source_dsn, target_dsn), count in moves.items():
+        print(f"{count:>8} users  {old.index(source_dsn)} -> {new.index(target_dsn)}")
+    print(f"{sum(moves.values())} users {'to move' if dry_run else 'moved'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from", dest="old", required=True, help="current DATABASE_SHARD_URLS")
+    parser.add_argument("--to", dest="new", required=True, help="new DATABASE_SHARD_URLS")
+    parser.add_argument("--dry-run", action="store_true", help="only count the users to move")
+    args = parser.parse_args()
+
+    split = lambda value: [dsn.strip() for dsn in value.split(",") if dsn.strip()]
+    asyncio.run(rebalance(split(args.old), split(args.new), args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from typing import Dict, List, Optional
+
+from emotions import EMOTIONS, CATEGORIES
+
+SPARK = "▁▂▃▄▅▆▇█"
+SHADES = "·░▒▓█"
+
+MONTHS = ["янв", "фев", "мар", "апр", "май", "июн", "июл", "авг", "сен", "окт", "ноя", "дек"]
+
+
+def month_range(today: date):
+    return today.replace(day=1), today
+
+
+def year_range(today: date):
+    """Last 12 calendar months including the current one"""
+    if today.month == 12:
+        start = date(today.year, 1, 1)
+    else:
+        start = date(today.year - 1, today.month + 1, 1)
+    return start, today
+
+
+def _spark(values: List[Optional[float]], low: float = 0, high: float = 10) -> str:
+    chars = []
+    for value in values:
+        if value is None:
+            chars.append(" ")
+            continue
+        level = int((value - low) / (high - low) * (len(SPARK) - 1) + 0.5)
+        chars.append(SPARK[max(0, min(len(SPARK) - 1, level))])
+    return "".join(chars)
+
+
+def _shade(count: int, peak: int) -> str:
+    if not count or not peak:
+        return SHADES[0]
+    return SHADES[max(1, round(count / peak * (len(SHADES) - 1)))]
+
+
+def _periods(start: date, end: date, by_month: bool) -> List[date]:
+    periods = []
+    current = start
+    while current <= end:
+        key = current.replace(day=1) if by_month else current
+        if not periods or periods[-1] != key:
+            periods.append(key)
+        current += timedelta(days=1)
+    return periods
+
+
+def build_report(rows: List[Dict], start: date, end: date, by_month: bool = False) -> Dict:
+    """Aggregate daily rollup rows into emotion distribution, average intensity
+    per day (or month) and a category x period heatmap"""
+    emotions = Counter()
+    categories = Counter()
+    intensity = defaultdict(lambda: [0, 0])
+    heatmap = defaultdict(Counter)
+    total = 0
+
+    for row in rows:
+        period = row['local_date'].replace(day=1) if by_month else row['local_date']
+        count = row['entries_count']
+        total += count
+        emotions[row['emotion']] += count
+        intensity[period][0] += row['intensity_sum']
+        intensity[period][1] += row['intensity_count']
+        if row['category']:
+            categories[row['category']] += count
+            heatmap[row['category']][period] += count
+
+    periods = _periods(start, end, by_month)
+    avg_intensity = [
+        round(intensity[p][0] / intensity[p][1], 1) if intensity[p][1] else None
+        for p in periods
+    ]
+    return {
+        "total": total,
+        "periods": periods,
+        "top_emotions": emotions.most_common(5),
+        "top_categories": categories.most_common(),
+        "avg_intensity": avg_intensity,
+        "heatmap": {cat: [heatmap[cat][p] for p in periods] for cat in CATEGORIES if cat in heatmap},
+    }
+
+
+def render_report(report: Dict, title: str, by_month: bool = False) -> str:
+    if not report['total']:
+        return f"*{title}*\n\nЗа этот период записей пока нет."
+
+    text = f"*{title}*\n\nЗаписей: {report['total']}\n\n"
+
+    text += "*Чаще всего:*\n"
+    for emotion, count in report['top_emotions']:
+        share = round(count / report['total'] * 100)
+        text += f"{emotion} — {count} ({share}%)\n"
+
+    known = [v for v in report['avg_intensity'] if v is not None]
+    if known:
+        label = "по месяцам" if by_month else "по дням"
+        text += f"\n*Средняя интенсивность {label}:*\n"
+        text += f"`{_spark(report['avg_intensity'])}`\n"
+        text += f"от {min(known)} до {max(known)} из 10\n"
+
+    if report['heatmap']:
+        peak = max(max(values) for values in report['heatmap'].values())
+        if by_month:
+            header = " ".join(MONTHS[p.month - 1][0] for p in report['periods'])
+        else:
+            header = "".join(str(p.day % 10) for p in report['periods'])
+        text += "\n*Категории:*\n"
+        text += f"🗓 `{header}`\n"
+        sep = " " if by_month else ""
+        for category, values in report['heatmap'].items():
+            cells = sep.join(_shade(v, peak) for v in values)
+            text += f"{EMOTIONS[category]['emoji']} `{cells}`\n"
+
+    return text
@@ -0,0 +1,69 @@
+"""Cache of rendered stats and diary screens.
+
+Keys are (user_id, view, page, entries_version). Database bumps a user's
+entries_version on every write, so a new entry makes all of the user's
+older keys unreachable without any lookup or delete; they age out of the
+LRU. Entries are bounded by their total size in bytes, not their count.
+
+The version counter lives in process memory. With several replicas a write
+on one of them is not seen by the others, so entries also expire after
+RESPONSE_CACHE_TTL seconds.
+
+charts.py reuses ResponseCache for chart images with its own sizeof.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+
+from config import RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL
+from metrics import metrics
+
+Response = Tuple[str, InlineKeyboardMarkup]
+
+
+def response_size(response: Response) -> int:
+    text, keyboard = response
+    return len(text.encode()) + len(keyboard.model_dump_json(exclude_none=True))
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_BYTES, ttl: float = RESPONSE_CACHE_TTL,
+                 name: str = "response_cache", sizeof: Callable[[Any], int] = response_size):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.name = name
+        self.sizeof = sizeof
+        # key -> (response, size, stored_at)
+        self.items: "OrderedDict[Hashable, Tuple[Any, int, float]]" = OrderedDict()
+        self.size = 0
+
+        metrics.gauge(f"{name}.bytes", lambda: self.size)
+        metrics.gauge(f"{name}.entries", lambda: len(self.items))
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self.items.get(key)
+        if item is None or time.monotonic() - item[2] > self.ttl:
+            metrics.inc(f"{self.name}.misses")
+            return None
+        self.items.move_to_end(key)
+        metrics.inc(f"{self.name}.hits")
+        return item[0]
+
+    def put(self, key: Hashable, response: Any):
+        if self.max_bytes <= 0:
+            return
+        size = self.sizeof(response)
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.items[key] = (response, size, time.monotonic())
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted, _) = self.items.popitem(last=False)
+            self.size -= evicted
+            metrics.inc(f"{self.name}.evictions")
+
+
+response_cache = ResponseCache()
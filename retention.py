@@ -0,0 +1,113 @@
+"""Account deletion (/delete_me) and data retention.
+
+Both delete in batches of DELETE_BATCH_SIZE rows in primary key order,
+each batch its own short statement, with DELETE_BATCH_PAUSE seconds in
+between, so a heavy user or a large backlog never holds locks for long.
+Batches skip rows locked by the minute poll on scheduled_checks instead
+of waiting for them; anything left behind is picked up on the next run.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from config import DELETE_BATCH_PAUSE, DELETE_BATCH_SIZE, RETENTION_CHECKS_DAYS, RETENTION_ENTRIES_DAYS
+from database import USER_DATA_TABLES
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# (table, condition on $3 = cutoff, retention in days)
+RETENTION_RULES = [
+    ("scheduled_checks", "sent AND scheduled_time < $3", RETENTION_CHECKS_DAYS),
+    ("entries", "created_at < $3", RETENTION_ENTRIES_DAYS),
+]
+
+
+async def delete_user(db, user_id: int) -> bool:
+    """Remove all of the user's rows, children before the users row"""
+    deleted = 0
+    for table, _ in USER_DATA_TABLES[:-1]:
+        while True:
+            count = await db.delete_user_rows(table, user_id, DELETE_BATCH_SIZE)
+            deleted += count
+            if count == 0:
+                break
+            await asyncio.sleep(DELETE_BATCH_PAUSE)
+
+    finished = await db.finish_deletion(user_id)
+    if finished is None:
+        logger.info(f"Deletion of user {user_id} cancelled after {deleted} rows")
+        return False
+    if not finished:
+        logger.warning(f"Deletion of user {user_id} left rows behind, retrying on the next run")
+        return False
+    metrics.inc("deletions.users")
+    logger.info(f"Deleted user {user_id}: {deleted} rows")
+    return True
+
+
+async def process_deletion_requests(db) -> int:
+    """Carry out pending /delete_me requests, oldest first"""
+    done = 0
+    for user_id in await db.get_deletion_requests():
+        if await delete_user(db, user_id):
+            done += 1
+    return done
+
+
+async def apply_retention(db, now: datetime = None) -> int:
+    """Delete rows older than their table's retention period"""
+    now = now or datetime.utcnow()
+    total = 0
+    for table, condition, days in RETENTION_RULES:
+        if days <= 0:
+            continue
+        cutoff = now - timedelta(days=days)
+        deleted = 0
+        # Ids are per database, so every shard is walked with its own cursor
+        for shard in db.shards:
+            after_id = 0
+            while True:
+                count, after_id = await shard.delete_expired_batch(
+                    table, condition, cutoff, after_id, DELETE_BATCH_SIZE
+                )
+                deleted += count
+                if count < DELETE_BATCH_SIZE:
+                    break
+                await asyncio.sleep(DELETE_BATCH_PAUSE)
+        if deleted:
+            metrics.inc(f"retention.{table}", deleted)
+            logger.info(f"Retention: deleted {deleted} rows from {table} older than {days} days")
+        total += deleted
+
+    if RETENTION_ENTRIES_DAYS > 0:
+        total += await _expire_entry_copies(db, now - timedelta(days=RETENTION_ENTRIES_DAYS))
+    return total
+
+
+async def _expire_entry_copies(db, cutoff: datetime) -> int:
+    """Data derived from expired entries: daily rollup rows before the cutoff
+    date, and reason clusters (whose labels are entry text) left without entries"""
+    rollup = 0
+    clusters = 0
+    for shard in db.shards:
+        while True:
+            count = await shard.delete_expired_rollup_batch(cutoff.date(), DELETE_BATCH_SIZE)
+            rollup += count
+            if count < DELETE_BATCH_SIZE:
+                break
+            await asyncio.sleep(DELETE_BATCH_PAUSE)
+
+        after_id = 0
+        while True:
+            seen, deleted, after_id = await shard.prune_reason_clusters(after_id, DELETE_BATCH_SIZE)
+            clusters += deleted
+            if seen < DELETE_BATCH_SIZE:
+                break
+            await asyncio.sleep(DELETE_BATCH_PAUSE)
+
+    if rollup or clusters:
+        metrics.inc("retention.daily_emotion_rollup", rollup)
+        metrics.inc("retention.reason_clusters", clusters)
+        logger.info(f"Retention: deleted {rollup} rollup rows and {clusters} reason clusters of expired entries")
+    return rollup + clusters
@@ -0,0 +1,177 @@
+"""User-id sharding over several PostgreSQL databases.
+
+ShardedDatabase has the same interface as Database. Per-user methods go to
+the shard that owns the user (jump consistent hash of user_id over
+DATABASE_SHARD_URLS). Methods without a user fan out to every shard
+concurrently, and their results are merged: lists concatenated, counts
+summed, batched writes split by owner.
+
+Jobs that page through a table by its id (reason clustering, retention)
+iterate over db.shards themselves, because ids are per database.
+
+Changing the shard list moves users between databases. Do it with
+rebalance.py while the bot is stopped.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
+
+from database import Database
+from models import EntryColumns
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_MASK = (1 << 64) - 1
+
+
+def shard_index(user_id: int, shards: int) -> int:
+    """Jump consistent hash (Lamping & Veach): going from N to N + 1 shards
+    moves only 1/(N + 1) of the users, all of them to the new shard"""
+    key = user_id & _MASK
+    bucket, jump = -1, 0
+    while jump < shards:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & _MASK
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def _routed(name: str):
+    def method(self, user_id: int, *args, **kwargs):
+        return getattr(self.shard(user_id), name)(user_id, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+class ShardedDatabase:
+    # Methods whose first argument is the user_id
+    PER_USER = [
+        "add_user", "get_user", "update_user_timezone", "complete_onboarding", "update_user_settings",
+        "save_entry", "get_entries", "get_entries_count", "get_emotion_stats", "get_weekly_summary",
+        "get_chart_data", "get_daily_rollup", "get_insights", "save_scheduled_checks",
+        "add_delayed_check", "skip_today_checks", "add_ping_skip", "request_deletion",
+        "cancel_deletion", "finish_deletion", "entries_version", "import_entries", "get_last_entry_id",
+        "get_entries_page",
+    ]
+
+    def __init__(self, dsns: List[str]):
+        self.shards: List[Database] = [Database(dsn, replica_dsn=None) for dsn in dsns]
+        # Replicas are configured for the unsharded setup only
+        self.replica_pool = None
+
+    def shard(self, user_id: int) -> Database:
+        return self.shards[shard_index(user_id, len(self.shards))]
+
+    def _split(self, items: Iterable[T], user_id: Callable[[T], int]) -> Dict[int, List[T]]:
+        parts: Dict[int, List[T]] = defaultdict(list)
+        for item in items:
+            parts[shard_index(user_id(item), len(self.shards))].append(item)
+        return parts
+
+    async def _all(self, name: str, *args, **kwargs) -> list:
+        return await asyncio.gather(*(getattr(shard, name)(*args, **kwargs) for shard in self.shards))
+
+    async def _each(self, name: str, parts: Dict[int, list], *args) -> list:
+        return await asyncio.gather(*(
+            getattr(self.shards[index], name)(part, *args) for index, part in parts.items()
+        ))
+
+    async def connect(self):
+        await asyncio.gather(*(shard.connect() for shard in self.shards))
+
+    async def disconnect(self):
+        await asyncio.gather(*(shard.disconnect() for shard in self.shards))
+
+    async def replica_lag(self) -> Optional[float]:
+        return None
+
+    # === Fan-out reads ===
+
+    async def get_all_users(self):
+        return [user for users in await self._all("get_all_users") for user in users]
+
+    async def get_all_users_with_settings(self):
+        return [row for rows in await self._all("get_all_users_with_settings") for row in rows]
+
+    async def get_users_with_settings_changed_since(self, since: datetime):
+        return [row for rows in await self._all("get_users_with_settings_changed_since", since) for row in rows]
+
+    async def get_and_mark_pending_checks(self, current_time: datetime) -> List[int]:
+        # Checks are marked sent as they are read: one failing shard must not
+        # throw away the users the others have already marked
+        results = await asyncio.gather(
+            *(shard.get_and_mark_pending_checks(current_time) for shard in self.shards), return_exceptions=True
+        )
+        user_ids = []
+        for index, result in enumerate(results):
+            if isinstance(result, Exception):
+                logger.error(f"Pending checks of shard {index} failed: {result}")
+                continue
+            user_ids.extend(result)
+        return user_ids
+
+    async def get_skipped_users(self, due: List[Tuple[int, date]]) -> Set[int]:
+        parts = self._split(due, lambda item: item[0])
+        return set().union(*await self._each("get_skipped_users", parts))
+
+    async def get_deletion_requests(self, limit: int = 10) -> List[int]:
+        return [user_id for ids in await self._all("get_deletion_requests", limit) for user_id in ids]
+
+    async def get_user_ids_page(self, after_id: int, limit: int) -> List[int]:
+        # Each shard's page is sorted, so the first `limit` of the merge is the global page
+        pages = await self._all("get_user_ids_page", after_id, limit)
+        return sorted(user_id for ids in pages for user_id in ids)[:limit]
+
+    async def get_entry_columns(self, user_ids: List[int], since: datetime) -> EntryColumns:
+        parts = await self._each("get_entry_columns", self._split(user_ids, lambda user_id: user_id), since)
+        return EntryColumns._make([value for part in parts for value in column] for column in zip(*parts))
+
+    async def rollup_needs_backfill(self) -> bool:
+        return any(await self._all("rollup_needs_backfill"))
+
+    # === Fan-out writes ===
+
+    async def save_entries_bulk(self, entries: List[Dict]) -> int:
+        return sum(await self._each("save_entries_bulk", self._split(entries, lambda entry: entry['user_id'])))
+
+    async def replace_pending_checks(self, records: List[Tuple[int, datetime]],
+                                     user_ids: Optional[List[int]] = None) -> int:
+        parts = self._split(records, lambda record: record[0])
+        if user_ids is None:
+            # Every shard replaces all of its unsent checks, even with no new ones
+            return sum(await asyncio.gather(*(
+                shard.replace_pending_checks(parts.get(index, [])) for index, shard in enumerate(self.shards)
+            )))
+        owners = self._split(user_ids, lambda user_id: user_id)
+        return sum(await asyncio.gather(*(
+            self.shards[index].replace_pending_checks(parts.get(index, []), ids) for index, ids in owners.items()
+        )))
+
+    async def save_insights(self, rows):
+        await self._each("save_insights", self._split(rows, lambda row: row[0]))
+
+    async def clear_all_pending_checks(self) -> int:
+        return sum(await self._all("clear_all_pending_checks"))
+
+    async def delete_old_ping_skips(self, before: date):
+        await self._all("delete_old_ping_skips", before)
+
+    async def backfill_daily_rollup(self, user_ids: List[int] = None, batch_size: int = 500) -> int:
+        if user_ids is None:
+            return sum(await self._all("backfill_daily_rollup", None, batch_size))
+        parts = self._split(user_ids, lambda user_id: user_id)
+        return sum(await self._each("backfill_daily_rollup", parts, batch_size))
+
+    async def renormalize_entries(self, batch_size: int = 1000) -> int:
+        return sum(await self._all("renormalize_entries", batch_size))
+
+    async def delete_user_rows(self, table: str, user_id: int, limit: int) -> int:
+        return await self.shard(user_id).delete_user_rows(table, user_id, limit)
+
+
+for _name in ShardedDatabase.PER_USER:
+    setattr(ShardedDatabase, _name, _routed(_name))
@@ -0,0 +1,243 @@
+"""Keep emotion entries when the database is down or slow.
+
+EntryWriter saves through a circuit breaker. If the save fails, times out
+or the breaker is open, the entry goes to an append-only local spool file
+(length-prefixed JSON records, fsync'd) and the user still gets "Записано!".
+A periodic job replays the spool in bulk once the database answers again.
+Every entry carries an idempotency key, so a save that timed out but did
+commit is not duplicated by the replay.
+
+Only failures that say the database is unreachable or overloaded
+(TRANSIENT_ERRORS) count against the breaker and spool the entry. An error
+the database answers with, like a constraint violation, would fail the same
+way on replay: save() raises EntryRejected instead, and a spooled record
+that the database rejects is moved to a `.rejected` file so it cannot block
+the rest of the spool.
+"""
+import asyncio
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import asyncpg
+
+from config import DB_BREAKER_FAILURES, DB_BREAKER_RESET, DB_SAVE_TIMEOUT, ENTRY_SPOOL_PATH
+from database import db
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct(">I")
+
+# The database could not be reached or is overloaded; anything else is an
+# answer about the entry itself and is not retried
+TRANSIENT_ERRORS = (
+    asyncio.TimeoutError,
+    OSError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.TooManyConnectionsError,
+    asyncpg.InterfaceError,
+)
+
+
+class EntryRejected(Exception):
+    """The database refused the entry; it was neither saved nor spooled"""
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive errors. While open, calls are refused;
+    every `reset_timeout` seconds one trial call is let through (half-open),
+    and a success closes the breaker again."""
+
+    def __init__(self, failures: int = 3, reset_timeout: float = 30.0):
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "half_open":
+            # Let exactly one trial through until it reports back
+            self.opened_at = time.monotonic()
+        return state != "open"
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info("Database circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            if self.opened_at is None:
+                logger.error(f"Database circuit breaker opened after {self.failures} failures")
+                metrics.inc("db_breaker_opened")
+            self.opened_at = time.monotonic()
+
+
+class EntrySpool:
+    """Append-only file of 4-byte length-prefixed JSON records.
+
+    Replay moves the file aside first (`take`), so new entries keep going to
+    a fresh file while the old one is written to the database.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.replay_path = path + ".replay"
+        self.rejected_path = path + ".rejected"
+        self._lock = threading.Lock()
+
+    def append(self, record: Dict, path: Optional[str] = None):
+        data = json.dumps(record, ensure_ascii=False, default=str).encode()
+        with self._lock, open(path or self.path, "ab") as f:
+            f.write(_HEADER.pack(len(data)) + data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def reject(self, record: Dict):
+        """Keep a record the database refused, for a person to look at"""
+        self.append(record, self.rejected_path)
+
+    def take(self) -> Optional[str]:
+        """Path of the file to replay: a leftover from a failed replay, or the
+        current spool moved aside. None if there is nothing to replay."""
+        with self._lock:
+            if os.path.exists(self.replay_path):
+                return self.replay_path
+            if os.path.exists(self.path) and os.path.getsize(self.path):
+                os.replace(self.path, self.replay_path)
+                return self.replay_path
+        return None
+
+    def size(self) -> int:
+        return sum(os.path.getsize(p) for p in (self.path, self.replay_path) if os.path.exists(p))
+
+    @staticmethod
+    def read(path: str) -> List[Dict]:
+        records = []
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            (length,) = _HEADER.unpack_from(data, offset)
+            offset += _HEADER.size
+            if offset + length > len(data):
+                break
+            records.append(json.loads(data[offset:offset + length]))
+            offset += length
+        if offset != len(data):
+            # Crash in the middle of an append: that entry was never acknowledged
+            logger.warning(f"Ignoring truncated record at the end of {path}")
+        return records
+
+
+class EntryWriter:
+    def __init__(self, database, spool: EntrySpool, breaker: CircuitBreaker, timeout: float):
+        self.db = database
+        self.spool = spool
+        self.breaker = breaker
+        self.timeout = timeout
+
+        metrics.gauge("spool.bytes", self.spool.size)
+        metrics.gauge("db_breaker.open", lambda: int(self.breaker.state != "closed"))
+
+    async def save(self, user_id: int, **fields) -> bool:
+        """Save an entry; True if it reached the database, False if spooled.
+        Raises EntryRejected if the database refused it."""
+        entry = dict(fields, user_id=user_id, created_at=datetime.now(), idempotency_key=uuid.uuid4().hex)
+        if self.breaker.allow():
+            try:
+                await asyncio.wait_for(self.db.save_entry(**entry), timeout=self.timeout)
+                self.breaker.success()
+                return True
+            except TRANSIENT_ERRORS as e:
+                self.breaker.failure()
+                logger.warning(f"Spooling entry for user {user_id}: {type(e).__name__}: {e}")
+            except Exception as e:
+                # The database answered, so it is up; spooling would only hide the error
+                self.breaker.success()
+                metrics.inc("spool.rejected")
+                logger.error(f"Entry of user {user_id} rejected: {type(e).__name__}: {e}")
+                raise EntryRejected(str(e)) from e
+
+        await asyncio.to_thread(self.spool.append, entry)
+        metrics.inc("spool.appended")
+        return False
+
+    async def replay(self, batch_size: int = 500) -> int:
+        """Write spooled entries to the database; returns how many were inserted"""
+        path = await asyncio.to_thread(self.spool.take)
+        if path is None or not self.breaker.allow():
+            return 0
+
+        records = []
+        for record in await asyncio.to_thread(EntrySpool.read, path):
+            try:
+                record['created_at'] = datetime.fromisoformat(record['created_at'])
+            except (KeyError, TypeError, ValueError) as e:
+                await self._reject(record, e)
+                continue
+            records.append(record)
+
+        inserted = 0
+        try:
+            for i in range(0, len(records), batch_size):
+                inserted += await self._write_batch(records[i:i + batch_size])
+        except TRANSIENT_ERRORS as e:
+            # The file stays; already written batches are skipped next time
+            self.breaker.failure()
+            logger.error(f"Spool replay failed after {inserted} entries: {type(e).__name__}: {e}")
+            return inserted
+
+        self.breaker.success()
+        os.remove(path)
+        metrics.inc("spool.replayed", inserted)
+        logger.info(f"Replayed {len(records)} spooled entries, {inserted} new")
+        return inserted
+
+    async def _write_batch(self, batch: List[Dict]) -> int:
+        """save_entries_bulk, splitting the batch in halves on a non-transient
+        error until the records the database refuses are found and set aside"""
+        try:
+            return await self.db.save_entries_bulk(batch)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            if len(batch) == 1:
+                await self._reject(batch[0], e)
+                return 0
+            middle = len(batch) // 2
+            return await self._write_batch(batch[:middle]) + await self._write_batch(batch[middle:])
+
+    async def _reject(self, record: Dict, error: Exception):
+        await asyncio.to_thread(self.spool.reject, record)
+        metrics.inc("spool.rejected")
+        logger.error(
+            f"Spooled entry {record.get('idempotency_key')} of user {record.get('user_id')} rejected, "
+            f"moved to {self.spool.rejected_path}: {type(error).__name__}: {error}"
+        )
+
+
+entry_writer = EntryWriter(
+    db,
+    EntrySpool(ENTRY_SPOOL_PATH),
+    CircuitBreaker(DB_BREAKER_FAILURES, DB_BREAKER_RESET),
+    DB_SAVE_TIMEOUT,
+)
@@ -0,0 +1,250 @@
+"""Supervisor mode: one front process, BOT_WORKERS worker processes.
+
+The front process only terminates HTTP. For every webhook request it reads
+the chat id from the raw JSON and forwards the body unchanged to worker
+`chat_id % BOT_WORKERS` over that worker's unix socket. A chat always lands
+on the same worker, so its FSM state (MemoryStorage), throttling bucket and
+response cache entries stay valid in that process, while different chats
+are handled on different cores.
+
+Frames are a kind byte and a 4-byte length, followed by the payload:
+
+    U <update JSON>   ->  b"1" queued, b"0" queue full (the front answers 503)
+    S                 ->  JSON with the worker's health and metrics
+
+Replies come back in request order, so a connection carries any number of
+requests in flight. A worker that dies is restarted; until it is back its
+chats get 503 and Telegram retries them.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import struct
+import tempfile
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, List, Optional
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct(">cI")
+_REPLY = struct.Struct(">I")
+
+KIND_UPDATE = b"U"
+KIND_STATS = b"S"
+
+# Seconds to wait for workers to come up before the webhook is set anyway
+STARTUP_TIMEOUT = 60.0
+
+
+def raw_chat_id(update: dict) -> int:
+    """Same chat as update_queue.update_chat_id(), read from the raw JSON"""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat.get("id", 0)
+        return (event.get("from") or {}).get("id", 0)
+    return 0
+
+
+class WorkerLink:
+    """Front end of the socket to one worker, with pipelined requests"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.pending: Deque[asyncio.Future] = deque()
+        self._connecting = asyncio.Lock()
+        self._reader_task: Optional[asyncio.Task] = None
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        async with self._connecting:
+            if self.connected:
+                return
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+            self._reader_task = asyncio.create_task(self._read_replies(self.reader))
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                (length,) = _REPLY.unpack(await reader.readexactly(_REPLY.size))
+                payload = await reader.readexactly(length)
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_result(payload)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            # Only if nobody has reconnected in the meantime
+            if self.reader is reader:
+                self.close(e)
+
+    async def request(self, kind: bytes, payload: bytes = b"", timeout: float = 10.0) -> bytes:
+        if not self.connected:
+            await self.connect()
+        future = asyncio.get_running_loop().create_future()
+        # No await between queuing the future and writing the frame: replies stay in order
+        self.pending.append(future)
+        self.writer.write(_HEADER.pack(kind, len(payload)) + payload)
+        await self.writer.drain()
+        return await asyncio.wait_for(future, timeout)
+
+    def close(self, error: Exception = None):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(f"Worker connection lost: {error}"))
+
+
+class Supervisor:
+    """Starts the worker processes, restarts the ones that exit and routes updates to them"""
+
+    def __init__(self, target: Callable[[int, str], None], workers: int, request_timeout: float = 10.0):
+        self.target = target
+        self.workers = workers
+        self.request_timeout = request_timeout
+        self.socket_dir = ""
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.links: List[WorkerLink] = []
+        self.restarts = 0
+        self._monitor: Optional[asyncio.Task] = None
+        # spawn: children start clean instead of inheriting the front's event loop and threads
+        self._context = multiprocessing.get_context("spawn")
+
+        metrics.gauge("supervisor.workers_alive", lambda: sum(self.alive()))
+        metrics.gauge("supervisor.restarts", lambda: self.restarts)
+
+    def socket_path(self, index: int) -> str:
+        return os.path.join(self.socket_dir, f"worker-{index}.sock")
+
+    def alive(self) -> List[bool]:
+        return [process is not None and process.is_alive() for process in self.processes]
+
+    def _spawn(self, index: int):
+        path = self.socket_path(index)
+        if os.path.exists(path):
+            os.remove(path)
+        process = self._context.Process(target=self.target, args=(index, path), name=f"bot-worker-{index}")
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    async def start(self):
+        self.socket_dir = tempfile.mkdtemp(prefix="emotion-bot-")
+        self.links = [WorkerLink(self.socket_path(index)) for index in range(self.workers)]
+        for index in range(self.workers):
+            self._spawn(index)
+        # Already watching: a worker that fails during startup is restarted while we wait
+        self._monitor = asyncio.create_task(self._watch())
+
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        waiting = set(range(self.workers))
+        while waiting and time.monotonic() < deadline:
+            for index in list(waiting):
+                try:
+                    await self.links[index].connect()
+                    waiting.discard(index)
+                except OSError:
+                    pass
+            if waiting:
+                await asyncio.sleep(0.2)
+        if waiting:
+            logger.error(f"Workers {sorted(waiting)} not ready after {STARTUP_TIMEOUT:.0f}s")
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, alive in enumerate(self.alive()):
+                if alive:
+                    continue
+                process = self.processes[index]
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                try:
+                    # Whatever the dead worker left running in its group
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.links[index].close()
+                self.restarts += 1
+                self._spawn(index)
+
+    async def forward(self, chat_id: int, body: bytes) -> bool:
+        """Hand a raw update to its chat's worker; False if it could not take it"""
+        index = chat_id % self.workers
+        try:
+            accepted = await self.links[index].request(KIND_UPDATE, body, self.request_timeout) == b"1"
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"Worker {index} unavailable: {e}")
+            accepted = False
+        metrics.inc("supervisor.forwarded" if accepted else "supervisor.rejected")
+        return accepted
+
+    async def stats(self) -> List[Optional[dict]]:
+        async def one(link: WorkerLink) -> Optional[dict]:
+            try:
+                return json.loads(await link.request(KIND_STATS, timeout=5))
+            except (OSError, asyncio.TimeoutError, ValueError):
+                return None
+        return await asyncio.gather(*(one(link) for link in self.links))
+
+    async def stop(self, timeout: float = 15.0):
+        """SIGTERM every worker so it drains its queue, kill the ones that do not exit"""
+        if self._monitor:
+            self._monitor.cancel()
+        for link in self.links:
+            link.close()
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop in {timeout:.0f}s, killing it")
+                # Workers lead their own process group (see bot.run_worker), so this
+                # also takes down the processes they started
+                os.killpg(process.pid, signal.SIGKILL)
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+async def serve_worker(path: str, on_update: Callable[[bytes], Awaitable[bool]],
+                       on_stats: Callable[[], Awaitable[dict]]) -> asyncio.AbstractServer:
+    """Worker end: read frames from the front and reply in order"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                kind, length = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                payload = await reader.readexactly(length)
+                if kind == KIND_UPDATE:
+                    try:
+                        reply = b"1" if await on_update(payload) else b"0"
+                    except Exception as e:
+                        logger.error(f"Failed to accept forwarded update: {e}")
+                        reply = b"0"
+                else:
+                    reply = json.dumps(await on_stats(), default=str).encode()
+                writer.write(_REPLY.pack(len(reply)) + reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_unix_server(handle, path)
@@ -0,0 +1,98 @@
+"""Bot API client session tuned for bursts of outgoing messages.
+
+Ping waves and weekly summaries send many messages at once, so the
+connector keeps a larger pool of keep-alive connections and caches DNS.
+TELEGRAM_API_URL points the bot at a self-hosted telegram-bot-api server.
+"""
+import asyncio
+import logging
+import ssl
+import time
+from typing import Optional
+
+import certifi
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+
+from aiogram import __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+
+from config import (
+    TELEGRAM_API_LOCAL, TELEGRAM_API_URL, TELEGRAM_DNS_TTL, TELEGRAM_KEEPALIVE, TELEGRAM_POOL_SIZE,
+    TELEGRAM_TIMEOUT,
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyMiddleware(BaseRequestMiddleware):
+    """Per-method Bot API latency and error counters for /metrics"""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc(f"telegram.errors.{type(e).__name__}")
+            raise
+        finally:
+            metrics.observe(f"telegram.{name}", time.perf_counter() - started)
+            metrics.inc("telegram.requests")
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """AiohttpSession with keep-alive and DNS cache settings on its connector.
+
+    The parent keeps connector options in a private dict, so the client
+    session is built here instead, from public aiohttp API only.
+    """
+
+    def __init__(self, limit: int, keepalive_timeout: float, ttl_dns_cache: int, **kwargs):
+        super().__init__(limit=limit, **kwargs)
+        # All requests go to one host, so the total limit is the per-host pool size
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self._client: Optional[ClientSession] = None
+
+    async def create_session(self) -> ClientSession:
+        if self._client is None or self._client.closed:
+            self._client = ClientSession(
+                connector=TCPConnector(
+                    ssl=ssl.create_default_context(cafile=certifi.where()),
+                    limit=self.limit,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=self.ttl_dns_cache,
+                ),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram_version}"},
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+            # Give the SSL connections time to close, as AiohttpSession.close does
+            await asyncio.sleep(0.25)
+
+
+def create_session() -> AiohttpSession:
+    if TELEGRAM_API_URL:
+        api = TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL)
+        logger.info(f"Using Bot API server at {TELEGRAM_API_URL}")
+    else:
+        api = PRODUCTION
+
+    session = TunedAiohttpSession(
+        api=api,
+        limit=TELEGRAM_POOL_SIZE,
+        keepalive_timeout=TELEGRAM_KEEPALIVE,
+        ttl_dns_cache=TELEGRAM_DNS_TTL,
+        timeout=TELEGRAM_TIMEOUT,
+    )
+    session.middleware(LatencyMiddleware())
+    return session
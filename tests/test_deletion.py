@@ -0,0 +1,56 @@
+"""Needs a disposable PostgreSQL database in DATABASE_URL; skipped without one."""
+import os
+import unittest
+
+from database import Database
+from retention import process_deletion_requests
+
+USER_ID = 9_300_000_001
+
+
+@unittest.skipUnless(os.getenv("DATABASE_URL"), "DATABASE_URL is not set")
+class DeletionTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = Database(os.environ["DATABASE_URL"], replica_dsn=None)
+        await self.db.connect()
+        await self._cleanup()
+        await self.db.add_user(USER_ID)
+        await self.db.update_user_settings(USER_ID, 9, 22, 5)
+        await self.db.save_entry(USER_ID, "тревога", intensity=6)
+
+    async def asyncTearDown(self):
+        await self._cleanup()
+        await self.db.disconnect()
+
+    async def _cleanup(self):
+        async with self.db.pool.acquire() as conn:
+            for table in ["deletion_requests", "scheduled_checks", "daily_emotion_rollup", "entries", "users"]:
+                await conn.execute(f"DELETE FROM {table} WHERE user_id = $1", USER_ID)
+
+    async def test_start_cancels_pending_deletion(self):
+        before = await self.db.get_user(USER_ID)
+        await self.db.request_deletion(USER_ID)
+        self.assertEqual((await self.db.get_user(USER_ID)).checks_per_day, 0)
+
+        self.assertEqual(await self.db.cancel_deletion(USER_ID), 5)
+        await self.db.save_entry(USER_ID, "радость")
+        await process_deletion_requests(self.db)
+
+        user = await self.db.get_user(USER_ID)
+        self.assertIsNotNone(user)
+        self.assertEqual(user.checks_per_day, 5)
+        self.assertGreater(user.settings_version, before.settings_version + 1)
+        self.assertEqual(await self.db.get_entries_count(USER_ID), 2)
+        self.assertIsNone(await self.db.cancel_deletion(USER_ID))
+
+    async def test_cancel_during_deletion_keeps_user(self):
+        await self.db.request_deletion(USER_ID)
+        await self.db.cancel_deletion(USER_ID)
+        self.assertEqual(await self.db.delete_user_rows("entries", USER_ID, 100), 0)
+        self.assertIsNone(await self.db.finish_deletion(USER_ID))
+        self.assertIsNotNone(await self.db.get_user(USER_ID))
+
+    async def test_deletion_without_cancel_removes_user(self):
+        await self.db.request_deletion(USER_ID)
+        self.assertEqual(await process_deletion_requests(self.db), 1)
+        self.assertIsNone(await self.db.get_user(USER_ID))
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import asyncpg
+
+from spool import CircuitBreaker, EntryRejected, EntrySpool, EntryWriter
+
+
+class FakeDatabase:
+    def __init__(self, error=None, poisoned_users=()):
+        self.error = error
+        self.poisoned_users = set(poisoned_users)
+        self.saved = []
+
+    async def save_entry(self, **entry):
+        if self.error:
+            raise self.error
+        self.saved.append(entry)
+
+    async def save_entries_bulk(self, entries):
+        if any(entry["user_id"] in self.poisoned_users for entry in entries):
+            raise asyncpg.ForeignKeyViolationError("entries_user_id_fkey")
+        self.saved.extend(entries)
+        return len(entries)
+
+
+class EntryWriterTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.spool = EntrySpool(os.path.join(self.dir.name, "spool.bin"))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def writer(self, database):
+        return EntryWriter(database, self.spool, CircuitBreaker(failures=3, reset_timeout=60), timeout=1)
+
+    async def test_rejected_entry_is_not_spooled_and_keeps_breaker_closed(self):
+        writer = self.writer(FakeDatabase(asyncpg.ForeignKeyViolationError("entries_user_id_fkey")))
+        for _ in range(3):
+            with self.assertRaises(EntryRejected):
+                await writer.save(1, emotion="тревога")
+        self.assertEqual(self.spool.size(), 0)
+        self.assertEqual(writer.breaker.state, "closed")
+
+    async def test_transient_error_spools_and_counts_against_breaker(self):
+        writer = self.writer(FakeDatabase(ConnectionRefusedError()))
+        for _ in range(3):
+            self.assertFalse(await writer.save(1, emotion="тревога"))
+        self.assertEqual(len(EntrySpool.read(self.spool.path)), 3)
+        self.assertEqual(writer.breaker.state, "open")
+
+    async def test_timeout_spools(self):
+        class SlowDatabase(FakeDatabase):
+            async def save_entry(self, **entry):
+                await asyncio.sleep(10)
+
+        writer = EntryWriter(SlowDatabase(), self.spool, CircuitBreaker(), timeout=0.01)
+        self.assertFalse(await writer.save(1, emotion="тревога"))
+        self.assertEqual(len(EntrySpool.read(self.spool.path)), 1)
+
+    async def test_replay_sets_rejected_records_aside(self):
+        writer = self.writer(FakeDatabase(ConnectionRefusedError()))
+        for user_id in [1, 2, 666, 3, 4]:
+            await writer.save(user_id, emotion="тревога")
+        writer.breaker.success()
+
+        database = FakeDatabase(poisoned_users=[666])
+        writer.db = database
+        self.assertEqual(await writer.replay(batch_size=4), 4)
+
+        self.assertEqual(sorted(entry["user_id"] for entry in database.saved), [1, 2, 3, 4])
+        self.assertEqual([record["user_id"] for record in EntrySpool.read(self.spool.rejected_path)], [666])
+        self.assertIsNone(self.spool.take())
+        self.assertEqual(writer.breaker.state, "closed")
+
+    async def test_replay_keeps_file_on_transient_error(self):
+        writer = self.writer(FakeDatabase(ConnectionRefusedError()))
+        await writer.save(1, emotion="тревога")
+        writer.breaker.success()
+
+        class DownDatabase(FakeDatabase):
+            async def save_entries_bulk(self, entries):
+                raise ConnectionResetError()
+
+        writer.db = DownDatabase()
+        self.assertEqual(await writer.replay(), 0)
+        self.assertTrue(os.path.exists(self.spool.replay_path))
+        self.assertFalse(os.path.exists(self.spool.rejected_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
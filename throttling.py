@@ -0,0 +1,94 @@
+"""Per-user anti-flood throttling for message and callback handlers.
+
+Every user has a token bucket (THROTTLE_BURST tokens, refilled at
+THROTTLE_RATE per second) kept in a bounded LRU map. A handler costs
+1 token unless it is tagged with a cost class via flags, e.g.
+
+    @dp.callback_query(F.data == "stats", flags={"throttling": "stats"})
+
+and the class is looked up in THROTTLE_COSTS. A user out of tokens gets
+a short notice and the update is dropped before it reaches the database.
+
+Duplicate callbacks are coalesced earlier, in UpdateQueue.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from config import THROTTLE_BURST, THROTTLE_COSTS, THROTTLE_MAX_USERS, THROTTLE_RATE
+from metrics import metrics
+
+THROTTLED_TEXT = "Слишком часто. Подожди пару секунд 🙏"
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.notified = False
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate: float = THROTTLE_RATE, burst: float = THROTTLE_BURST,
+                 costs: Dict[str, float] = THROTTLE_COSTS, max_users: int = THROTTLE_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.costs = costs
+        self.max_users = max_users
+        self.buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+        metrics.gauge("throttle.users", lambda: len(self.buckets))
+
+    def _bucket(self, user_id: int, now: float) -> TokenBucket:
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.burst, now)
+            if len(self.buckets) > self.max_users:
+                # Evicting a user only refills their bucket early
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(user_id)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def cost(self, data: Dict[str, Any]) -> float:
+        cost_class = get_flag(data, "throttling")
+        if cost_class is None:
+            return 1
+        return self.costs.get(cost_class, 1)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        bucket = self._bucket(user.id, time.monotonic())
+        cost = self.cost(data)
+        if bucket.tokens < cost:
+            metrics.inc("throttle.dropped")
+            await self._notify(event, bucket)
+            return None
+        bucket.tokens -= cost
+        bucket.notified = False
+        return await handler(event, data)
+
+    async def _notify(self, event: TelegramObject, bucket: TokenBucket):
+        if isinstance(event, CallbackQuery):
+            # Callbacks must be answered anyway, or the button keeps spinning
+            await event.answer(THROTTLED_TEXT)
+        elif isinstance(event, Message) and not bucket.notified:
+            # One notice per flood, not one per message
+            bucket.notified = True
+            await event.answer(THROTTLED_TEXT)
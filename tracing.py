@@ -0,0 +1,200 @@
+"""Lightweight per-update span tracing.
+
+TracingMiddleware opens a Trace for every update. Spans are recorded by
+wrappers around the FSM storage (TracedStorage), Database methods and pool
+acquisition (instrument_database) and Telegram API calls
+(TelegramTracingMiddleware). Updates slower than SLOW_UPDATE_MS are logged
+to the "slow_updates" logger with their span breakdown and kept for
+/debug/slow.
+"""
+import functools
+import inspect
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.types import TelegramObject, Update
+
+from config import SLOW_UPDATE_MS
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("slow_updates")
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+# Recent slow updates for /debug/slow
+slow_updates: deque = deque(maxlen=100)
+
+
+class Trace:
+    __slots__ = ("update_id", "event_type", "started", "spans", "_depth")
+
+    def __init__(self, update_id: int, event_type: str):
+        self.update_id = update_id
+        self.event_type = event_type
+        self.started = time.perf_counter()
+        self.spans: List[tuple] = []  # (name, seconds, depth)
+        self._depth = 0
+
+    def summary(self, total: float) -> Dict:
+        """Spans aggregated by name; "other" is time outside top-level spans"""
+        by_name: Dict[str, Dict] = {}
+        top_level = 0.0
+        for name, seconds, depth in self.spans:
+            item = by_name.setdefault(name, {"count": 0, "ms": 0.0})
+            item["count"] += 1
+            item["ms"] += seconds * 1000
+            if depth == 0:
+                top_level += seconds
+        spans = {
+            name: {"count": item["count"], "ms": round(item["ms"], 2)}
+            for name, item in sorted(by_name.items(), key=lambda kv: -kv[1]["ms"])
+        }
+        return {
+            "update_id": self.update_id,
+            "event_type": self.event_type,
+            "total_ms": round(total * 1000, 2),
+            "other_ms": round(max(0.0, total - top_level) * 1000, 2),
+            "spans": spans,
+        }
+
+
+@contextmanager
+def span(name: str):
+    """Time a block inside the current update's trace; a no-op outside updates"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    depth = trace._depth
+    trace._depth += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace._depth -= 1
+        trace.spans.append((name, time.perf_counter() - started, depth))
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Outer update middleware: one Trace per update, slow ones are logged"""
+
+    def __init__(self, slow_ms: float = SLOW_UPDATE_MS):
+        self.slow_ms = slow_ms
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        trace = Trace(event.update_id, event.event_type)
+        token = _current.set(trace)
+        try:
+            return await handler(event, data)
+        finally:
+            _current.reset(token)
+            total = time.perf_counter() - trace.started
+            metrics.observe("update.traced", total)
+            if total * 1000 >= self.slow_ms:
+                summary = trace.summary(total)
+                slow_updates.append(summary)
+                metrics.inc("update.slow")
+                # Structured under LOG_FORMAT=json instead of a JSON string inside msg
+                slow_logger.warning(
+                    f"Slow {summary['event_type']} update {summary['update_id']}: {summary['total_ms']} ms",
+                    extra={"trace": summary},
+                )
+
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """Bot session middleware: a span per Bot API call"""
+
+    async def __call__(self, make_request, bot, method):
+        with span(f"telegram.{method.__api_method__}"):
+            return await make_request(bot, method)
+
+
+class TracedStorage(BaseStorage):
+    """FSM storage wrapper with a span per call"""
+
+    def __init__(self, storage: BaseStorage):
+        self.storage = storage
+
+    async def set_state(self, key, state=None) -> None:
+        with span("fsm.set_state"):
+            await self.storage.set_state(key, state)
+
+    async def get_state(self, key):
+        with span("fsm.get_state"):
+            return await self.storage.get_state(key)
+
+    async def set_data(self, key, data) -> None:
+        with span("fsm.set_data"):
+            await self.storage.set_data(key, data)
+
+    async def get_data(self, key):
+        with span("fsm.get_data"):
+            return await self.storage.get_data(key)
+
+    async def update_data(self, key, data):
+        with span("fsm.update_data"):
+            return await self.storage.update_data(key, data)
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+
+class _TracedAcquire:
+    def __init__(self, context, name: str):
+        self._context = context
+        self._name = name
+
+    async def __aenter__(self):
+        with span(self._name):
+            return await self._context.__aenter__()
+
+    async def __aexit__(self, *exc):
+        return await self._context.__aexit__(*exc)
+
+
+class TracedPool:
+    """asyncpg pool proxy timing how long acquire() waits for a connection"""
+
+    def __init__(self, pool, name: str = "db.pool_acquire"):
+        self._pool = pool
+        self._name = name
+
+    def acquire(self, *args, **kwargs):
+        return _TracedAcquire(self._pool.acquire(*args, **kwargs), self._name)
+
+    def __getattr__(self, item):
+        return getattr(self._pool, item)
+
+
+def _traced(fn, name: str):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with span(name):
+            return await fn(*args, **kwargs)
+    return wrapper
+
+
+def instrument_database(database):
+    """Wrap public Database coroutines and its pools. Call after connect()."""
+    if getattr(database, "_traced", False):
+        return
+    for name, member in inspect.getmembers(type(database), inspect.iscoroutinefunction):
+        if not name.startswith("_"):
+            setattr(database, name, _traced(getattr(database, name), f"db.{name}"))
+    database.pool = TracedPool(database.pool)
+    if database.replica_pool:
+        database.replica_pool = TracedPool(database.replica_pool, "db.replica_pool_acquire")
+    database._traced = True
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional, Set, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update: Update) -> int:
+    """Chat (or user) an update belongs to; used to keep per-chat ordering"""
+    try:
+        event = update.event
+    except Exception:
+        return 0
+
+    chat = getattr(event, "chat", None)
+    if chat is None:
+        chat = getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+
+    user = getattr(event, "from_user", None)
+    return user.id if user else 0
+
+
+def callback_key(update: Update) -> Optional[Tuple]:
+    """(user, message, data) of a callback query update, None for other updates"""
+    callback = update.callback_query
+    if callback is None:
+        return None
+    return callback.from_user.id, callback.message.message_id if callback.message else None, callback.data
+
+
+class UpdateQueue:
+    """Bounded update queue drained by a pool of workers.
+
+    Updates are split into lanes by chat id and every lane is served by a
+    single worker, so updates from one chat are processed in order while
+    different chats are processed concurrently.
+
+    A callback identical to one still queued or being handled (same user,
+    message and data, e.g. a double tap on a button) is not queued again:
+    it is only answered, so the button stops spinning.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int = 8, maxsize: int = 100, **data):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.data = data
+        self.lanes: List[asyncio.Queue] = [asyncio.Queue(maxsize=maxsize) for _ in range(workers)]
+        self._tasks: List[asyncio.Task] = []
+        self.pending_callbacks: Set[Tuple] = set()
+        self._answers: Set[asyncio.Task] = set()
+
+        metrics.gauge("update_queue.depth", self.depth)
+        metrics.gauge("update_queue.max_lane_depth", lambda: max(q.qsize() for q in self.lanes))
+        metrics.gauge("update_queue.capacity", lambda: maxsize * workers)
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.lanes)
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(lane)) for lane in self.lanes]
+        logger.info(f"Update queue started with {len(self.lanes)} workers")
+
+    async def stop(self, timeout: float = 10):
+        """Let workers drain what is already queued, then cancel them"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.lanes)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Update queue stopped with {self.depth()} updates left")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def put(self, update: Update, timeout: Optional[float] = None) -> bool:
+        """Enqueue an update. Waits up to `timeout` seconds for room in a full
+        lane (None = wait forever) and returns False if it is still full."""
+        key = callback_key(update)
+        if key is not None and key in self.pending_callbacks:
+            metrics.inc("update_queue.coalesced")
+            task = asyncio.create_task(self._answer_duplicate(update))
+            self._answers.add(task)
+            task.add_done_callback(self._answers.discard)
+            return True
+
+        lane = self.lanes[update_chat_id(update) % len(self.lanes)]
+        item = (time.monotonic(), update, key)
+
+        if lane.full():
+            metrics.inc("update_queue.backpressure")
+            if timeout == 0:
+                metrics.inc("update_queue.rejected")
+                return False
+            try:
+                await asyncio.wait_for(lane.put(item), timeout)
+            except asyncio.TimeoutError:
+                metrics.inc("update_queue.rejected")
+                return False
+        else:
+            lane.put_nowait(item)
+
+        if key is not None:
+            self.pending_callbacks.add(key)
+        metrics.inc("update_queue.enqueued")
+        return True
+
+    async def _answer_duplicate(self, update: Update):
+        try:
+            await self.bot.answer_callback_query(update.callback_query.id)
+        except Exception as e:
+            logger.warning(f"Failed to answer duplicate callback {update.update_id}: {e}")
+
+    async def _worker(self, lane: asyncio.Queue):
+        while True:
+            enqueued_at, update, key = await lane.get()
+            started = time.monotonic()
+            metrics.observe("update_queue.wait", started - enqueued_at)
+            try:
+                result = await self.dispatcher.feed_update(self.bot, update, **self.data)
+                if isinstance(result, TelegramMethod):
+                    await self.dispatcher.silent_call_request(bot=self.bot, result=result)
+                metrics.inc("update_queue.processed")
+            except Exception as e:
+                metrics.inc("update_queue.failed")
+                logger.error(f"Failed to process update {update.update_id}: {e}")
+            finally:
+                self.pending_callbacks.discard(key)
+                metrics.observe("update_queue.process", time.monotonic() - started)
+                lane.task_done()
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Webhook handler that acknowledges Telegram immediately and leaves the
+    actual processing to an UpdateQueue.
+
+    When the queue is full the request waits up to `put_timeout` seconds and
+    then answers 503, so Telegram retries the update later.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, queue: UpdateQueue,
+                 put_timeout: float = 1.0, secret_token: Optional[str] = None):
+        super().__init__(dispatcher=dispatcher, bot=bot, secret_token=secret_token)
+        self.queue = queue
+        self.put_timeout = put_timeout
+
+    def register(self, app: web.Application, /, path: str, **kwargs):
+        super().register(app, path=path, **kwargs)
+        app.on_startup.append(self._start_queue)
+        app.on_shutdown.append(self._stop_queue)
+
+    async def _start_queue(self, app: web.Application):
+        await self.queue.start()
+
+    async def _stop_queue(self, app: web.Application):
+        await self.queue.stop()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+        if not await self.queue.put(update, timeout=self.put_timeout):
+            return web.Response(text="Queue is full", status=503)
+        return web.json_response({})
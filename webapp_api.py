@@ -0,0 +1,211 @@
+"""JSON API for the Telegram Web App dashboard.
+
+    GET /api/entries?limit=50&cursor=...   diary entries, newest first
+    GET /api/stats?days=30                 totals, top emotions and a daily series
+
+The Web App sends its initData as `Authorization: tma <initData>`. It is
+checked as Telegram describes: HMAC-SHA256 of the sorted fields with the key
+HMAC-SHA256("WebAppData", bot token), and must not be older than
+WEBAPP_AUTH_MAX_AGE.
+
+Entries are paged with keyset cursors: `next_cursor` encodes the
+(created_at, id) of the last entry on the page, so a page costs the same at
+any depth. Responses carry a weak ETag built from users.last_entry_id, which
+every write to the user's entries changes; a request whose If-None-Match
+still matches is answered 304 after that single users lookup, without
+reading entries. Bodies are serialized with orjson and written to the client
+in chunks, gzip-compressed when it accepts gzip.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import orjson
+from aiohttp import ETag, hdrs, web
+
+from config import API_PAGE_SIZE, BOT_TOKEN, WEBAPP_AUTH_MAX_AGE
+from database import db
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_PAGE_SIZE = 200
+MAX_STATS_DAYS = 365
+# Entries serialized per write to the response
+CHUNK_ENTRIES = 50
+
+_JSON_OPTIONS = orjson.OPT_NAIVE_UTC
+_SECRET = hmac.new(b"WebAppData", (BOT_TOKEN or "").encode(), hashlib.sha256).digest()
+
+
+def verify_init_data(init_data: str, now: Optional[float] = None) -> Optional[int]:
+    """User id from Web App initData, None if the signature is wrong or too old"""
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received = fields.pop("hash", "")
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    expected = hmac.new(_SECRET, check_string.encode(), hashlib.sha256).hexdigest()
+    # Bytes: compare_digest raises TypeError on non-ASCII str, which a client controls
+    if not hmac.compare_digest(expected.encode(), received.encode()):
+        return None
+    try:
+        auth_date = int(fields["auth_date"])
+        user_id = int(json.loads(fields["user"])["id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if (now or time.time()) - auth_date > WEBAPP_AUTH_MAX_AGE:
+        return None
+    return user_id
+
+
+def encode_cursor(created_at: datetime, entry_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{entry_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """(created_at, id) from encode_cursor(); ValueError if it was not made there"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, entry_id = raw.split("|")
+        return datetime.fromisoformat(created_at), int(entry_id)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Bad cursor: {cursor!r}") from e
+
+
+def _int_param(request: web.Request, name: str, default: int, maximum: int) -> int:
+    try:
+        value = int(request.query.get(name, default))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{name} must be a number")
+    return min(max(value, 1), maximum)
+
+
+async def _authorize(request: web.Request) -> Tuple[int, int, int]:
+    """(user_id, last_entry_id, timezone) of the caller, or an HTTP error"""
+    scheme, _, init_data = request.headers.get(hdrs.AUTHORIZATION, "").partition(" ")
+    user_id = verify_init_data(init_data) if scheme.lower() == "tma" else None
+    if user_id is None:
+        metrics.inc("api.unauthorized")
+        raise web.HTTPUnauthorized(text="Invalid initData")
+    # The tag is read before the data and from the same pool: a replica can only
+    # move forward in between, so the body is never older than its ETag
+    state = await db.get_last_entry_id(user_id)
+    if state is None:
+        raise web.HTTPNotFound(text="Unknown user, start the bot first")
+    return user_id, state[0], state[1]
+
+
+def _not_modified(request: web.Request, etag: str) -> bool:
+    return any(tag.value == etag for tag in request.if_none_match or ())
+
+
+def _response(request: web.Request, etag: str) -> web.StreamResponse:
+    response = web.StreamResponse(headers={
+        hdrs.CACHE_CONTROL: "private, no-cache",
+        hdrs.VARY: "Authorization, Accept-Encoding",
+    })
+    response.etag = ETag(value=etag, is_weak=True)
+    response.content_type = "application/json"
+    if "gzip" in request.headers.get(hdrs.ACCEPT_ENCODING, ""):
+        response.enable_compression(web.ContentCoding.gzip)
+    return response
+
+
+def _not_modified_response(etag: str) -> web.Response:
+    metrics.inc("api.not_modified")
+    response = web.Response(status=304, headers={hdrs.CACHE_CONTROL: "private, no-cache"})
+    response.etag = ETag(value=etag, is_weak=True)
+    return response
+
+
+async def _write_array(response: web.StreamResponse, items: Iterable[dict]):
+    """Write a JSON array CHUNK_ENTRIES items at a time"""
+    await response.write(b"[")
+    chunk, written = [], False
+    for item in items:
+        chunk.append(orjson.dumps(item, option=_JSON_OPTIONS))
+        if len(chunk) == CHUNK_ENTRIES:
+            await response.write((b"," if written else b"") + b",".join(chunk))
+            chunk, written = [], True
+    await response.write((b"," if written and chunk else b"") + b",".join(chunk) + b"]")
+
+
+async def entries_handler(request: web.Request) -> web.StreamResponse:
+    started = time.perf_counter()
+    user_id, version, _ = await _authorize(request)
+    etag = f"{user_id}.{version}"
+    if _not_modified(request, etag):
+        return _not_modified_response(etag)
+
+    limit = _int_param(request, "limit", API_PAGE_SIZE, MAX_PAGE_SIZE)
+    cursor = request.query.get("cursor")
+    try:
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="Bad cursor")
+
+    # The page is fetched whole and the connection returned before writing
+    # to the client, so a slow client never holds a pool connection
+    rows = await db.get_entries_page(user_id, before, limit)
+    next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if len(rows) == limit else None
+
+    response = _response(request, etag)
+    await response.prepare(request)
+    await response.write(b'{"entries":')
+    await _write_array(response, (dict(row) for row in rows))
+    await response.write(b',"next_cursor":' + orjson.dumps(next_cursor) + b"}")
+    await response.write_eof()
+    metrics.observe("api.entries", time.perf_counter() - started)
+    return response
+
+
+async def stats_handler(request: web.Request) -> web.StreamResponse:
+    started = time.perf_counter()
+    user_id, version, timezone = await _authorize(request)
+    # The daily series ends on the user's local today, so the tag rolls over at midnight
+    today = (datetime.utcnow() + timedelta(hours=timezone)).date()
+    etag = f"{user_id}.{version}.{timezone}.{today.isoformat()}"
+    if _not_modified(request, etag):
+        return _not_modified_response(etag)
+
+    days = _int_param(request, "days", 30, MAX_STATS_DAYS)
+    stats = await db.get_emotion_stats(user_id)
+    rollup = await db.get_daily_rollup(user_id, today - timedelta(days=days - 1), today)
+
+    daily = defaultdict(lambda: [0, 0, 0])  # local_date -> entries, intensity sum, intensity count
+    for row in rollup:
+        totals = daily[row["local_date"]]
+        totals[0] += row["entries_count"]
+        totals[1] += row["intensity_sum"]
+        totals[2] += row["intensity_count"]
+    series = [
+        {"date": day, "entries": entries, "avg_intensity": round(total / count, 1) if count else None}
+        for day, (entries, total, count) in sorted(daily.items())
+    ]
+
+    body = {
+        "total": stats.total,
+        "streak": stats.streak,
+        "avg_intensity": float(stats.avg_intensity) if stats.avg_intensity is not None else None,
+        "top_emotions": [{"emotion": emotion, "count": count} for emotion, count in stats.top_emotions],
+        "top_categories": [{"category": category, "count": count} for category, count in stats.top_categories],
+        "days": series,
+    }
+    payload = orjson.dumps(body, option=_JSON_OPTIONS)
+    response = _response(request, etag)
+    await response.prepare(request)
+    await response.write(payload)
+    await response.write_eof()
+    metrics.observe("api.stats", time.perf_counter() - started)
+    return response
+
+
+def setup_api(app: web.Application):
+    app.router.add_get("/api/entries", entries_handler)
+    app.router.add_get("/api/stats", stats_handler)